@@ -79,7 +79,7 @@ def sanitize(value):
 
 
 def create(hdf5, name, dtype, shape=(None,), compression=None,
-           fillvalue=0, attrs=None):
+           fillvalue=0, attrs=None, shuffle=False, chunks=True):
     """
     :param hdf5: a h5py.File object
     :param name: an hdf5 key string
@@ -87,12 +87,14 @@ def create(hdf5, name, dtype, shape=(None,), compression=None,
     :param shape: shape of the dataset (can be extendable)
     :param compression: None or 'gzip' are recommended
     :param attrs: dictionary of attributes of the dataset
+    :param shuffle: if True, apply the shuffle filter before compressing
+    :param chunks: chunk shape of an extendable dataset (True means auto)
     :returns: a HDF5 dataset
     """
     if shape[0] is None:  # extendable dataset
         dset = hdf5.create_dataset(
-            name, (0,) + shape[1:], dtype, chunks=True, maxshape=shape,
-            compression=compression)
+            name, (0,) + shape[1:], dtype, chunks=chunks, maxshape=shape,
+            compression=compression, shuffle=shuffle)
     else:  # fixed-shape dataset
         dset = hdf5.create_dataset(name, shape, dtype, fillvalue=fillvalue,
                                    compression=compression)
@@ -352,7 +354,8 @@ class File(h5py.File):
         self.path = path
         return self
 
-    def create_df(self, key, nametypes, compression=None, **kw):
+    def create_df(self, key, nametypes, compression=None, shuffle=False,
+                  chunks=True, **kw):
         """
         Create a HDF5 datagroup readable as a pandas DataFrame
 
@@ -362,6 +365,10 @@ class File(h5py.File):
             pairs (name, dtype) or (name, array) or structured array or DataFrame
         :param compression:
             the kind of HDF5 compression to use
+        :param shuffle:
+            if True, apply the shuffle filter before compressing
+        :param chunks:
+            chunk shape of the columns (True means auto)
         :param kw:
             extra attributes to store
         """
@@ -380,7 +387,8 @@ class File(h5py.File):
                 dt = value.dtype
             else:
                 dt = value
-            dset = create(self, f'{key}/{name}', dt, (None,), compression)
+            dset = create(self, f'{key}/{name}', dt, (None,), compression,
+                          shuffle=shuffle, chunks=chunks)
             if is_array:
                 extend(dset, value)
             names.append(name)
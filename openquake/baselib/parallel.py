@@ -186,25 +186,33 @@ import time
 import socket
 import signal
 import pickle
+import uuid
+import glob
 import getpass
 import inspect
 import logging
 import operator
 import tempfile
 import traceback
+import contextlib
 import collections
 from unittest import mock
 import multiprocessing.dummy
 from multiprocessing.connection import wait
 import multiprocessing.shared_memory as shmem
+try:
+    import fcntl
+except ImportError:  # on Windows
+    fcntl = None
 import psutil
 import numpy
+import pandas
 
 from openquake.baselib import config, hdf5
 from openquake.baselib.python3compat import decode
 from openquake.baselib.zeromq import zmq, Socket
 from openquake.baselib.performance import (
-    Monitor, memory_gb, init_performance)
+    Monitor, memory_gb, init_performance, perf_dt, task_info_dt)
 from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize, CallableDict,
     gettemp, engine_version, shortlist, compress, decompress, mp as mp_context)
@@ -215,6 +223,10 @@ submit = CallableDict()
 MB = 1024 ** 2
 GB = 1024 ** 3
 host_cores = config.zworkers.host_cores.split(',')
+MIN_STEAL_ETA = 10  # do not re-split tasks expected to end in few seconds
+SHM_DIR = '/dev/shm'  # where the shared memory segments live on Linux
+# arrays larger than that are returned via shared memory, if enabled
+SHM_MIN_BYTES = float(config.distribution.get('shmem_min_mb') or 0) * MB
 
 
 def scratch_dir(job_id):
@@ -378,6 +390,12 @@ class Result(object):
     func = None
 
     def __init__(self, val, mon, tb_str='', msg=''):
+        self.shm_bytes = 0
+        shm_prefix = getattr(mon, 'shm_prefix', None)
+        if shm_prefix and not tb_str and not msg:
+            nbytes = []
+            val = to_shm(val, shm_prefix, mon.shm_min_bytes, nbytes)
+            self.shm_bytes = sum(nbytes)
         if isinstance(val, dict):
             self.pik = Pickled(val)
             self.nbytes = {k: len(Pickled(v)) for k, v in val.items()}
@@ -391,6 +409,8 @@ class Result(object):
         else:
             self.pik = Pickled(val)
             self.nbytes = {'tot': len(self.pik)}
+        if self.shm_bytes:
+            self.nbytes['shm'] = self.shm_bytes
         self.mon = mon
         self.tb_str = tb_str
         self.msg = msg
@@ -402,6 +422,8 @@ class Result(object):
         """
         t0 = time.time()
         val = self.pik.unpickle()
+        if self.shm_bytes:
+            val = from_shm(val)
         self.dt = time.time() - t0
         if self.tb_str:
             etype = val.__class__
@@ -676,6 +698,198 @@ class SharedArray(object):
         self.sm.close()
         self.sm.unlink()
 
+
+class WorkStealer(object):
+    """
+    Helper to be used inside generator tasks looping over work items
+    (sources, tiles, ...). It estimates the time needed to complete the
+    remaining items and stores it in `monitor.eta`, so that the master
+    receives it with the next result. If the master is in work stealing
+    mode and there are idle cores, it suggests to re-split the remaining
+    items, so that the idle cores can steal them.
+
+    :param monitor: the task monitor
+    :param total: the total number of work items in the task
+    """
+    def __init__(self, monitor, total):
+        self.monitor = monitor
+        self.total = total
+        self.t0 = time.time()
+        shared = getattr(monitor, 'shared', None) or {}
+        self.idle = shared.get('idle')  # None if not in work stealing mode
+
+    def pieces(self, done, maxpieces):
+        """
+        :param done: number of work items already completed
+        :param maxpieces: maximum number of pieces for the remaining work
+        :returns: the number of pieces in which to re-split the remaining
+                  work, or 0 if the task should continue
+        """
+        eta = (time.time() - self.t0) / done * (self.total - done)
+        self.monitor.eta = eta
+        if self.idle is None or maxpieces < 2 or eta < MIN_STEAL_ETA:
+            return 0
+        with self.idle as arr:
+            idle = int(arr[0])
+            if idle == 0:
+                return 0
+            npieces = min(idle + 1, maxpieces)
+            arr[0] = idle - npieces + 1  # claim the idle cores
+        return npieces
+
+
+class ReadTokens(object):
+    """
+    Token-based admission for tasks reading the same file concurrently:
+    at most `num_tokens` tasks can read at the same time, the others wait
+    on a file lock inside the kernel, without polling or sleeping. The
+    tokens are files in the given directory, so the admission works with
+    processpool and threadpool and also with zmq if the directory is
+    on a shared filesystem. Use it as follows::
+
+     tokens = ReadTokens(scratch_dir(monitor.calc_id), 8)
+     with tokens(monitor):
+         <read the data>
+
+    The time spent waiting for a token is stored in the performance
+    data under the operation "waiting for read token".
+
+    :param dirname: directory where to store the token files
+    :param num_tokens: maximum number of concurrent readers (0 = no limit)
+    """
+    def __init__(self, dirname, num_tokens):
+        self.dirname = dirname
+        self.num_tokens = num_tokens if fcntl else 0
+
+    def _path(self, i):
+        return os.path.join(self.dirname, 'read_token_%d.lock' % i)
+
+    def _acquire(self, start):
+        # try all the tokens without blocking, starting from `start`
+        # and then wait for the first one
+        n = self.num_tokens
+        for i in range(n):
+            fh = open(self._path((start + i) % n), 'w')
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fh
+            except BlockingIOError:
+                fh.close()
+        fh = open(self._path(start % n), 'w')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    @contextlib.contextmanager
+    def __call__(self, monitor):
+        """
+        Context manager holding a token while reading
+        """
+        if not self.num_tokens:
+            yield
+            return
+        with monitor('waiting for read token', measuremem=False):
+            # spread the waiting tasks over the tokens
+            fh = self._acquire(monitor.task_no)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+            fh.close()
+
+
+class ShmArray(object):
+    """
+    A numpy array stored by a worker in a shared memory segment (a file in
+    /dev/shm) and mapped without copying by the master on the same node.
+    The file API is used instead of mmap to get an OSError and not a SIGBUS
+    when /dev/shm is full.
+
+    :param array: a numpy array without objects
+    :param prefix: the prefix of the segment path
+    """
+    def __init__(self, array, prefix):
+        self.path = prefix + uuid.uuid4().hex
+        self.shape = array.shape
+        self.dtype = array.dtype
+        try:
+            with open(self.path, 'wb') as f:
+                numpy.ascontiguousarray(array).tofile(f)
+        except OSError:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            raise
+
+    def get(self):
+        """
+        :returns: the array mapped in memory; the segment is unlinked, so
+                  the memory is released when the array is garbage collected
+        """
+        try:
+            arr = numpy.memmap(self.path, self.dtype, 'r+', shape=self.shape)
+        finally:
+            os.unlink(self.path)
+        return arr.view(numpy.ndarray)
+
+
+def to_shm(val, prefix, min_bytes, nbytes):
+    """
+    Move the large arrays contained in a task result (directly, inside
+    dictionaries, DataFrames or objects with an .array attribute like
+    MapArrays) into shared memory.
+
+    :param val: the task result
+    :param prefix: the prefix of the shared memory segments
+    :param min_bytes: only arrays larger than that are moved
+    :param nbytes: a list populated with the number of bytes moved
+    :returns: the task result with ShmArray instances instead of arrays
+    """
+    if isinstance(val, numpy.ndarray):
+        if val.nbytes >= min_bytes and not val.dtype.hasobject:
+            try:
+                shm = ShmArray(val, prefix)
+            except OSError as exc:  # for instance /dev/shm is full
+                logging.warning('Could not use the shared memory: %s', exc)
+            else:
+                nbytes.append(val.nbytes)
+                return shm
+    elif isinstance(val, dict):
+        for k, v in val.items():
+            val[k] = to_shm(v, prefix, min_bytes, nbytes)
+    elif (isinstance(val, pandas.DataFrame) and
+          isinstance(val.index, pandas.RangeIndex) and val.index.start == 0):
+        dic = {col: to_shm(val[col].to_numpy(), prefix, min_bytes, nbytes)
+               for col in val.columns}
+        if any(isinstance(v, ShmArray) for v in dic.values()):
+            return ShmFrame(dic)
+    elif isinstance(getattr(val, 'array', None), numpy.ndarray):
+        val.array = to_shm(val.array, prefix, min_bytes, nbytes)
+    return val
+
+
+class ShmFrame(dict):
+    """
+    A dictionary column name -> array or ShmArray used to transfer
+    DataFrames with a trivial index
+    """
+
+
+def from_shm(val):
+    """
+    Replace the ShmArray instances in a task result with arrays mapped in
+    memory; it is the inverse of :func:`to_shm`
+    """
+    if isinstance(val, ShmArray):
+        return val.get()
+    elif isinstance(val, ShmFrame):
+        return pandas.DataFrame({k: from_shm(v) for k, v in val.items()})
+    elif isinstance(val, dict):
+        for k, v in val.items():
+            val[k] = from_shm(v)
+    elif isinstance(getattr(val, 'array', None), ShmArray):
+        val.array = val.array.get()
+    return val
+
+
 # determine the number of cores to use
 cpu_count = psutil.cpu_count()
 if sys.platform == 'win32':
@@ -696,6 +910,12 @@ class Starmap(object):
     num_cores = int(config.distribution.get('num_cores', '0')) or tot_cores
     CT = num_cores * 2
     expected_outputs = 0  # unknown
+    # in work stealing mode generator tasks can re-split their remaining
+    # work when there are idle cores (see WorkStealer)
+    work_stealing = bool(config.distribution.get('work_stealing'))
+    # the task info is saved in batches, to avoid lots of small writes
+    save_every = 100  # tasks
+    save_time = 10  # seconds
 
     @classmethod
     def init(cls, distribute=None):
@@ -818,6 +1038,13 @@ class Starmap(object):
         self.task_no = 0
         self._shared = {}
         self.n_out = 0
+        self.task_info = []  # task_info records to save
+        self.perf_data = []  # performance arrays to save
+        self.last_save = time.time()
+        self.etas = {}  # task_no -> latest ETA in seconds
+        self.max_etas = {}  # task_no -> maximum ETA in seconds
+        self.n_stolen = 0  # number of subtasks spawned by running tasks
+        self.shm_received = 0  # bytes received via shared memory
 
     def log_percent(self):
         """
@@ -834,10 +1061,36 @@ class Starmap(object):
             queued = len(self.task_queue)
             self.progress('%s %3d%% [%d submitted, %d queued]',
                           self.name, percent, self.task_no, queued)
+            if self.etas:
+                self.progress('ETA of the slowest running tasks: %s',
+                              self.slowest(self.etas))
             self.prev_percent = percent
         assert percent <= 100, percent  # sanity check
         return done
 
+    @staticmethod
+    def slowest(etas, n=3):
+        """
+        :returns: a string with the n tasks with the largest ETA
+        """
+        items = sorted(etas.items(), key=operator.itemgetter(1), reverse=True)
+        return ', '.join('#%d=%ds' % (task_no, eta)
+                         for task_no, eta in items[:n])
+
+    def set_idle(self):
+        """
+        Store the number of idle cores in the shared memory, so that the
+        running tasks can decide to re-split their work
+        """
+        if 'idle' not in self._shared:
+            return
+        if self.task_queue:  # the free cores will receive queued tasks
+            idle = 0
+        else:
+            idle = max((len(self.pids) or self.num_cores) - len(self.tasks), 0)
+        with self._shared['idle'] as arr:
+            arr[0] = idle
+
     def init_slurm(self):
         """
         Initialize the list host_cores by reading the file with the hostcores
@@ -855,6 +1108,16 @@ class Starmap(object):
         if not hasattr(self, 'socket'):  # setup the PULL socket the first time
             self.__class__.running_tasks = self.tasks
             self.socket = Socket(self.receiver, zmq.PULL, 'bind').__enter__()
+            if self.work_stealing and self.distribute in (
+                    'processpool', 'threadpool'):
+                # the number of idle cores is known only on a single node
+                self._shared['idle'] = SharedArray((1,), numpy.int32, 0)
+            if (SHM_MIN_BYTES and self.distribute == 'processpool' and
+                    os.path.isdir(SHM_DIR)):
+                # return the large arrays via shared memory
+                self.monitor.shm_prefix = os.path.join(
+                    SHM_DIR, 'oq-%d-%d-' % (os.getpid(), self.socket.port))
+                self.monitor.shm_min_bytes = SHM_MIN_BYTES
             self.monitor.shared = self._shared
             self.monitor.backurl = 'tcp://%s:%s' % (
                 self.return_ip, self.socket.port)
@@ -949,6 +1212,57 @@ class Starmap(object):
             logging.debug('Unlinking %s', name)
             shr.unlink()
 
+    def _task_ended(self, res):
+        # accumulate the task info and the performance data of the task
+        self.busytime += {res.workerid: res.mon.duration}
+        name = res.mon.operation[6:]  # strip 'total '
+        n = self.name + ':' + name if name == 'split_task' else name
+        if self.distribute in ('zmq', 'slurm'):
+            mem_gb = 0
+            if res.mon.task_no % 10 == 0:
+                # measure the memory only for 1 task out of 10, to be fast
+                # with 8 nodes the time to get the memory is 0.01 secs
+                for line in host_cores:
+                    host, _cores = line.split()
+                    addr = 'tcp://%s:%s' % (host, config.zworkers.ctrl_port)
+                    with Socket(addr, zmq.REQ, 'connect') as sock:
+                        mem_gb += sock.send('memory_gb')
+        elif self._shared:
+            # do not measure the memory on the workers, only in the master
+            # otherwise memory_rss would double count the shared memory
+            mem_gb = memory_gb()
+        else:
+            mem_gb = memory_gb(Starmap.pids)
+        self.task_info.append(res.mon.get_task_info(res, n, mem_gb))
+        self.perf_data.append(res.mon.get_data())
+        self.save_task_info()
+
+    def save_task_info(self, force=False):
+        """
+        Save the accumulated task_sent, task_info and performance_data
+        in the underlying hdf5 file. This is done every `save_every` tasks
+        or `save_time` seconds, unless `force` is set.
+        """
+        if not force and (
+                len(self.task_info) < self.save_every and
+                time.time() - self.last_save < self.save_time):
+            return
+        task_sent = ast.literal_eval(decode(self.h5['task_sent'][()]))
+        task_sent.update(self.sent)
+        del self.h5['task_sent']
+        self.h5['task_sent'] = str(task_sent)
+        if self.task_info:
+            hdf5.extend(self.h5['task_info'],
+                        numpy.array(self.task_info, task_info_dt))
+            self.h5['task_info'].flush()  # notify the reader
+        if self.perf_data:
+            perf_data = numpy.concatenate(self.perf_data, dtype=perf_dt)
+            hdf5.extend(self.h5['performance_data'], perf_data)
+            self.h5['performance_data'].flush()  # notify the reader
+        self.task_info.clear()
+        self.perf_data.clear()
+        self.last_save = time.time()
+
     def _loop(self):
         self.busytime = AccumDict(accum=[])  # pid -> time
         dist = 'no' if self.num_tasks == 1 else self.distribute
@@ -968,6 +1282,7 @@ class Starmap(object):
         nbytes = sum(self.sent[self.task_func.__name__].values())
         logging.warning('Sent %d %s tasks, %s', len(self.tasks),
                         self.name, humansize(nbytes))
+        self.set_idle()
 
         isocket = iter(self.socket)  # read from the PULL socket
         finished = set()
@@ -979,44 +1294,36 @@ class Starmap(object):
                                 'is job %s', res.mon.calc_id, self.calc_id)
             elif res.msg == 'TASK_ENDED':
                 finished.add(res.mon.task_no)
-                self.busytime += {res.workerid: res.mon.duration}
                 self.tasks.remove(res.mon.task_no)
+                self.etas.pop(res.mon.task_no, None)
                 self._submit_many(1)
+                self.set_idle()
                 todo = set(range(self.task_no)) - finished
                 logging.debug('%d tasks todo %s', len(todo),
                               shortlist(sorted(todo)))
-                task_sent = ast.literal_eval(decode(self.h5['task_sent'][()]))
-                task_sent.update(self.sent)
-                del self.h5['task_sent']
-                self.h5['task_sent'] = str(task_sent)
-                name = res.mon.operation[6:]  # strip 'total '
-                n = self.name + ':' + name if name == 'split_task' else name
-                if self.distribute in ('zmq', 'slurm'):
-                    mem_gb = 0
-                    if res.mon.task_no % 10 == 0:
-                        # measure the memory only for 1 task out of 10, to be fast
-                        # with 8 nodes the time to get the memory is 0.01 secs
-                        for line in host_cores:
-                            host, _cores = line.split()
-                            addr = 'tcp://%s:%s' % (host, config.zworkers.ctrl_port)
-                            with Socket(addr, zmq.REQ, 'connect') as sock:
-                                mem_gb += sock.send('memory_gb')
-                elif self._shared:
-                    # do not measure the memory on the workers, only in the master
-                    # otherwise memory_rss would double count the shared memory
-                    mem_gb = memory_gb()
-                else:
-                    mem_gb = memory_gb(Starmap.pids)
-                res.mon.save_task_info(self.h5, res, n, mem_gb)
-                res.mon.flush(self.h5)
+                self._task_ended(res)
             elif res.func:  # add subtask
                 self.task_queue.append((res.func, res.pik))
                 self._submit_many(1)
+                self.n_stolen += 1
+                self.set_idle()
             else:
+                eta = getattr(res.mon, 'eta', None)
+                if eta is not None:
+                    task_no = res.mon.task_no
+                    self.etas[task_no] = eta
+                    self.max_etas[task_no] = max(
+                        eta, self.max_etas.get(task_no, 0))
                 self.n_out += 1
+                self.shm_received += res.shm_bytes
                 yield res
         self.log_percent()
+        self.save_task_info(force=True)
         self.socket.__exit__(None, None, None)
+        prefix = getattr(self.monitor, 'shm_prefix', None)
+        if prefix:  # remove the segments of discarded results, if any
+            for path in glob.glob(prefix + '*'):
+                os.remove(path)
         self.tasks.clear()
         self.unlink()
         if len(self.busytime) > 1:
@@ -1024,6 +1331,9 @@ class Starmap(object):
             logging.info(
                 'Mean time per core=%ds, std=%.1fs, min=%ds, max=%ds',
                 times.mean(), times.std(), times.min(), times.max())
+        if self.max_etas:
+            logging.info('Largest ETA estimates: %s; spawned %d subtasks',
+                         self.slowest(self.max_etas), self.n_stolen)
 
 
 def sequential_apply(task, args, concurrent_tasks=Starmap.CT,
@@ -1066,18 +1376,30 @@ def split_task(elements, func, args, duration, outs_per_task, monitor):
                    for i in range(outs_per_task)]
     # see how long it takes to run the first slice
     t0 = time.time()
+    stealer = WorkStealer(monitor, n)
+    done = 0
     for i, elems in enumerate(split_elems):
         monitor.out_no = monitor.task_no + i * 65536
         res = func(elems, *args, monitor=monitor)
         dt = time.time() - t0
+        done += len(elems)
+        # claim the idle cores only if the task is not split by duration
+        npieces = 0 if dt > duration else stealer.pieces(done, n - done)
         yield res
         if dt > duration:
             # spawn subtasks for the rest and exit, used in classical/case_14
-            for els in split_elems[i + 1:]:
-                ls = List(els)
-                ls.weight = sum(getattr(el, 'weight', 1.) for el in els)
-                yield (func, ls) + args
-            break
+            rest = split_elems[i + 1:]
+        elif npieces:
+            # give the rest to the idle cores
+            rest = numpy.array_split(
+                numpy.concatenate(split_elems[i + 1:]), npieces)
+        else:
+            continue
+        for els in rest:
+            ls = List(els)
+            ls.weight = sum(getattr(el, 'weight', 1.) for el in els)
+            yield (func, ls) + args
+        break
 
 
 def logfinish(n, tot):
@@ -311,17 +311,24 @@ class Monitor(object):
         if self.h5:
             self.flush(self.h5)
 
-    def save_task_info(self, h5, res, name, mem_gb=0):
+    def get_task_info(self, res, name, mem_gb=0):
         """
-        Called by parallel.IterResult.
+        :param res: a :class:`Result` object
+        :param name: name of the task function
+        :param mem_gb: memory consumption at the saving time (optional)
+        :returns: a tuple compatible with task_info_dt
+        """
+        return (name, self.task_no, self.weight, self.duration, len(res.pik),
+                mem_gb)
 
+    def save_task_info(self, h5, res, name, mem_gb=0):
+        """
         :param h5: where to save the info
         :param res: a :class:`Result` object
         :param name: name of the task function
         :param mem_gb: memory consumption at the saving time (optional)
         """
-        t = (name, self.task_no, self.weight, self.duration, len(res.pik),
-             mem_gb)
+        t = self.get_task_info(res, name, mem_gb)
         data = numpy.array([t], task_info_dt)
         hdf5.extend(h5['task_info'], data)
         h5['task_info'].flush()  # notify the reader
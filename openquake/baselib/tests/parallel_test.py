@@ -17,6 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import glob
 import sys
 import platform
 import unittest.mock as mock
@@ -25,6 +26,7 @@ import shutil
 import unittest
 import itertools
 import tempfile
+import threading
 import numpy
 import pandas
 
@@ -146,6 +148,24 @@ class StarmapTestCase(unittest.TestCase):
             self.assertGreater(dic[b'supertask'], 0)
         shutil.rmtree(tmpdir)
 
+    def test_task_info(self):
+        # the task info is saved in batches of 2 tasks and at the end
+        tmpdir = tempfile.mkdtemp()
+        tmp = os.path.join(tmpdir, 'calc_1.hdf5')
+        performance.init_performance(tmp)
+        allargs = [(numpy.arange(n),) for n in range(5)]
+        with hdf5.File(tmp, 'a') as h5, \
+                mock.patch.object(parallel.Starmap, 'save_every', 2):
+            res = parallel.Starmap(get_length, allargs, h5=h5).reduce()
+        self.assertEqual(res, {'n': 10})
+        with hdf5.File(tmp, 'r') as h5:
+            info = h5['task_info'][()]
+            self.assertEqual(sorted(info['task_no']), [0, 1, 2, 3, 4])
+            num = general.countby(h5['performance_data'][()], 'operation')
+            self.assertEqual(num[b'total get_length'], 5)
+            self.assertIn('get_length', h5['task_sent'][()].decode('utf8'))
+        shutil.rmtree(tmpdir)
+
     def test_countletters(self):
         data = [('hello', 'world'), ('ciao', 'mondo')]
         smap = parallel.Starmap(countletters, data)
@@ -254,6 +274,96 @@ class SplitTaskTestCase(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+class WorkStealingTestCase(unittest.TestCase):
+    def test_pieces(self):
+        idle = parallel.SharedArray((1,), numpy.int32, 3)
+        try:
+            mon = performance.Monitor()
+            mon.shared = {'idle': idle}
+            stealer = parallel.WorkStealer(mon, 100)
+            stealer.t0 -= 10  # pretend 10 seconds were spent
+            with mock.patch.object(parallel, 'MIN_STEAL_ETA', 1):
+                self.assertEqual(stealer.pieces(10, 90), 4)
+                # the idle cores have been claimed
+                self.assertEqual(stealer.pieces(20, 80), 0)
+            self.assertGreater(mon.eta, 30)
+        finally:
+            idle.unlink()
+
+    def test_duration_does_not_claim(self):
+        # when the task is split by duration the idle cores are left free
+        idle = parallel.SharedArray((1,), numpy.int32, 3)
+        try:
+            mon = performance.Monitor()
+            mon.shared = {'idle': idle}
+            with mock.patch.object(parallel, 'MIN_STEAL_ETA', 0):
+                out = list(parallel.split_task(
+                    numpy.arange(10), lambda els, monitor: els.sum(), (),
+                    -1, 5, mon))
+            self.assertEqual(out[0], 5)  # 0 + 5
+            self.assertEqual(len(out), 5)  # result + 4 subtasks
+            with idle as arr:
+                self.assertEqual(arr[0], 3)
+        finally:
+            idle.unlink()
+
+    def test_split(self):
+        # a straggler task with slow elements is re-split on the idle cores;
+        # using a threadpool so that MIN_STEAL_ETA is patched in the workers
+        elements = numpy.array([.01] * 9 + [.1] * 10)
+        tmpdir = tempfile.mkdtemp()
+        tmp = os.path.join(tmpdir, 'calc_1.hdf5')
+        parallel.Starmap.shutdown()
+        with hdf5.File(tmp, 'w') as h5, \
+                mock.patch.dict(os.environ, {'OQ_DISTRIBUTE': 'threadpool'}), \
+                mock.patch.object(parallel, 'MIN_STEAL_ETA', .1), \
+                mock.patch.object(parallel.Starmap, 'num_cores', 4), \
+                mock.patch.object(parallel.Starmap, 'work_stealing', True):
+            performance.init_performance(h5)
+            try:
+                smap = parallel.Starmap(process_elements, h5=h5)
+                smap.submit_split((elements, 1), 1000, 10)
+                res = smap.reduce(acc=0)
+            finally:
+                parallel.Starmap.shutdown()
+        self.assertAlmostEqual(res, elements.sum())
+        self.assertGreater(smap.n_stolen, 0)
+        self.assertIn(0, smap.max_etas)  # ETA of the first task
+        shutil.rmtree(tmpdir)
+
+
+@unittest.skipIf(parallel.fcntl is None, 'fcntl is not available')
+class ReadTokensTestCase(unittest.TestCase):
+    def test(self):
+        # with 2 tokens the third reader has to wait for the first one
+        tmpdir = tempfile.mkdtemp()
+        tokens = parallel.ReadTokens(tmpdir, 2)
+        mons = [performance.Monitor('task') for _ in range(3)]
+        for task_no, mon in enumerate(mons):
+            mon.task_no = task_no
+        events = []
+
+        def read(mon, dt):
+            with tokens(mon):
+                events.append(('start', mon.task_no))
+                time.sleep(dt)
+                events.append(('stop', mon.task_no))
+
+        threads = [threading.Thread(target=read, args=(mon, dt))
+                   for mon, dt in zip(mons, [.2, .4, 0])]
+        for thread in threads:
+            thread.start()
+            time.sleep(.05)
+        for thread in threads:
+            thread.join()
+        self.assertLess(events.index(('stop', 0)), events.index(('start', 2)))
+        # the waiting time is recorded in the performance data
+        [waiting] = mons[2].children
+        self.assertEqual(waiting.operation, 'waiting for read token')
+        self.assertGreater(waiting.duration, .05)
+        shutil.rmtree(tmpdir)
+
+
 def update(s_array, index, value, monitor):
     """
     Update a shared array
@@ -277,3 +387,45 @@ class SharedArrayTestCase(unittest.TestCase):
         ).reduce()
         with self.s_array as arr:
             numpy.testing.assert_allclose(arr, [[.1, .1], [.2, .2]])
+
+
+class Rmap(object):
+    # an object with an .array attribute, like a MapArray
+    def __init__(self, array):
+        self.array = array
+
+
+def big_arrays(n, monitor):
+    df = pandas.DataFrame(dict(eid=numpy.arange(n), loss=numpy.ones(n)))
+    return {'rmap': Rmap(numpy.full((n, 2), .1)), 'alt': df,
+            'gmfdata': {'sid': numpy.zeros(n, numpy.uint32)}, 'n': n}
+
+
+@unittest.skipUnless(os.path.isdir(parallel.SHM_DIR), 'no /dev/shm')
+class ShmTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        prefix = os.path.join(parallel.SHM_DIR, 'oq-test-')
+        nbytes = []
+        val = parallel.to_shm(big_arrays(100, None), prefix, 800, nbytes)
+        self.assertEqual(nbytes, [1600, 800, 800])  # small sids not moved
+        self.assertIsInstance(val['rmap'].array, parallel.ShmArray)
+        self.assertIsInstance(val['alt'], parallel.ShmFrame)
+        val = parallel.from_shm(val)
+        self.assertEqual(val['rmap'].array.sum(), 20.)
+        self.assertEqual(list(val['alt'].columns), ['eid', 'loss'])
+        self.assertEqual(val['alt'].loss.sum(), 100.)
+        self.assertEqual(glob.glob(prefix + '*'), [])  # segments unlinked
+
+    def test_starmap(self):
+        allargs = [(n,) for n in (10, 1000, 2000)]
+        with mock.patch.object(parallel, 'SHM_MIN_BYTES', 1000):
+            smap = parallel.Starmap(big_arrays, allargs,
+                                    distribute='processpool')
+            for res in smap:
+                n = res['n']
+                self.assertEqual(len(res['alt']), n)
+                self.assertEqual(res['rmap'].array.shape, (n, 2))
+                self.assertEqual(len(res['gmfdata']['sid']), n)
+        # check that the shared memory was used and cleaned up
+        self.assertGreater(smap.shm_received, 0)
+        self.assertEqual(glob.glob(smap.monitor.shm_prefix + '*'), [])
@@ -19,7 +19,7 @@
 import time
 import unittest
 from openquake.baselib import config
-from openquake.baselib.workerpool import WorkerMaster
+from openquake.baselib.workerpool import WorkerMaster, preload
 from openquake.baselib.parallel import Starmap
 from openquake.baselib.general import socket_ready
 
@@ -53,3 +53,11 @@ class WorkerPoolTestCase(unittest.TestCase):
     def tearDownClass(cls):
         cls.master.stop()
         config.zworkers = cls.z
+
+
+class PreloadTestCase(unittest.TestCase):
+    def test(self):
+        # the unknown GSIM is logged and skipped
+        with self.assertLogs(level='WARNING'):
+            n = preload('BooreAtkinson2011, Unknown')
+        self.assertEqual(n, 1)
@@ -22,7 +22,9 @@ import shutil
 import socket
 import getpass
 import tempfile
+import logging
 import functools
+import importlib
 import subprocess
 from datetime import datetime
 import psutil
@@ -35,9 +37,59 @@ except ImportError:
         "Do nothing"
 
 
+# modules containing numba functions compiled at import time (i.e. loaded
+# from the numba cache) and used in the tasks of the calculators
+PRELOAD = ['openquake.baselib.performance',
+           'openquake.hazardlib.gsim',
+           'openquake.hazardlib.contexts',
+           'openquake.hazardlib.map_array',
+           'openquake.hazardlib.stats',
+           'openquake.hazardlib.calc.gmf',
+           'openquake.hazardlib.geo.utils',
+           'openquake.risklib.reinsurance',
+           'openquake.calculators.classical',
+           'openquake.calculators.event_based',
+           'openquake.calculators.event_based_risk']
+
+
+def preload(gsims=''):
+    """
+    Import the modules used by the tasks (all the GSIMs and the numba
+    functions) and instantiate the given GSIMs, so that the tasks
+    do not pay the startup cost.
+
+    :param gsims: comma-separated GSIM class names, possibly empty
+    :returns: the number of instantiated GSIMs
+    """
+    for modname in PRELOAD:
+        importlib.import_module(modname)
+    from openquake.hazardlib import valid
+    n = 0
+    for name in gsims.split(','):
+        name = name.strip()
+        if name:
+            try:
+                valid.gsim(name)
+            except Exception as exc:  # do not kill the worker
+                logging.warning('Could not preload %s: %s', name, exc)
+            else:
+                n += 1
+    return n
+
+
 def init_workers():
     """Used to initialize the process pool"""
     setproctitle('oq-zworker')
+    if keep_alive():
+        preload(config.zworkers.get('preload_gsims') or '')
+
+
+def keep_alive():
+    """
+    :returns: True if the workerpool must survive the end of the jobs
+    """
+    return (parallel.oq_distribute() == 'zmq' and
+            config.zworkers.get('keep_alive', '').lower() in ('1', 'true'))
 
 
 def get_zworkers(job_id):
@@ -315,7 +367,8 @@ class WorkerPool(object):
                         break
                     elif cmd == 'restart':
                         self.stop()
-                        self.pool = general.mp.Pool(self.num_workers)
+                        self.pool = general.mp.Pool(
+                            self.num_workers, init_workers)
                         ctrlsock.send('restarted')
                     elif cmd == 'getpid':
                         ctrlsock.send(self.proc.pid)
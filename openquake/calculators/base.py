@@ -29,7 +29,8 @@ import operator
 import traceback
 import getpass
 from datetime import datetime
-from shapely import wkt, geometry
+import shapely
+from shapely import wkt
 import psutil
 import numpy
 import pandas
@@ -52,6 +53,7 @@ from openquake.hazardlib.shakemap.maps import get_sitecol_shakemap
 from openquake.hazardlib.shakemap.gmfs import to_gmfs
 from openquake.risklib import riskinput, riskmodels, reinsurance
 from openquake.commonlib import readinput, datastore, logs
+from openquake.commonlib.calc import GMF_CHUNK
 from openquake.calculators.export import export as exp
 from openquake.calculators import getters, postproc
 
@@ -205,8 +207,8 @@ def wkt2peril(fname, name, sitecol):
                              (fname, text.split('(')[0]))
         geom = wkt.loads(text.strip('"'))  # strip quotes
     peril = numpy.zeros(len(sitecol), float)
-    for sid, lon, lat in sitecol.complete.array[['sids', 'lon', 'lat']]:
-        peril[sid] = geometry.Point(lon, lat).within(geom)
+    arr = sitecol.complete.array
+    peril[arr['sids']] = shapely.contains_xy(geom, arr['lon'], arr['lat'])
     return peril
 
 
@@ -857,9 +859,8 @@ class HazardCalculator(BaseCalculator):
                                      field_map=json.dumps(fieldmap))
             self.treaty_df = treaty_df
             # add policy_grp column
-            for _, pol in policy_df.iterrows():
-                grp = reinsurance.build_policy_grp(pol, treaty_df)
-                policy_acc['policy_grp'].append(grp)
+            policy_acc['policy_grp'].extend(
+                reinsurance.build_policy_grps(policy_df, treaty_df))
             for col in policy_df.columns:
                 policy_acc[col].extend(policy_df[col])
             policy_acc['loss_type'].extend([loss_type] * len(policy_df))
@@ -1526,9 +1527,14 @@ def create_gmf_data(dstore, prim_imts, sec_imts=(), data=None, N=None, E=None, R
         eff_time = oq.investigation_time * oq.ses_per_logic_tree_path * R
     else:
         eff_time = 0
-    # not gzipping for speed
+    # not compressing by default for speed
+    if oq.gmf_compression:
+        kw = dict(compression=oq.gmf_compression, shuffle=True,
+                  chunks=(GMF_CHUNK,))
+    else:
+        kw = {}
     dstore.create_df('gmf_data', items, num_events=E or len(dstore['events']),
-                     imts=' '.join(map(str, prim_imts)),
+                     imts=' '.join(map(str, prim_imts)), **kw,
                      investigation_time=oq.investigation_time or 0,
                      effective_time=eff_time)
     if oq.mea_tau_phi:
@@ -1536,12 +1542,12 @@ def create_gmf_data(dstore, prim_imts, sec_imts=(), data=None, N=None, E=None, R
             'mea_tau_phi', GmfComputer.mtp_dt.descr, compression='gzip')
 
     if data is not None:
-        _df = pandas.DataFrame(dict(items))
+        sids = data['sid']
+        gmvs = numpy.array([arr for _, arr in items[2:]]).T
+        momenta = stats.calc_momenta_by(sids, gmvs, numpy.ones(len(sids)), N)
+        ok = momenta[0, :, 0] > 0
         avg_gmf = numpy.zeros((2, N, M + len(sec_imts)), F32)
-        for sid, df in _df.groupby(_df.sid):
-            df.pop('eid')
-            df.pop('sid')
-            avg_gmf[:, sid] = stats.avg_std(df.to_numpy())
+        avg_gmf[:, ok] = stats.calc_avg_std(momenta[:, ok])
         dstore['avg_gmf'] = avg_gmf
 
 
@@ -31,7 +31,8 @@ from openquake.baselib import parallel, hdf5, config, python3compat
 from openquake.baselib.general import (
     AccumDict, DictArray, groupby, humansize, block_splitter)
 from openquake.hazardlib import valid, InvalidFile
-from openquake.hazardlib.contexts import read_cmakers
+from openquake.hazardlib.contexts import (
+    read_cmakers, purge_ctxs_cache, CTXS_CACHE)
 from openquake.hazardlib.calc.hazard_curve import classical as hazclassical
 from openquake.hazardlib.calc import disagg
 from openquake.hazardlib.map_array import RateMap, MapArray, rates_dt, check_hmaps
@@ -61,25 +62,27 @@ def _store(rates, num_chunks, h5, mon=None, gzip=GZIP):
     if newh5:
         scratch = parallel.scratch_dir(mon.calc_id)
         h5 = hdf5.File(f'{scratch}/{mon.task_no}.hdf5', 'a')
+    try:
+        h5.create_df(
+            '_rates', [(n, rates_dt[n]) for n in rates_dt.names], gzip)
+        hdf5.create(
+            h5, '_rates/slice_by_idx', getters.slice_dt, fillvalue=None)
+    except ValueError:  # already created
+        offset = len(h5['_rates/sid'])
+    else:
+        offset = 0
+    # sort by chunk and site ID, so that each chunk is stored in a single
+    # contiguous slice and the columns are extended only once
     chunks = rates['sid'] % num_chunks
-    idx_start_stop = []
-    for chunk in numpy.unique(chunks):
-        ch_rates = rates[chunks == chunk]
-        try:
-            h5.create_df(
-                '_rates', [(n, rates_dt[n]) for n in rates_dt.names], gzip)
-            hdf5.create(
-                h5, '_rates/slice_by_idx', getters.slice_dt, fillvalue=None)
-        except ValueError:  # already created
-            offset = len(h5['_rates/sid'])
-        else:
-            offset = 0
-        idx_start_stop.append((chunk, offset, offset + len(ch_rates)))
-        hdf5.extend(h5['_rates/sid'], ch_rates['sid'])
-        hdf5.extend(h5['_rates/gid'], ch_rates['gid'])
-        hdf5.extend(h5['_rates/lid'], ch_rates['lid'])
-        hdf5.extend(h5['_rates/rate'], ch_rates['rate'])
-    iss = numpy.array(idx_start_stop, getters.slice_dt)
+    order = numpy.lexsort((rates['sid'], chunks))
+    rates = rates[order]
+    uchunks, starts = numpy.unique(chunks[order], return_index=True)
+    iss = numpy.zeros(len(uchunks), getters.slice_dt)
+    iss['idx'] = uchunks
+    iss['start'] = starts + offset
+    iss['stop'] = numpy.append(starts[1:], len(rates)) + offset
+    for name in rates_dt.names:
+        hdf5.extend(h5['_rates/' + name], rates[name])
     hdf5.extend(h5['_rates/slice_by_idx'], iss)
     if newh5:
         fname = h5.filename
@@ -152,6 +155,7 @@ def classical(sources, tilegetters, cmaker, dstore, monitor):
     """
     # NB: removing the yield would cause terrible slow tasks
     cmaker.init_monitoring(monitor)
+    srcs_arg = sources  # passed to the subtasks, if any
     with dstore:
         if sources is None:  # read the full group from the datastore
             arr = dstore.getitem('_csm')[cmaker.grp_id]
@@ -168,7 +172,8 @@ def classical(sources, tilegetters, cmaker, dstore, monitor):
             yield result
         return
 
-    for tileget in tilegetters:
+    stealer = parallel.WorkStealer(monitor, len(tilegetters))
+    for t, tileget in enumerate(tilegetters, 1):
         result = hazclassical(sources, tileget(sitecol), cmaker)
         if cmaker.disagg_by_src:
             # do not remove zeros, otherwise AELO for JPN will break
@@ -189,7 +194,14 @@ def classical(sources, tilegetters, cmaker, dstore, monitor):
         elif rmap.size_mb:
             result['rmap'] = rmap
             result['rmap'].gid = cmaker.gid
+        npieces = stealer.pieces(t, len(tilegetters) - t)
         yield result
+        if npieces:  # give the remaining tiles to the idle cores
+            rest = numpy.arange(t, len(tilegetters))
+            for idxs in numpy.array_split(rest, npieces):
+                tgetters = [tilegetters[i] for i in idxs]
+                yield classical, srcs_arg, tgetters, cmaker, dstore
+            break
 
 
 def tiling(tilegetter, cmaker, dstore, monitor):
@@ -205,9 +217,10 @@ def tiling(tilegetter, cmaker, dstore, monitor):
     rmap = result.pop('rmap').remove_zeros()
     if config.directory.custom_tmp:
         rates = rmap.to_array(cmaker.gid)
-        _store(rates, cmaker.num_chunks, None, monitor)
+        result['fname'] = _store(rates, cmaker.num_chunks, None, monitor)
     else:
         result['rmap'] = rmap.to_array(cmaker.gid)
+    result['tileno'] = tilegetter.tileno
     return result
 
 
@@ -280,6 +293,7 @@ def postclassical(pgetter, wget, hstats, individual_rlzs,
     compute_mon = monitor('compute stats', measuremem=False)
     hmaps_mon = monitor('make_hmaps', measuremem=False)
     sidx = MapArray(sids, 1, 1).fill(0).sidx
+    statfuncs = list(hstats.values())
     for sid in sids:
         idx = sidx[sid]
         with combine_mon:
@@ -295,12 +309,14 @@ def postclassical(pgetter, wget, hstats, individual_rlzs,
                     pmap_by_kind['hcurves-rlzs'][r].array[idx] = (
                         pc[:, r].reshape(M, L1))
             if hstats:
-                for s, (statname, stat) in enumerate(hstats.items()):
-                    sc = getters.build_stat_curve(
-                        pc, imtls, stat, pgetter.weights, wget,
-                        pgetter.use_rates)
-                    arr = sc.reshape(M, L1)
-                    pmap_by_kind['hcurves-stats'][s].array[idx] = arr
+                # all the statistics are computed together, with a single
+                # sort of the realizations for the quantiles
+                scs = getters.build_stat_curves(
+                    pc, imtls, statfuncs, pgetter.weights, wget,
+                    pgetter.use_rates)
+                for s in range(S):
+                    pmap_by_kind['hcurves-stats'][s].array[idx] = (
+                        scs[:, s].reshape(M, L1))
 
     if poes and (R == 1 or individual_rlzs):
         with hmaps_mon:
@@ -378,6 +394,59 @@ class Hazard:
         return mean_rates_by_src
 
 
+class TilingPipeline:
+    """
+    Helper class submitting the postclassical task for a chunk of sites
+    as soon as all the tiling tasks affecting the chunk are done, so that
+    the two phases overlap.
+
+    :param smap: the Starmap running the tiling tasks
+    :param allargs: the arguments (tilegetter, cmaker, dstore) of the tasks
+    :param sids: the site IDs of the complete site collection
+    :param pgetters: a list of MapGetters, one per chunk
+    :param mktask: a function getter -> (task_func, args)
+    """
+    def __init__(self, smap, allargs, sids, pgetters, mktask):
+        self.smap = smap
+        self.pgetters = pgetters
+        self.mktask = mktask
+        C = len(pgetters)
+        self.todo = numpy.zeros(C, int)  # number of tiling tasks per chunk
+        self.chunks = {}  # (grp_id, tileno) -> chunk indices
+        self.fnames = [[] for _ in range(C)]  # scratch files per chunk
+        by_tile = {}  # ntiles -> list of chunk indices per tile
+        for tgetter, cmaker, _ds in allargs:
+            T = int(tgetter.ntiles)
+            if T not in by_tile:
+                keys = numpy.unique(sids % T * C + sids % C)
+                cuts = numpy.searchsorted(keys // C, numpy.arange(1, T))
+                by_tile[T] = numpy.split(keys % C, cuts)
+            chunks = by_tile[T][tgetter.tileno]
+            self.chunks[cmaker.grp_id, tgetter.tileno] = chunks
+            self.todo[chunks] += 1
+        self.submitted = 0
+
+    def task_done(self, grp_id, tileno, fname=None):
+        """
+        Register the end of a tiling task and submit the postclassical
+        tasks for the chunks which are now complete
+        """
+        chunks = self.chunks[grp_id, tileno]
+        self.todo[chunks] -= 1
+        if fname:
+            for c in chunks:
+                self.fnames[c].append(fname)
+        for c in chunks[self.todo[chunks] == 0]:
+            getter = self.pgetters[c]
+            getter.filenames = getter.filenames[:1] + self.fnames[c]
+            func, args = self.mktask(getter)
+            if self.smap.task_queue:  # run before the queued tiling tasks
+                self.smap.task_queue.insert(0, (func, args))
+            else:
+                self.smap.submit(args, func)
+            self.submitted += 1
+
+
 @base.calculators.add('classical', 'ucerf_classical')
 class ClassicalCalculator(base.HazardCalculator):
     """
@@ -387,6 +456,7 @@ class ClassicalCalculator(base.HazardCalculator):
     precalc = 'preclassical'
     accept_precalc = ['preclassical', 'classical']
     SLOW_TASK_ERROR = False
+    pipeline = None  # TilingPipeline instance, set in pipelined tiling
 
     def agg_dicts(self, acc, dic):
         """
@@ -400,6 +470,11 @@ class ClassicalCalculator(base.HazardCalculator):
         if dic is None:
             raise MemoryError('You ran out of memory!')
 
+        if 'grp_id' not in dic:
+            # postclassical output coming from the tiling pipeline
+            self.collect_hazard(acc, dic)
+            return acc
+
         grp_id = dic.pop('grp_id')
         sdata = dic.pop('source_data', None)
         if sdata is not None:
@@ -427,6 +502,10 @@ class ClassicalCalculator(base.HazardCalculator):
         else:
             # aggregating rates is ultra-fast compared to storing
             self.rmap += rmap
+        if self.pipeline and 'tileno' in dic:
+            self.datastore.hdf5.flush()  # make the rates visible to readers
+            self.pipeline.task_done(
+                grp_id, dic.pop('tileno'), dic.pop('fname', None))
         return acc
 
     def create_rup(self):
@@ -548,6 +627,13 @@ class ClassicalCalculator(base.HazardCalculator):
                                    ' included in the hazard model')
         else:
             logging.info('cfactor = {:_d}'.format(int(self.cfactor[0])))
+        if oq.cache_distances and oq.cachedir:
+            maxsize = float(config.directory.ctxs_cache_max_gb) * 1024**3
+            n = purge_ctxs_cache(os.path.join(oq.cachedir, CTXS_CACHE),
+                                 maxsize)
+            if n:
+                logging.info('Removed %d old files from the contexts cache',
+                             n)
         self.store_info()
         self.build_curves_maps()
         return True
@@ -614,9 +700,24 @@ class ClassicalCalculator(base.HazardCalculator):
                         len(allargs), min(n_out), max(n_out))
 
         t0 = time.time()
+        pipelined = config.distribution.get('pipelined_tiling', True)
+        if pipelined:
+            # the hcurves/hmaps datasets must be created before swmr_on
+            self.individual = self._create_hcurves_maps()[-1]
+            self.hazard = {}  # kind -> array
         self.datastore.swmr_on()  # must come before the Starmap
         smap = parallel.Starmap(tiling, allargs, h5=self.datastore.hdf5)
+        if pipelined:
+            pgetters = getters.map_getters(self.datastore, self.full_lt)
+            self.pipeline = TilingPipeline(
+                smap, allargs, self.sitecol.complete.sids, pgetters,
+                lambda getter: self._postclassical_task(
+                    getter, self.individual))
         smap.reduce(self.agg_dicts, AccumDict(accum=0.))
+        if pipelined:
+            assert not self.pipeline.todo.any(), self.pipeline.todo
+            logging.info('Computed the statistics for %d chunks during the '
+                         'tiling phase', self.pipeline.submitted)
 
         fraction = os.environ.get('OQ_SAMPLE_SOURCES')
         if fraction:
@@ -767,25 +868,48 @@ class ClassicalCalculator(base.HazardCalculator):
                     imt=list(oq.imtls), poe=oq.poes)
         return N, S, M, P, L1, individual_rlzs
 
+    def _postclassical_task(self, getter, individual):
+        # returns the postprocessing task for the given MapGetter
+        oq = self.oqparam
+        if oq.fastmean:
+            return fast_mean, (getter,)
+        return postclassical, (getter, self.full_lt.wget, oq.hazard_stats(),
+                               individual, oq.max_sites_disagg,
+                               self.amplifier)
+
     # called by execute before post_execute
     def build_curves_maps(self):
         """
         Compute and store hcurves-rlzs, hcurves-stats, hmaps-rlzs, hmaps-stats
         """
         oq = self.oqparam
-        hstats = oq.hazard_stats()
+        if self.pipeline is None and not self._run_postclassical():
+            return
+        for kind in sorted(self.hazard):
+            logging.info('Saving %s', kind)  # very fast
+            self.datastore[kind][:] = self.hazard.pop(kind)
+
+        if 'hmaps-stats' in self.datastore and not oq.tile_spec:
+            self.plot_hmaps()
+
+            # check numerical stability of the hmaps around the poes
+            if self.N <= oq.max_sites_disagg and not self.amplifier:
+                mean_hcurves = self.datastore.sel('hcurves-stats', stat='mean')[:, 0]
+                check_hmaps(mean_hcurves, oq.imtls, oq.poes)
+
+    def _run_postclassical(self):
+        # run the postclassical tasks and populate the .hazard dictionary
+        oq = self.oqparam
         N, S, M, P, L1, individual = self._create_hcurves_maps()
         if '_rates' in set(self.datastore) or not self.datastore.parent:
             dstore = self.datastore
         else:
             dstore = self.datastore.parent
-        wget = self.full_lt.wget
-        allargs = [(getter, wget, hstats, individual, oq.max_sites_disagg,
-                    self.amplifier) for getter in getters.map_getters(
-                        dstore, self.full_lt)]
-        if not config.directory.custom_tmp and not allargs:  # case_60
+        tasks = [self._postclassical_task(getter, individual)
+                 for getter in getters.map_getters(dstore, self.full_lt)]
+        if not config.directory.custom_tmp and not tasks:  # case_60
             logging.warning('No rates were generated')
-            return
+            return False
         self.hazard = {}  # kind -> array
         hcbytes = 8 * N * S * M * L1
         hmbytes = 8 * N * S * M * P if oq.poes else 0
@@ -797,29 +921,13 @@ class ClassicalCalculator(base.HazardCalculator):
             pass  # avoid an HDF5 error
         else:  # in all the other cases
             self.datastore.swmr_on()
-        if oq.fastmean:
-            parallel.Starmap(
-                fast_mean, [args[0:1] for args in allargs],
-                distribute='no' if self.few_sites else None,
-                h5=self.datastore.hdf5,
-            ).reduce(self.collect_hazard)
-        else:
-            parallel.Starmap(
-                postclassical, allargs,
-                distribute='no' if self.few_sites else None,
-                h5=self.datastore.hdf5,
-            ).reduce(self.collect_hazard)
-        for kind in sorted(self.hazard):
-            logging.info('Saving %s', kind)  # very fast
-            self.datastore[kind][:] = self.hazard.pop(kind)
-
-        if 'hmaps-stats' in self.datastore and not oq.tile_spec:
-            self.plot_hmaps()
-
-            # check numerical stability of the hmaps around the poes
-            if self.N <= oq.max_sites_disagg and not self.amplifier:
-                mean_hcurves = self.datastore.sel('hcurves-stats', stat='mean')[:, 0]
-                check_hmaps(mean_hcurves, oq.imtls, oq.poes)
+        parallel.Starmap(
+            fast_mean if oq.fastmean else postclassical,
+            [args for _func, args in tasks],
+            distribute='no' if self.few_sites else None,
+            h5=self.datastore.hdf5,
+        ).reduce(self.collect_hazard)
+        return True
 
     def plot_hmaps(self):
         """
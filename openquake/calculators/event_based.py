@@ -28,12 +28,13 @@ from openquake.baselib import config, hdf5, parallel, python3compat
 from openquake.baselib.general import AccumDict, humansize, block_splitter
 from openquake.hazardlib.geo.packager import fiona
 from openquake.hazardlib.map_array import MapArray, get_mean_curve
-from openquake.hazardlib.stats import geom_avg_std, compute_stats
+from openquake.hazardlib.stats import (
+    geom_avg_std, compute_stats, calc_momenta_by, calc_avg_std)
 from openquake.hazardlib.calc.stochastic import sample_ruptures
 from openquake.hazardlib.contexts import ContextMaker, FarAwayRupture
 from openquake.hazardlib.calc.filters import (
     magstr, nofilter, getdefault, get_distances, SourceFilter)
-from openquake.hazardlib.calc.gmf import GmfComputer
+from openquake.hazardlib.calc.gmf import GmfComputer, set_mean_stds
 from openquake.hazardlib.calc.conditioned_gmfs import ConditionedGmfComputer
 from openquake.hazardlib import logictree, InvalidFile
 from openquake.hazardlib.calc.stochastic import get_rup_array, rupture_dt
@@ -42,7 +43,8 @@ from openquake.hazardlib.source.rupture import (
 from openquake.commonlib import util, logs, readinput, datastore
 from openquake.commonlib.calc import (
     gmvs_to_poes, make_hmaps, slice_dt, build_slice_by_event, RuptureImporter,
-    SLICE_BY_EVENT_NSITES, get_close_mosaic_models, get_proxies)
+    SLICE_BY_EVENT_NSITES, get_close_mosaic_models, get_proxies,
+    save_gmf_by_site, round_gmvs)
 from openquake.risklib.riskinput import str2rsi, rsi2str
 from openquake.calculators import base, views
 from openquake.calculators.getters import sig_eps_dt
@@ -60,6 +62,7 @@ F32 = numpy.float32
 F64 = numpy.float64
 TWO24 = 2 ** 24
 TWO32 = numpy.float64(2 ** 32)
+BATCH_NSITES = 10_000  # max number of sites for set_mean_stds
 rup_dt = numpy.dtype(
     [('rup_id', I64), ('rrup', F32), ('time', F32), ('task_no', U16)])
 
@@ -196,15 +199,26 @@ def get_computer(cmaker, proxy, srcfilter, station_data, station_sitecol):
         oq._amplifier, oq._sec_perils)
 
 
-def _event_based(proxies, cmaker, stations, srcfilter, shr,
-                 fmon, cmon, umon, mmon):
-    oq = cmaker.oq
-    alldata = []
-    sig_eps = []
-    times = []
-    max_iml = oq.get_max_iml()
-    se_dt = sig_eps_dt(oq.imtls)
-    mea_tau_phi = []
+def _batched(batch, mmon):
+    # compute the mean and stddevs for a batch of regular GmfComputers,
+    # spreading the time spent among the ruptures proportionally to N
+    t0 = time.time()
+    set_mean_stds([computer for _, computer, _ in batch], mmon)
+    dt = time.time() - t0
+    tot = sum(computer.N for _, computer, _ in batch)
+    for proxy, computer, dt0 in batch:
+        yield proxy, computer, dt0 + dt * computer.N / tot
+
+
+def gen_computers(proxies, cmaker, stations, srcfilter, fmon, mmon):
+    """
+    Yield triples (proxy, computer, dt) for the ruptures close to the
+    sites; for regular GMFs the mean and stddevs are computed in batches
+    of ruptures affecting up to BATCH_NSITES sites
+    """
+    conditioned = stations and stations[0] is not None
+    batch = []
+    nsites = 0
     for proxy in proxies:
         t0 = time.time()
         with fmon:
@@ -215,6 +229,32 @@ def _event_based(proxies, cmaker, stations, srcfilter, shr,
             except FarAwayRupture:
                 # skip this rupture
                 continue
+        dt = time.time() - t0
+        if conditioned:
+            yield proxy, computer, dt
+            continue
+        batch.append((proxy, computer, dt))
+        nsites += computer.N
+        if nsites >= BATCH_NSITES:
+            yield from _batched(batch, mmon)
+            batch = []
+            nsites = 0
+    if batch:
+        yield from _batched(batch, mmon)
+
+
+def _event_based(proxies, cmaker, stations, srcfilter, shr,
+                 fmon, cmon, umon, mmon):
+    oq = cmaker.oq
+    alldata = []
+    sig_eps = []
+    times = []
+    max_iml = oq.get_max_iml()
+    se_dt = sig_eps_dt(oq.imtls)
+    mea_tau_phi = []
+    for proxy, computer, dt in gen_computers(
+            proxies, cmaker, stations, srcfilter, fmon, mmon):
+        t0 = time.time()
         if stations and stations[0] is not None:  # conditioned GMFs
             assert cmaker.scenario
             with shr['mea'] as mea, shr['tau'] as tau, shr['phi'] as phi:
@@ -226,7 +266,7 @@ def _event_based(proxies, cmaker, stations, srcfilter, shr,
                 mtp = numpy.array(computer.mea_tau_phi, GmfComputer.mtp_dt)
                 mea_tau_phi.append(mtp)
         sig_eps.append(computer.build_sig_eps(se_dt))
-        dt = time.time() - t0
+        dt += time.time() - t0
         times.append((proxy['id'], computer.ctx.rrup.min(), dt))
         alldata.append(df)
     times = numpy.array([tup + (fmon.task_no,) for tup in times], rup_dt)
@@ -482,6 +522,58 @@ def compute_avg_gmf(gmf_df, weights, min_iml):
     return dic
 
 
+class AvgGmf(object):
+    """
+    Accumulate the weighted sums of the logarithms of the GMVs and of their
+    squares for each site, so that avg_gmf can be computed as the GMF blocks
+    arrive without keeping the GMFs in memory. As in `compute_avg_gmf` the
+    missing GMVs are replaced with `min_iml`.
+
+    :param weights: E weights associated to the events
+    :param N: total number of sites
+    :param min_iml: array of M minimum intensities
+    """
+    def __init__(self, weights, N, min_iml):
+        # double precision, since the variance is a difference of momenta
+        # and the rounding errors on the total weight would be amplified
+        self.weights = numpy.asarray(weights, F64)
+        self.min_iml = min_iml
+        self.momenta = numpy.zeros((3, N, len(min_iml)))
+        self.counts = numpy.zeros(N, int)
+        self.seen = numpy.zeros(len(weights), bool)
+
+    def add(self, sids, eids, gmvs):
+        """
+        :param sids: array of site IDs
+        :param eids: array of event IDs
+        :param gmvs: array of shape (len(sids), M)
+        """
+        N = len(self.counts)
+        self.momenta += calc_momenta_by(
+            sids, numpy.log(numpy.asarray(gmvs, F64)), self.weights[eids], N)
+        self.counts += numpy.bincount(sids, minlength=N)
+        self.seen[eids] = True
+
+    def get(self):
+        """
+        :returns: an array of shape (2, N, M) with geometric average and
+                  geometric stddev of the GMVs, zero for sites without GMVs
+        """
+        ok = self.counts > 0
+        momenta = self.momenta[:, ok]
+        missing = self.counts[ok] < len(self.weights)
+        # the events without GMVs at the site count as min_iml
+        totw = self.weights.sum()
+        logmin = numpy.log(self.min_iml)
+        mw = totw - momenta[0, missing]
+        momenta[1, missing] += mw * logmin
+        momenta[2, missing] += mw * logmin ** 2
+        momenta[0] = totw
+        avg_gmf = numpy.zeros((2,) + self.momenta.shape[1:], F32)
+        avg_gmf[:, ok] = numpy.exp(calc_avg_std(momenta))
+        return avg_gmf
+
+
 def read_gsim_lt(oq):
     # in aristotle mode the gsim_lt is read from the exposure.hdf5 file
     if oq.aristotle:
@@ -663,9 +755,11 @@ class EventBasedCalculator(base.HazardCalculator):
                     hdf5.extend(self.datastore['gmf_data/slice_by_event'], sbe)
                 hdf5.extend(dset, df.sid.to_numpy())
                 hdf5.extend(self.datastore['gmf_data/eid'], df.eid.to_numpy())
-                for m in range(len(primary)):
-                    hdf5.extend(self.datastore[f'gmf_data/gmv_{m}'],
-                                df[f'gmv_{m}'])
+                prec = self.oqparam.gmf_precision
+                gmvs = [round_gmvs(df[f'gmv_{m}'].to_numpy(), prec)
+                        for m in range(len(primary))]
+                for m, gmv in enumerate(gmvs):
+                    hdf5.extend(self.datastore[f'gmf_data/gmv_{m}'], gmv)
                 for sec_imt in sec_imts:
                     hdf5.extend(self.datastore[f'gmf_data/{sec_imt}'],
                                 df[sec_imt])
@@ -678,6 +772,16 @@ class EventBasedCalculator(base.HazardCalculator):
             if mtp:
                 for col, arr in mtp.items():
                     hdf5.extend(self.datastore[f'mea_tau_phi/{col}'], arr)
+
+        if len(gmfdata):
+            with self.monitor('updating avg_gmf'):
+                if self.avg_gmf is None:
+                    rlzs = self.datastore['events']['rlz_id']
+                    self.avg_gmf = AvgGmf(
+                        self.datastore['weights'][:][rlzs],
+                        len(self.sitecol.complete), self.oqparam.min_iml)
+                self.avg_gmf.add(df.sid.to_numpy(), df.eid.to_numpy(),
+                                 numpy.array(gmvs).T)
         return acc
 
     def _read_scenario_ruptures(self):
@@ -755,6 +859,7 @@ class EventBasedCalculator(base.HazardCalculator):
         else:
             logging.info('min_iml=%s', oq.min_iml)
         self.offset = 0
+        self.avg_gmf = None
         if oq.hazard_calculation_id:  # from ruptures
             dstore.parent = datastore.read(oq.hazard_calculation_id)
             self.full_lt = dstore.parent['full_lt'].init()
@@ -800,6 +905,10 @@ class EventBasedCalculator(base.HazardCalculator):
         acc = smap.reduce(self.agg_dicts)
         if 'gmf_data' not in dstore:
             return acc
+        if oq.ground_motion_fields and oq.gmf_by_site:
+            with self.monitor('saving gmf_by_site', measuremem=True):
+                save_gmf_by_site(dstore, oq.gmf_data_dt().names[1:],
+                                 len(self.sitecol.complete))
         if oq.ground_motion_fields:
             with self.monitor('saving avg_gmf', measuremem=True):
                 self.save_avg_gmf()
@@ -818,28 +927,17 @@ class EventBasedCalculator(base.HazardCalculator):
                 ' not computing avg_gmf')
             return
 
-        rlzs = self.datastore['events'][:]['rlz_id']
-        self.weights = self.datastore['weights'][:][rlzs]
-        gmf_df = self.datastore.read_df('gmf_data', 'sid')
-        for sec_imt in self.oqparam.sec_imts:  # ignore secondary perils
-            del gmf_df[sec_imt]
-        rel_events = gmf_df.eid.unique()
-        e = len(rel_events)
-        if e == 0:
+        # the avg_gmf has been accumulated in agg_dicts
+        if self.avg_gmf is None:
             raise RuntimeError(
                 'No GMFs were generated, perhaps they were '
                 'all below the minimum_intensity threshold')
-        elif e < len(self.datastore['events']):
+        rel_events = U32(numpy.where(self.avg_gmf.seen)[0])
+        e = len(rel_events)
+        if e < len(self.datastore['events']):
             self.datastore['relevant_events'] = rel_events
             logging.info('Stored {:_d} relevant event IDs'.format(e))
-
-        # really compute and store the avg_gmf
-        M = len(self.oqparam.min_iml)
-        avg_gmf = numpy.zeros((2, len(self.sitecol.complete), M), F32)
-        for sid, avgstd in compute_avg_gmf(
-                gmf_df, self.weights, self.oqparam.min_iml).items():
-            avg_gmf[:, sid] = avgstd
-        self.datastore['avg_gmf'] = avg_gmf
+        self.datastore['avg_gmf'] = self.avg_gmf.get()
         # make avg_gmf plots only if running via the webui
         if os.environ.get('OQ_APPLICATION_MODE') == 'ARISTOTLE':
             imts = list(self.oqparam.imtls)
@@ -34,6 +34,7 @@ from openquake.calculators.export import DISPLAY_NAME
 U8 = numpy.uint8
 U16 = numpy.uint16
 U32 = numpy.uint32
+U64 = numpy.uint64
 F32 = numpy.float32
 
 
@@ -58,7 +59,9 @@ def damage_from_gmfs(gmfslices, oqparam, dstore, monitor):
     if dstore.parent:
         dstore.parent.open('r')
     dfs = []
-    with dstore, monitor('reading data', measuremem=True):
+    # limit the number of tasks reading gmf_data at the same time
+    with calc.gmf_read_token(monitor), dstore, monitor(
+            'reading data', measuremem=True):
         for gmfslice in gmfslices:
             slc = slice(gmfslice[0], gmfslice[1])
             dfs.append(dstore.read_df('gmf_data', slc=slc))
@@ -96,8 +99,9 @@ def event_based_damage(df, oq, dstore, monitor):
         eids = gmf_df.eid.to_numpy()
         E = len(eids)
         if not oq.float_dmg_dist:
-            rng = scientific.MultiEventRNG(
-                oq.master_seed, numpy.unique(eids))
+            RNG = (scientific.VectorizedRNG if oq.vectorized_rng
+                   else scientific.MultiEventRNG)
+            rng = RNG(oq.master_seed, numpy.unique(eids))
         else:
             rng = None
         for taxo, adf in asset_df.groupby('taxonomy'):
@@ -208,6 +212,9 @@ class DamageCalculator(EventBasedRiskCalculator):
             for name in df.columns:
                 dset = self.datastore['risk_by_event/' + name]
                 hdf5.extend(dset, df[name].to_numpy())
+            self.rbe_counts += numpy.bincount(
+                df.agg_id.to_numpy(),
+                minlength=len(self.rbe_counts)).astype(U64)
         return 1
 
     def post_execute(self, dummy):
@@ -215,6 +222,7 @@ class DamageCalculator(EventBasedRiskCalculator):
         Store damages-rlzs/stats, aggrisk and aggcurves
         """
         oq = self.oqparam
+        self.datastore['rbe_counts'] = self.rbe_counts
         # no damage check, perhaps the sites where disjoint from gmf_data
         if self.dmgcsq[:, :, :, :, 1:].sum() == 0:
             haz_sids = self.datastore['gmf_data/sid'][:]
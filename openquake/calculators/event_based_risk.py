@@ -16,7 +16,6 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
-import time
 import os.path
 import logging
 import operator
@@ -27,9 +26,10 @@ from scipy import sparse
 
 from openquake.baselib import hdf5, performance, general, python3compat, config
 from openquake.hazardlib import stats, InvalidFile
+from openquake.commonlib import calc
 from openquake.commonlib.calc import starmap_from_gmfs, compactify3
 from openquake.risklib.scientific import (
-    total_losses, insurance_losses, MultiEventRNG, LOSSID)
+    total_losses, insurance_losses, MultiEventRNG, VectorizedRNG, LOSSID)
 from openquake.calculators import base, event_based
 from openquake.calculators.post_risk import (
     PostRiskCalculator, post_aggregate, fix_dtypes, fix_investigation_time)
@@ -42,6 +42,7 @@ F32 = numpy.float32
 F64 = numpy.float64
 TWO16 = 2 ** 16
 TWO32 = U64(2 ** 32)
+MAX_ROWS = 1_000_000  # compact the event loss accumulator beyond this
 get_n_occ = operator.itemgetter(1)
 
 
@@ -51,13 +52,56 @@ def fast_agg(keys, values, correl, li, acc):
     :param values: an array of (N, D) floats
     :param correl: True if there is asset correlation
     :param li: loss type index
-    :param acc: dictionary unique key -> array(L, D)
+    :param acc: list of L lists of pairs (keys, values)
     """
     ukeys, avalues = general.fast_agg2(keys, values)
     if correl:  # restore the variances
         avalues[:, 0] = avalues[:, 0] ** 2
-    for ukey, avalue in zip(ukeys, avalues):
-        acc[ukey][li] += avalue
+    acc[li].append((ukeys, avalues))
+    if sum(len(k) for k, v in acc[li]) > MAX_ROWS:
+        acc[li][:] = [compact(acc[li])]
+
+
+def compact(pairs):
+    """
+    :param pairs: a list of pairs (keys, values)
+    :returns: a single pair (unique keys, summed values)
+    """
+    if len(pairs) == 1:
+        return pairs[0]
+    keys = numpy.concatenate([k for k, v in pairs])
+    values = numpy.concatenate([v for k, v in pairs])
+    return general.fast_agg2(keys, values)
+
+
+def build_event_loss_table(acc, xtypes):
+    """
+    :param acc: list of L lists of pairs (keys, values), one per loss type
+    :param xtypes: L loss type names
+    :returns: a dictionary event_id, agg_id, loss_id, variance, loss
+    """
+    eids, kids, lids, values = [], [], [], []
+    for li, pairs in enumerate(acc):
+        if not pairs:
+            continue
+        ukeys, avalues = compact(pairs)
+        ok = avalues.any(axis=1)
+        ukeys = ukeys[ok]
+        eids.append(ukeys // TWO32)
+        kids.append(ukeys % TWO32)
+        lids.append(numpy.full(len(ukeys), LOSSID[xtypes[li]]))
+        values.append(avalues[ok])
+    if not eids:
+        return {col: [] for col in
+                ['event_id', 'agg_id', 'loss_id', 'variance', 'loss']}
+    eids = numpy.concatenate(eids)
+    kids = numpy.concatenate(kids)
+    lids = numpy.concatenate(lids)
+    values = numpy.concatenate(values)
+    order = numpy.lexsort((lids, kids, eids))
+    return dict(event_id=eids[order], agg_id=kids[order],
+                loss_id=lids[order], variance=values[order, 0],
+                loss=values[order, 1])
 
 
 def average_losses(ln, alt, rlz_id, AR, collect_rlzs):
@@ -105,7 +149,7 @@ def aggreg(outputs, crmodel, ARK, aggids, rlz_id, ideduc, monitor):
     loss_by_AR = {ln: [] for ln in xtypes}
     correl = int(oq.asset_correlation)
     (A, R, K), L = ARK, len(xtypes)
-    acc = general.AccumDict(accum=numpy.zeros((L, 2)))  # u8idx->array
+    acc = [[] for _ in range(L)]  # pairs (keys, values) by loss type
     value_cols = ['variance', 'loss']
     for out in outputs:
         for li, ln in enumerate(xtypes):
@@ -129,18 +173,8 @@ def aggreg(outputs, crmodel, ARK, aggids, rlz_id, ideduc, monitor):
                     aids = alt.aid.to_numpy()
                     for kids in aggids[:, aids]:
                         fast_agg(eids + U64(kids), values, correl, li, acc)
-    lis = range(len(xtypes))
     with monitor('building event loss table', measuremem=True):
-        dic = general.AccumDict(accum=[])
-        for ukey, arr in acc.items():
-            eid, kid = divmod(ukey, TWO32)
-            for li in lis:
-                if arr[li].any():
-                    dic['event_id'].append(eid)
-                    dic['agg_id'].append(kid)
-                    dic['loss_id'].append(LOSSID[xtypes[li]])
-                    for c, col in enumerate(['variance', 'loss']):
-                        dic[col].append(arr[li, c])
+        dic = build_event_loss_table(acc, xtypes)
         fix_dtypes(dic)
     return loss_by_AR, pandas.DataFrame(dic)
 
@@ -156,19 +190,16 @@ def ebr_from_gmfs(sbe, oqparam, dstore, monitor):
     if dstore.parent:
         dstore.parent.open('r')
     gmfcols = oqparam.gmf_data_dt().names
-    with dstore:
-        # this is fast compared to reading the GMFs
-        risk_sids = monitor.read('sids')
-        s0, s1 = sbe[0]['start'], sbe[-1]['stop']
-        t0 = time.time()
+    # this is fast compared to reading the GMFs
+    risk_sids = monitor.read('sids')
+    s0, s1 = sbe[0]['start'], sbe[-1]['stop']
+    # limit the number of tasks reading gmf_data at the same time
+    with calc.gmf_read_token(monitor), dstore, monitor(
+            'reading GMFs', measuremem=True):
         haz_sids = dstore['gmf_data/sid'][s0:s1]
-    dt = time.time() - t0
-    idx, = numpy.where(numpy.isin(haz_sids, risk_sids))
-    if len(idx) == 0:
-        return {}
-    # print('waiting %.1f' % dt)
-    time.sleep(dt)
-    with dstore, monitor('reading GMFs', measuremem=True):
+        idx, = numpy.where(numpy.isin(haz_sids, risk_sids))
+        if len(idx) == 0:
+            return {}
         start, stop = idx.min(), idx.max() + 1
         dic = {}
         for col in gmfcols:
@@ -179,6 +210,34 @@ def ebr_from_gmfs(sbe, oqparam, dstore, monitor):
                 dic[col] = dset[s0+start:s0+stop][idx - start]
     df = pandas.DataFrame(dic)
     del dic
+    yield from _gen_risk(df, oqparam, monitor)
+
+
+def ebr_from_site_gmfs(events, oqparam, dstore, monitor):
+    """
+    :param events: composite array with fields 'eid', 'weight'
+    :param oqparam: OqParam instance
+    :param dstore: DataStore instance from which to read gmf_by_site
+    :param monitor: a Monitor instance
+    :yields: dictionary of arrays, the output of event_based_risk
+    """
+    if dstore.parent:
+        dstore.parent.open('r')
+    gmfcols = oqparam.gmf_data_dt().names
+    risk_sids = monitor.read('sids')
+    # the events are consecutive, so it is enough to read a range of eids
+    eid0, eid1 = events[0]['eid'], events[-1]['eid'] + 1
+    with calc.gmf_read_token(monitor), dstore, monitor(
+            'reading GMFs', measuremem=True):
+        dic = calc.read_gmf_by_site(dstore, risk_sids, eid0, eid1, gmfcols)
+    if not dic:
+        return {}
+    df = pandas.DataFrame(dic)
+    del dic
+    yield from _gen_risk(df, oqparam, monitor)
+
+
+def _gen_risk(df, oqparam, monitor):
     # if max_gmvs_chunk is too small, there is a huge data transfer in
     # avg_losses and the calculation may hang; if too large, run out of memory
     slices = performance.split_slices(
@@ -207,8 +266,9 @@ def event_based_risk(df, oqparam, monitor):
     if oqparam.ignore_master_seed or oqparam.ignore_covs:
         rng = None
     else:
-        rng = MultiEventRNG(oqparam.master_seed, df.eid.unique(),
-                            int(oqparam.asset_correlation))
+        RNG = VectorizedRNG if oqparam.vectorized_rng else MultiEventRNG
+        rng = RNG(oqparam.master_seed, df.eid.unique(),
+                  int(oqparam.asset_correlation))
 
     outs = gen_outputs(df, crmodel, rng, monitor)
     avg, alt = aggreg(outs, crmodel, ARK, aggids, rlz_id, ideduc.any(),
@@ -401,6 +461,8 @@ class EventBasedRiskCalculator(event_based.EventBasedCalculator):
             logging.warning('The calculation is really big; consider setting '
                             'minimum_asset_loss')
         base.create_risk_by_event(self)
+        # number of rows of risk_by_event per agg_id, used in post_risk
+        self.rbe_counts = numpy.zeros(oq.K + 1, U64)
         self.rlzs = self.datastore['events']['rlz_id']
         self.num_events = numpy.bincount(self.rlzs, minlength=self.R)
         self.xtypes = oq.ext_loss_types
@@ -465,8 +527,12 @@ class EventBasedRiskCalculator(event_based.EventBasedCalculator):
             logging.info(
                 'Produced %s of GMFs', general.humansize(self.gmf_bytes))
         else:  # start from GMFs
-            smap = starmap_from_gmfs(ebr_from_gmfs, oq, self.datastore,
-                                     self._monitor)
+            if calc.use_gmf_by_site(self.datastore, self.sitecol.sids):
+                smap = calc.starmap_from_gmfs_by_site(
+                    ebr_from_site_gmfs, oq, self.datastore, self._monitor)
+            else:
+                smap = starmap_from_gmfs(ebr_from_gmfs, oq, self.datastore,
+                                         self._monitor)
             self.save_tmp(smap.monitor)
             smap.reduce(self.agg_dicts)
 
@@ -499,6 +565,9 @@ class EventBasedRiskCalculator(event_based.EventBasedCalculator):
                 for name in alt.columns:
                     dset = self.datastore['risk_by_event/' + name]
                     hdf5.extend(dset, alt[name].to_numpy())
+                self.rbe_counts += numpy.bincount(
+                    alt.agg_id.to_numpy(),
+                    minlength=len(self.rbe_counts)).astype(U64)
         with self.monitor('saving avg_losses'):
             for ln, ls in dic.pop('avg').items():
                 for coo in ls:
@@ -510,6 +579,7 @@ class EventBasedRiskCalculator(event_based.EventBasedCalculator):
         and then loss curves and maps.
         """
         oq = self.oqparam
+        self.datastore['rbe_counts'] = self.rbe_counts
 
         K = self.datastore['risk_by_event'].attrs.get('K', 0)
         upper_limit = self.E * (K + 1) * len(self.xtypes)
@@ -22,6 +22,7 @@ import numpy
 
 from openquake.baselib import general, hdf5
 from openquake.hazardlib.map_array import MapArray
+from openquake.hazardlib.stats import compute_stats
 from openquake.hazardlib.calc.disagg import to_rates, to_probs
 from openquake.hazardlib.source.rupture import BaseRupture, get_ebr
 from openquake.commonlib.calc import get_proxies
@@ -37,6 +38,23 @@ weight = operator.itemgetter('n_occ')
 slice_dt = numpy.dtype([('idx', U32), ('start', int), ('stop', int)])
 
 
+def merge_slices(slices):
+    """
+    :param slices: an array of dtype slice_dt
+    :returns: a list of (start, stop) pairs with adjacent slices merged
+
+    >>> merge_slices(numpy.array([(0, 0, 5), (0, 5, 7), (0, 9, 10)], slice_dt))
+    [(0, 7), (9, 10)]
+    """
+    out = []
+    for start, stop in zip(slices['start'], slices['stop']):
+        if out and out[-1][1] == start:
+            out[-1] = (out[-1][0], int(stop))
+        else:
+            out.append((int(start), int(stop)))
+    return out
+
+
 class NotFound(Exception):
     pass
 
@@ -45,10 +63,20 @@ def build_stat_curve(hcurve, imtls, stat, weights, wget, use_rates=False):
     """
     Build statistics by taking into account IMT-dependent weights
     """
+    return build_stat_curves(hcurve, imtls, [stat], weights, wget, use_rates)
+
+
+def build_stat_curves(hcurve, imtls, stats, weights, wget, use_rates=False):
+    """
+    Build S statistics at once by taking into account IMT-dependent weights;
+    the quantiles are computed by sorting the realizations only once.
+
+    :returns: an array of shape (L, S)
+    """
     poes = hcurve.T  # shape R, L
     assert len(poes) == len(weights), (len(poes), len(weights))
     L = imtls.size
-    array = numpy.zeros((L, 1))
+    array = numpy.zeros((L, len(stats)))
     
     if weights.shape[1] > 1:  # IMT-dependent weights
         # this is slower since the arrays are shorter
@@ -58,14 +86,16 @@ def build_stat_curve(hcurve, imtls, stat, weights, wget, use_rates=False):
             if not ws.sum():  # expect no data for this IMT
                 continue
             if use_rates:
-                array[slc, 0] = to_probs(stat(to_rates(poes[:, slc]), ws))
+                array[slc] = to_probs(
+                    compute_stats(to_rates(poes[:, slc]), stats, ws)).T
             else:
-                array[slc, 0] = stat(poes[:, slc], ws)
+                array[slc] = compute_stats(poes[:, slc], stats, ws).T
     else:
         if use_rates:
-            array[:, 0] = to_probs(stat(to_rates(poes), weights[:, -1]))
+            array[:] = to_probs(
+                compute_stats(to_rates(poes), stats, weights[:, -1])).T
         else:
-            array[:, 0] = stat(poes, weights[:, -1])
+            array[:] = compute_stats(poes, stats, weights[:, -1]).T
     return array
 
 
@@ -300,21 +330,23 @@ class MapGetter(object):
         """
         if self._map:
             return self._map
+        cols = {'sid': [], 'lid': [], 'gid': [], 'rate': []}
         for fname in self.filenames:
             with hdf5.File(fname) as dstore:
                 slices = dstore['_rates/slice_by_idx'][:]
                 slices = slices[slices['idx'] == self.idx]
-                for start, stop in zip(slices['start'], slices['stop']):
-                    rates_df = dstore.read_df('_rates', slc=slice(start, stop))
-                    # not using groupby to save memory
-                    for sid in rates_df.sid.unique():
-                        df = rates_df[rates_df.sid == sid]
-                        try:
-                            array = self._map[sid]
-                        except KeyError:
-                            array = numpy.zeros((self.L, self.G))
-                            self._map[sid] = array
-                        array[df.lid, df.gid] = df.rate
+                for start, stop in merge_slices(slices):
+                    for col, arrays in cols.items():
+                        arrays.append(dstore['_rates/' + col][start:stop])
+        if not cols['sid']:
+            return self._map
+        sids = numpy.concatenate(cols['sid'])
+        usids, inv = numpy.unique(sids, return_inverse=True)
+        # single scatter for all the sites in the chunk
+        array = numpy.zeros((len(usids), self.L, self.G))
+        array[inv, numpy.concatenate(cols['lid']),
+              numpy.concatenate(cols['gid'])] = numpy.concatenate(cols['rate'])
+        self._map = dict(zip(usids, array))
         return self._map
 
     def get_hcurve(self, sid):  # used in classical
@@ -23,8 +23,9 @@ import itertools
 import numpy
 import pandas
 
-from openquake.baselib import general, parallel, python3compat
+from openquake.baselib import config, general, hdf5, parallel, python3compat
 from openquake.commonlib import datastore, logs
+from openquake.hazardlib.stats import compute_stats
 from openquake.risklib import asset, scientific, reinsurance
 from openquake.calculators import base, views
 from openquake.calculators.base import expose_outputs
@@ -34,6 +35,7 @@ F32 = numpy.float32
 F64 = numpy.float64
 U16 = numpy.uint16
 U32 = numpy.uint32
+U64 = numpy.uint64
 
 
 class FakeBuilder:
@@ -57,6 +59,38 @@ def fix_investigation_time(oq, dstore):
     return R
 
 
+def _curves_by_rlzs(aggdf, periods, ep_fields, weights, blocksize=1000):
+    # yield triples (agg_ids, weights, curves of shape (R', A, P, EP))
+    # grouping together the agg_ids with the same set of realizations
+    P = len(periods)
+    agg_id = aggdf.agg_id.to_numpy()
+    rlz_id = aggdf.rlz_id.to_numpy()
+    porder = numpy.argsort(periods)
+    pidx = porder[numpy.searchsorted(periods[porder],
+                                     aggdf.return_period.to_numpy())]
+    order = numpy.lexsort((pidx, rlz_id, agg_id))
+    values = aggdf[ep_fields].to_numpy()[order]
+    agg_id = agg_id[order]
+    rlz_id = rlz_id[order]
+    starts = _group_starts(agg_id)
+    aggids = agg_id[starts]
+
+    # the realizations contributing to each agg_id
+    present = numpy.zeros((agg_id[-1] + 1, len(weights)), bool)
+    present[agg_id, rlz_id] = True
+    counts = numpy.diff(numpy.append(starts, len(agg_id)))
+    assert (counts == present[aggids].sum(axis=1) * P).all()
+    sigs, inv = numpy.unique(present[aggids], axis=0, return_inverse=True)
+    for sig, rlzs in enumerate(sigs):
+        R = rlzs.sum()
+        idx = numpy.flatnonzero(inv.reshape(-1) == sig)
+        for start in range(0, len(idx), blocksize):
+            block = idx[start:start + blocksize]
+            rows = starts[block][:, None] + numpy.arange(R * P)
+            arr = values[rows].reshape(len(block), R, P, len(ep_fields))
+            yield aggids[block], weights[rlzs], arr.transpose(1, 0, 2, 3)
+
+
 def save_curve_stats(dstore):
     """
     Save agg_curves-stats
@@ -85,15 +119,12 @@ def save_curve_stats(dstore):
         loss_id = scientific.LOSSID[lt]
         out = numpy.zeros((K + 1, S, P, EP))
         aggdf = aggcurves_df[aggcurves_df.loss_id == loss_id]
-        for agg_id, df in aggdf.groupby("agg_id"):
-            for s, stat in enumerate(stats.values()):
-                for p in range(P):
-                    for e, ep_field in enumerate(ep_fields):
-                        dfp = df[df.return_period == periods[p]]
-                        ws = weights[dfp.rlz_id.to_numpy()]
-                        ws /= ws.sum()
-                        out[agg_id, s, p, e] = stat(dfp[ep_field].to_numpy(),
-                                                    ws)
+        if len(aggdf):
+            for aggids, ws, arr in _curves_by_rlzs(
+                    aggdf, periods, ep_fields, weights):
+                # shape (S, A, P, EP) -> (A, S, P, EP)
+                out[aggids] = compute_stats(
+                    arr, list(stats.values()), ws / ws.sum()).swapaxes(0, 1)
         stat = 'agg_curves-stats/' + lt
         dstore.create_dset(stat, F64, (K + 1, S, P, EP))
         dstore.set_shape_descr(stat, agg_id=K+1, stat=list(stats),
@@ -242,31 +273,110 @@ def fix_dtypes(dic):
     fix_dtype(dic, F32, floatcolumns)
 
 
-def build_aggcurves(items, builder, num_events, aggregate_loss_curves_types):
+def _group_starts(*keys):
+    # indices of the first row of each group of equal keys, for sorted keys
+    flags = numpy.zeros(len(keys[0]), bool)
+    flags[0] = True
+    for key in keys:
+        flags[1:] |= key[1:] != key[:-1]
+    return numpy.flatnonzero(flags)
+
+
+def _sort_by_group(values, gidx):
+    # sort the values inside each group, keeping the groups in order
+    return values[numpy.lexsort((values, gidx))]
+
+
+def _add_curves(dic, name, losses, starts, num_events, builder):
+    curves, plas = scientific.losses_by_period_segmented(
+        losses, starts, builder.return_periods, num_events,
+        builder.eff_time, builder.pla_factor)
+    dic[name] = curves.flatten()
+    if plas is not None:
+        dic['pla_' + name] = plas.flatten()
+
+
+def build_aggrisk(data, builder, num_events, aggnumber, tr, oq, monitor):
     """
-    :param items: a list of pairs ((agg_id, rlz_id, loss_id), losses)
+    :param data: a dictionary of arrays sorted by (agg_id, rlz_id, loss_id)
     :param builder: a :class:`LossCurvesMapsBuilder` instance
+    :param num_events: the number of events per realization
+    :param aggnumber: the number of buildings per agg_id (or None)
+    :param tr: the time ratio (or None for scenarios)
+    :returns: a pair of dictionaries of arrays (aggrisk, aggcurves)
     """
-    dic = general.AccumDict(accum=[])
-    for (agg_id, rlz_id, loss_id), data in items:
-        year = data.pop('year', ())
-        curve = {
-            col: builder.build_curve(
-                # col is 'losses' in the case of consequences
-                year, 'loss' if col == 'losses' else col,
-                data[col], aggregate_loss_curves_types,
-                scientific.LOSSTYPE[loss_id], num_events[rlz_id])
-            for col in data}
-        for p, period in enumerate(builder.return_periods):
-            dic['agg_id'].append(agg_id)
-            dic['rlz_id'].append(rlz_id)
-            dic['loss_id'].append(loss_id)
-            dic['return_period'].append(period)
-            for col in data:
-                # NB: 'fatalities' in EventBasedDamageTestCase.test_case_15
-                for k, c in curve[col].items():
-                    dic[k].append(c[p])
-    return dic
+    agg_id = data.pop('agg_id')
+    rlz_id = data.pop('rlz_id')
+    loss_id = data.pop('loss_id')
+    year = data.pop('year', ())
+    starts = _group_starts(agg_id, rlz_id, loss_id)
+    G = len(starts)
+    counts = numpy.diff(numpy.append(starts, len(agg_id)))
+    gidx = numpy.repeat(numpy.arange(G), counts)
+    ne = num_events[rlz_id[starts]]
+    risk = {'agg_id': agg_id[starts], 'rlz_id': rlz_id[starts],
+            'loss_id': loss_id[starts]}
+
+    def norm(agg):
+        return agg * tr if oq.investigation_time else agg / ne
+
+    dmgs = [col for col in data if col.startswith('dmg_')]
+    if dmgs:
+        # infer the number of buildings in nodamage state
+        ndamaged = sum(numpy.add.reduceat(data[col], starts, dtype=F64)
+                       for col in dmgs)
+        dmg0 = aggnumber[risk['agg_id']] - ndamaged / (ne * len(
+            oq.loss_types))
+        assert (dmg0 >= 0).all(), dmg0.min()
+        risk['dmg_0'] = dmg0
+    if builder.pla_factor:
+        # the sorted losses are padded with zeros on the left up to ne,
+        # so the i-th loss of a group of n corresponds to eff_time / (n - i)
+        pos = numpy.arange(len(agg_id)) - starts[gidx]
+        factor = builder.pla_factor(builder.eff_time / (counts[gidx] - pos))
+    sorted_losses = {}
+    for col in data:
+        sorted_losses[col] = losses = _sort_by_group(data[col], gidx)
+        risk[col] = norm(numpy.add.reduceat(losses, starts).astype(F64))
+        if builder.pla_factor:
+            risk['pla_' + col] = norm(
+                numpy.add.reduceat(losses * factor, starts))
+
+    curves = {}
+    loss_cols = [col for col in data if not col.startswith('dmg_')]
+    if not (oq.investigation_time and loss_cols):
+        return risk, curves
+    P = len(builder.return_periods)
+    for key, val in risk.items():
+        if key in ('agg_id', 'rlz_id', 'loss_id'):
+            curves[key] = numpy.repeat(val, P)
+    curves['return_period'] = numpy.tile(builder.return_periods, G)
+    aggtypes = oq.aggregate_loss_curves_types.split(', ')
+    if len(year):
+        # group the losses by (agg_id, rlz_id, loss_id, year)
+        order = numpy.lexsort((year, gidx))
+        ystarts = _group_starts(gidx[order], year[order])
+        ygidx = gidx[order][ystarts]
+        ygstarts = _group_starts(ygidx)
+    for col in loss_cols:
+        # col is 'losses' in the case of consequences
+        name = 'loss' if col == 'losses' else col
+        if 'ep' in aggtypes:
+            _add_curves(curves, name, sorted_losses[col], starts, ne, builder)
+        if len(year):
+            # see specs in https://github.com/gem/oq-engine/issues/8971
+            losses = data[col][order]
+            if 'aep' in aggtypes:
+                ylosses = numpy.add.reduceat(losses, ystarts)
+                _add_curves(curves, name + '_aep',
+                            _sort_by_group(ylosses, ygidx), ygstarts,
+                            ne, builder)
+            if 'oep' in aggtypes:
+                ylosses = numpy.maximum.reduceat(losses, ystarts)
+                _add_curves(curves, name + '_oep',
+                            _sort_by_group(ylosses, ygidx), ygstarts,
+                            ne, builder)
+    return risk, curves
 
 
 def get_loss_id(ext_loss_types):
@@ -275,39 +385,84 @@ def get_loss_id(ext_loss_types):
     return scientific.LOSSID[ext_loss_types[0]]
 
 
-# launch Starmap building the aggcurves and store them
-def store_aggcurves(oq, agg_ids, rbe_df, builder, loss_cols,
-                    events, num_events, dstore):
-    aggtypes = oq.aggregate_loss_curves_types
-    logging.info('Building aggcurves')
-    units = dstore['exposure'].cost_calculator.get_units(oq.loss_types)
+def _agg_slices(agg_id, num_blocks):
+    # split the sorted rows in contiguous slices without breaking the agg_ids
+    N = len(agg_id)
+    astarts = _group_starts(agg_id)
+    idxs = numpy.searchsorted(astarts, N * numpy.arange(1, num_blocks) //
+                              num_blocks)
+    cuts = numpy.unique(numpy.concatenate(
+        [[0], astarts[idxs[idxs < len(astarts)]], [N]]))
+    return [slice(a, b) for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+def _get_tr(dstore, oq):
+    # time ratio (or None for scenarios)
+    if oq.investigation_time:  # event based
+        tr = oq.time_ratio  # (risk_invtime / haz_invtime) * num_ses
+        if oq.collect_rlzs:  # reduce the time ratio by the number of rlzs
+            tr /= len(dstore['weights'])
+        return tr
+
+
+def _get_year(events):
+    # the year of each event, or () if there is a single year
     try:
         year = events['year']
-        if len(numpy.unique(year)) == 1:  # there is a single year
-            year = ()
     except ValueError:  # missing in case of GMFs from CSV
-        year = ()
-    items = []
-    for agg_id in agg_ids:
-        gb = rbe_df[rbe_df.agg_id == agg_id].groupby(['rlz_id', 'loss_id'])
-        for (rlz_id, loss_id), df in gb:
-            data = {col: df[col].to_numpy() for col in loss_cols}
-            if len(year):
-                data['year'] = year[df.event_id.to_numpy()]
-            items.append([(agg_id, rlz_id, loss_id), data])
-    dic = parallel.Starmap.apply(
-        build_aggcurves, (items, builder, num_events, aggtypes),
-        concurrent_tasks=oq.concurrent_tasks,
-        h5=dstore.hdf5).reduce()
-    fix_dtypes(dic)
-    suffix = {'ep': '', 'aep': '_aep', 'oep': '_oep'}
-    ep_fields = ['loss' + suffix[a] for a in aggtypes.split(', ')]
-    dstore.create_df('aggcurves', pandas.DataFrame(dic),
-                     limit_states=' '.join(oq.limit_states),
-                     units=units, ep_fields=ep_fields)
-
-
-# aggcurves are built in parallel, aggrisk sequentially
+        return ()
+    if len(numpy.unique(year)) > 1:  # there are multiple years
+        return year
+    return ()
+
+
+def store_loss_by_event(dstore, df, rup_id):
+    """
+    Store loss_by_event and loss_by_rupture
+
+    :param df: risk_by_event rows for the total agg_id and loss type
+    :param rup_id: the rupture ID of each event
+    """
+    df = df.copy()
+    df['rup_id'] = rup_id[df.event_id.to_numpy()]
+    if 'losses' in df.columns:  # for consequences
+        df['loss'] = df['losses']
+    lbe_df = df[['event_id', 'loss']].sort_values(
+        'loss',  ascending=False)
+    gb = df[['rup_id', 'loss']].groupby('rup_id')
+    rbr_df = gb.sum().sort_values('loss', ascending=False)
+    dstore.create_df('loss_by_rupture', rbr_df.reset_index())
+    dstore.create_df('loss_by_event', lbe_df)
+
+
+def store_agg(dstore, oq, results):
+    """
+    Store aggrisk and aggcurves from the outputs of build_aggrisk
+
+    :param results: a list of pairs (aggrisk dict, aggcurves dict)
+    :returns: the aggrisk DataFrame
+    """
+    aggrisk = {col: numpy.concatenate([risk[col] for risk, _ in results])
+               for col in results[0][0]}
+    fix_dtypes(aggrisk)
+    aggrisk = pandas.DataFrame(aggrisk)
+    dstore.create_df('aggrisk', aggrisk,
+                     limit_states=' '.join(oq.limit_states))
+    if results[0][1]:
+        dic = {col: numpy.concatenate([curves[col] for _, curves in results])
+               for col in results[0][1]}
+        fix_dtypes(dic)
+        units = dstore['exposure'].cost_calculator.get_units(oq.loss_types)
+        suffix = {'ep': '', 'aep': '_aep', 'oep': '_oep'}
+        ep_fields = ['loss' + suffix[a] for a in
+                     oq.aggregate_loss_curves_types.split(', ')]
+        dstore.create_df('aggcurves', pandas.DataFrame(dic),
+                         limit_states=' '.join(oq.limit_states),
+                         units=units, ep_fields=ep_fields)
+    return aggrisk
+
+
+# aggrisk and aggcurves are built in parallel over ranges of agg_ids
 def build_store_agg(dstore, oq, rbe_df, num_events):
     """
     Build the aggrisk and aggcurves tables from the risk_by_event table
@@ -315,10 +470,7 @@ def build_store_agg(dstore, oq, rbe_df, num_events):
     size = dstore.getsize('risk_by_event')
     logging.info('Building aggrisk from %s of risk_by_event',
                  general.humansize(size))
-    if oq.investigation_time:  # event based
-        tr = oq.time_ratio  # (risk_invtime / haz_invtime) * num_ses
-        if oq.collect_rlzs:  # reduce the time ratio by the number of rlzs
-            tr /= len(dstore['weights'])
+    tr = _get_tr(dstore, oq)
     rups = len(dstore['ruptures'])
     events = dstore['events'][:]
     rlz_id = events['rlz_id']
@@ -327,16 +479,13 @@ def build_store_agg(dstore, oq, rbe_df, num_events):
         rbe_df['rlz_id'] = rlz_id[rbe_df.event_id.to_numpy()]
     else:
         rbe_df['rlz_id'] = 0
-    acc = general.AccumDict(accum=[])
     columns = [col for col in rbe_df.columns if col not in {
         'event_id', 'agg_id', 'rlz_id', 'loss_id', 'variance'}]
     dmgs = [col for col in columns if col.startswith('dmg_')]
-    if dmgs:
-        aggnumber = dstore['agg_values']['number']
+    aggnumber = dstore['agg_values']['number'] if dmgs else None
 
     agg_ids = rbe_df.agg_id.unique()
     K = agg_ids.max()
-    L = len(oq.loss_types)
     T = scientific.LOSSID[oq.total_losses or 'structural']
     logging.info("Performing %d aggregations", len(agg_ids))
 
@@ -346,55 +495,190 @@ def build_store_agg(dstore, oq, rbe_df, num_events):
     else:
         builder = FakeBuilder()
 
-    # double loop to avoid running out of memory
-    for agg_id in agg_ids:
+    # build loss_by_event and loss_by_rupture
+    if ('loss' in columns or 'losses' in columns) and rups:
+        df = rbe_df[(rbe_df.agg_id == K) & (rbe_df.loss_id == T)]
+        if len(df):
+            store_loss_by_event(dstore, df, rup_id)
+
+    # sort risk_by_event once by (agg_id, rlz_id, loss_id), keeping
+    # the agg_ids in order of appearance
+    rank = numpy.zeros(K + 1, U32)
+    rank[agg_ids] = numpy.arange(len(agg_ids))
+    aggrank = rank[rbe_df.agg_id.to_numpy()]
+    order = numpy.lexsort((rbe_df.loss_id.to_numpy(),
+                           rbe_df.rlz_id.to_numpy(), aggrank))
+    data = {col: rbe_df[col].to_numpy()[order]
+            for col in ['agg_id', 'rlz_id', 'loss_id'] + columns}
+    if oq.investigation_time and loss_cols:
+        year = _get_year(events)
+        if len(year):
+            data['year'] = year[rbe_df.event_id.to_numpy()[order]]
+    num_blocks = min(oq.concurrent_tasks or 1,
+                     -(-len(order) // 100_000), len(agg_ids))
+    slices = _agg_slices(aggrank[order], num_blocks)
+    allargs = [({col: arr[slc] for col, arr in data.items()},
+                builder, num_events, aggnumber, tr, oq) for slc in slices]
+    del data
+    results = list(parallel.Starmap(build_aggrisk, allargs, h5=dstore.hdf5))
+    results.sort(key=lambda res: rank[res[0]['agg_id'][0]])
+    return store_agg(dstore, oq, results)
+
+
+def get_rbe_counts(dstore, K):
+    """
+    :returns: the number of rows of risk_by_event for each agg_id
+    """
+    try:
+        return dstore['rbe_counts'][:]
+    except KeyError:  # not stored by the risk calculator, compute it
+        dset = dstore['risk_by_event/agg_id']
+        counts = numpy.zeros(K + 1, U64)
+        for slc in general.gen_slices(0, len(dset), 10_000_000):
+            counts += numpy.bincount(dset[slc], minlength=K + 1).astype(U64)
+        return counts
+
+
+def _rbe_partitions(counts, maxrows):
+    # associate to each agg_id a partition of contiguous agg_ids
+    # with less than 2 * maxrows rows, unless an agg_id has more rows
+    offsets = numpy.cumsum(counts) - counts
+    _, part = numpy.unique(offsets // maxrows, return_inverse=True)
+    return part
+
+
+def partition_rbe(dstore, fname, columns, part, idxs, rlz_id, year, maxrows):
+    """
+    Copy risk_by_event into the file `fname`, with a group for each
+    partition of agg_ids, by reading chunks of maxrows rows. The rlz_id
+    (and year) columns are added, the agg_ids are reaggregated if idxs
+    is not None.
+
+    :returns: the number of copied rows per partition
+    """
+    nrows = numpy.zeros(part.max() + 1, int)
+    dset = dstore['risk_by_event']
+    with hdf5.File(fname, 'w') as h5:
+        for slc in general.gen_slices(0, len(dset['event_id']), maxrows):
+            dic = {col: dset[col][slc] for col in columns}
+            eids = dic['event_id']
+            if idxs is not None:
+                dic['agg_id'] = idxs[dic['agg_id']]
+            dic['rlz_id'] = rlz_id[eids]
+            if len(year):
+                dic['year'] = year[eids]
+            parts = part[dic['agg_id']]
+            order = numpy.argsort(parts, kind='stable')
+            starts = _group_starts(parts[order])
+            stops = numpy.append(starts[1:], len(order))
+            for start, stop in zip(starts, stops):
+                p = parts[order[start]]
+                idx = order[start:stop]
+                nrows[p] += len(idx)
+                for col, arr in dic.items():
+                    key = '%d/%s' % (p, col)
+                    if key not in h5:
+                        hdf5.create(h5, key, arr.dtype)
+                    hdf5.extend(h5[key], arr[idx])
+    return nrows
+
+
+def read_partition(fname, p, columns):
+    """
+    :returns: a DataFrame with the rows of the partition p of risk_by_event
+    """
+    with hdf5.File(fname, 'r') as h5:
+        grp = h5[str(p)]
+        return pandas.DataFrame({col: grp[col][:]
+                                 for col in columns if col in grp})
+
+
+def build_aggrisk_part(fname, p, columns, reaggregate, builder, num_events,
+                       aggnumber, tr, oq, monitor):
+    """
+    Build aggrisk and aggcurves from the partition p of risk_by_event
+
+    :returns: a pair of dictionaries of arrays (aggrisk, aggcurves)
+    """
+    with monitor('reading risk_by_event'):
+        df = read_partition(fname, p, ['event_id', 'agg_id', 'rlz_id',
+                                       'loss_id', 'year'] + columns)
+    if reaggregate:
+        keys = [col for col in df.columns if col not in columns]
+        df = df.groupby(keys).sum().reset_index()
+    order = numpy.lexsort((df.loss_id.to_numpy(), df.rlz_id.to_numpy(),
+                           df.agg_id.to_numpy()))
+    data = {col: df[col].to_numpy()[order]
+            for col in df.columns if col != 'event_id'}
+    return build_aggrisk(data, builder, num_events, aggnumber, tr, oq,
+                         monitor)
+
+
+# out-of-core version of build_store_agg
+def stream_store_agg(dstore, oq, num_events, idxs=None):
+    """
+    Build the aggrisk and aggcurves tables from the risk_by_event table
+    without reading it in memory: risk_by_event is split in partitions of
+    contiguous agg_ids which are processed in parallel.
 
+    :param idxs: reaggregation indices, or None
+    """
+    size = dstore.getsize('risk_by_event')
+    dset = dstore['risk_by_event']
+    nrows = len(dset['event_id'])
+    K = dset.attrs.get('K', 0)
+    counts = get_rbe_counts(dstore, K)
+    if idxs is not None:
+        counts = numpy.bincount(idxs, counts).astype(U64)
+        K = len(counts) - 1
+    columns = [col for col in dset.attrs['__pdcolumns__'].split()
+               if col not in {'event_id', 'agg_id', 'loss_id', 'variance'}]
+    rowsize = size / nrows
+    maxrows = max(int(min(float(config.memory.rbe_max_gb) * 1024**3 / rowsize,
+                          -(-nrows // (oq.concurrent_tasks or 1)))), 1)
+    part = _rbe_partitions(counts, maxrows)
+    logging.info('Building aggrisk from %s of risk_by_event in %d '
+                 'partitions', general.humansize(size), part.max() + 1)
+
+    events = dstore['events'][:]
+    if len(num_events) > 1:
+        rlz_id = events['rlz_id']
+    else:
+        rlz_id = numpy.zeros(len(events), U16)
+    dmgs = [col for col in columns if col.startswith('dmg_')]
+    aggnumber = dstore['agg_values']['number'] if dmgs else None
+    loss_cols = [col for col in columns if not col.startswith('dmg_')]
+    if loss_cols:
+        builder = get_loss_builder(dstore, oq, num_events=num_events)
+    else:
+        builder = FakeBuilder()
+    year = _get_year(events) if oq.investigation_time and loss_cols else ()
+
+    fname = os.path.join(parallel.scratch_dir(dstore.calc_id), 'rbe.hdf5')
+    rows = partition_rbe(
+        dstore, fname, ['event_id', 'agg_id', 'loss_id'] + columns,
+        part, idxs, rlz_id, year, maxrows)
+    try:
         # build loss_by_event and loss_by_rupture
-        if agg_id == K and ('loss' in columns or 'losses' in columns) and rups:
-            df = rbe_df[(rbe_df.agg_id == K) & (rbe_df.loss_id == T)].copy()
+        T = scientific.LOSSID[oq.total_losses or 'structural']
+        if ('loss' in columns or 'losses' in columns) and len(
+                dstore['ruptures']):
+            df = read_partition(fname, part[K], ['event_id', 'agg_id',
+                                                 'loss_id'] + columns)
+            df = df[(df.agg_id == K) & (df.loss_id == T)]
             if len(df):
-                df['rup_id'] = rup_id[df.event_id.to_numpy()]
-                if 'losses' in columns:  # for consequences
-                    df['loss'] = df['losses']
-                lbe_df = df[['event_id', 'loss']].sort_values(
-                    'loss',  ascending=False)
-                gb = df[['rup_id', 'loss']].groupby('rup_id')
-                rbr_df = gb.sum().sort_values('loss', ascending=False)
-                dstore.create_df('loss_by_rupture', rbr_df.reset_index())
-                dstore.create_df('loss_by_event', lbe_df)
-
-        # build aggrisk
-        gb = rbe_df[rbe_df.agg_id == agg_id].groupby(['rlz_id', 'loss_id'])
-        for (rlz_id, loss_id), df in gb:
-            ne = num_events[rlz_id]
-            acc['agg_id'].append(agg_id)
-            acc['rlz_id'].append(rlz_id)
-            acc['loss_id'].append(loss_id)
-            if dmgs:
-                # infer the number of buildings in nodamage state
-                ndamaged = sum(df[col].sum() for col in dmgs)
-                dmg0 = aggnumber[agg_id] - ndamaged / (ne * L)
-                assert dmg0 >= 0, dmg0
-                acc['dmg_0'].append(dmg0)
-            for col in columns:
-                losses = df[col].sort_values().to_numpy()
-                sorted_losses, _, eperiods = scientific.fix_losses(
-                    losses, ne, builder.eff_time)
-                agg = sorted_losses.sum()
-                acc[col].append(
-                    agg * tr if oq.investigation_time else agg/ne)
-                if builder.pla_factor:
-                    agg = sorted_losses @ builder.pla_factor(eperiods)
-                    acc['pla_' + col].append(
-                        agg * tr if oq.investigation_time else agg/ne)
-    fix_dtypes(acc)
-    aggrisk = pandas.DataFrame(acc)
-    dstore.create_df('aggrisk', aggrisk,
-                     limit_states=' '.join(oq.limit_states))
-    if oq.investigation_time and loss_cols:
-        store_aggcurves(oq, agg_ids, rbe_df, builder, loss_cols, events,
-                        num_events, dstore)
-    return aggrisk
+                store_loss_by_event(dstore, df, events['rup_id'])
+
+        tr = _get_tr(dstore, oq)
+        allargs = [(fname, p, columns, idxs is not None, builder,
+                    num_events, aggnumber, tr, oq)
+                   for p in numpy.flatnonzero(rows)]
+        results = list(parallel.Starmap(
+            build_aggrisk_part, allargs, h5=dstore.hdf5))
+    finally:
+        os.remove(fname)
+    results.sort(key=lambda res: res[0]['agg_id'][0])
+    return store_agg(dstore, oq, results)
 
 
 def build_reinsurance(dstore, oq, num_events):
@@ -566,20 +850,30 @@ class PostRiskCalculator(base.RiskCalculator):
                     self.datastore.set_shape_descr(
                         'src_loss_table/' + loss_type, source=source_ids)
         K = len(self.datastore['agg_keys']) if oq.aggregate_by else 0
-        rbe_df = self.datastore.read_df('risk_by_event')
-        if len(rbe_df) == 0:
-            logging.warning('The risk_by_event table is empty, perhaps the '
-                            'hazard is too small?')
-            return 0
         if self.reaggreate:
             idxs = numpy.concatenate([
                 reagg_idxs(self.num_tags, oq.aggregate_by[0]),
                 numpy.array([K], int)])
-            rbe_df['agg_id'] = idxs[rbe_df['agg_id'].to_numpy()]
-            rbe_df = rbe_df.groupby(
-                ['event_id', 'loss_id', 'agg_id']).sum().reset_index()
-        self.aggrisk = build_store_agg(
-            self.datastore, oq, rbe_df, self.num_events)
+        else:
+            idxs = None
+        size = self.datastore.getsize('risk_by_event')
+        if size > float(config.memory.rbe_max_gb) * 1024**3:
+            # risk_by_event too large to be read in memory
+            with self.monitor('stream_store_agg', measuremem=True):
+                self.aggrisk = stream_store_agg(
+                    self.datastore, oq, self.num_events, idxs)
+        else:
+            rbe_df = self.datastore.read_df('risk_by_event')
+            if len(rbe_df) == 0:
+                logging.warning('The risk_by_event table is empty, perhaps '
+                                'the hazard is too small?')
+                return 0
+            if idxs is not None:
+                rbe_df['agg_id'] = idxs[rbe_df['agg_id'].to_numpy()]
+                rbe_df = rbe_df.groupby(
+                    ['event_id', 'loss_id', 'agg_id']).sum().reset_index()
+            self.aggrisk = build_store_agg(
+                self.datastore, oq, rbe_df, self.num_events)
         if 'reinsurance-risk_by_event' in self.datastore:
             build_reinsurance(self.datastore, oq, self.num_events)
         return 1
@@ -27,6 +27,7 @@ from openquake.hazardlib import pmf, geo, source_reader
 from openquake.baselib.general import AccumDict, groupby, block_splitter
 from openquake.hazardlib.contexts import read_cmakers
 from openquake.hazardlib.source.point import grid_point_sources
+from openquake.hazardlib.geo.surface.multi import build_u_max
 from openquake.hazardlib.source.base import get_code2cls
 from openquake.hazardlib.sourceconverter import SourceGroup
 from openquake.hazardlib.calc.filters import (
@@ -96,6 +97,48 @@ def _filter(srcs, min_mag):
     return out
 
 
+def compute_u_max(items, secparams, monitor):
+    """
+    Compute the u_max parameter for a block of multifault ruptures
+
+    :param items: triples (source_id, rupture index, section indices)
+    :param secparams: an array of section parameters
+    :returns: a dictionary source_id -> list of pairs (rupture index, u_max)
+    """
+    u_max = build_u_max([idxs for _, _, idxs in items], secparams)
+    out = AccumDict(accum=[])
+    for (source_id, rupid, _), um in zip(items, u_max):
+        out[source_id].append((rupid, um))
+    return out
+
+
+def store_u_max(multifaults, secparams, h5=None):
+    """
+    Compute in parallel the u_max parameter for the ruptures of the
+    multifault sources and store it in the multifault file, unless
+    it is already there
+    """
+    hdf5path = multifaults[0].hdf5path
+    with hdf5.File(hdf5path, 'r') as f:
+        srcs = [src for src in multifaults
+                if f'{src.source_id}/u_max' not in f]
+    items = [(src.source_id, rupid, idxs) for src in srcs
+             for rupid, idxs in enumerate(src.rupture_idxs)]
+    if not items:
+        return
+    logging.info('Computing u_max for %d multifault ruptures', len(items))
+    # the cost of MultiLine.get_u_max is quadratic in the number of sections
+    dic = parallel.Starmap.apply(
+        compute_u_max, (items, secparams),
+        weight=lambda item: len(item[2]) ** 2, h5=h5).reduce()
+    with hdf5.File(hdf5path, 'r+') as f:
+        for src in srcs:
+            u_max = numpy.zeros(len(src.mags), F32)
+            for rupid, um in dic[src.source_id]:
+                u_max[rupid] = um
+            f[f'{src.source_id}/u_max'] = u_max
+
+
 def preclassical(srcs, sites, cmaker, secparams, monitor):
     """
     Weight the sources. Also split them if split_sources is true. If
@@ -282,6 +325,10 @@ class PreClassicalCalculator(base.HazardCalculator):
             logging.warning(
                 'There are %d multiFaultSources (secparams=%s)',
                 len(multifaults), general.humansize(secparams.nbytes))
+            ry0 = [src for src in multifaults if 'ry0' in
+                   self.cmakers[src.grp_id].REQUIRES_DISTANCES]
+            if ry0:
+                store_u_max(ry0, secparams, self.datastore.hdf5)
         else:
             secparams = ()
         self._process(atomic_sources, normal_sources, sites, secparams)
@@ -216,6 +216,46 @@ class ClassicalTestCase(CalculatorTestCase):
         self.assertEqual(data['tiles'], 1)
         self.assertEqual(data['blocks'], 2)
 
+    def test_case_22_no_pipeline(self):
+        # tiling with the statistics computed after all the tiling tasks
+        with mock.patch.dict(config.memory, {'pmap_max_gb': 1E-5}), \
+             mock.patch.dict(config.distribution, {'pipelined_tiling': 0}), \
+             mock.patch.dict(os.environ, {'OQ_DISTRIBUTE': 'no'}):
+            self.assert_curves_ok([
+                '/hazard_curve-mean-PGA.csv',
+                'hazard_curve-mean-SA(0.1)',
+                'hazard_curve-mean-SA(0.2).csv',
+                'hazard_curve-mean-SA(0.5).csv',
+                'hazard_curve-mean-SA(1.0).csv',
+                'hazard_curve-mean-SA(2.0).csv',
+        ], case_22.__file__, delta=1E-6)
+        self.assertIsNone(self.calc.pipeline)
+
+    def test_case_22_pipeline_tiles(self):
+        # tiling with several tiles and chunks, the pipelined statistics
+        # must be the same as the ones computed after the tiling phase
+        tmp = tempfile.gettempdir()
+        hcurves = {}
+        for pipelined, custom_tmp in [(0, ''), (1, ''), (1, tmp)]:
+            with mock.patch.dict(config.memory, {'pmap_max_gb': 1E-5,
+                                                 'pmap_max_mb': 1E-4}), \
+                 mock.patch.dict(config.distribution,
+                                 {'pipelined_tiling': pipelined}), \
+                 mock.patch.dict(config.directory, {'custom_tmp': custom_tmp}), \
+                 mock.patch.dict(os.environ, {'OQ_DISTRIBUTE': 'no'}):
+                self.run_calc(case_22.__file__, 'job.ini',
+                              max_sites_disagg='4')
+            data = self.calc.datastore['source_groups']
+            self.assertEqual(data['tiles'], 6)
+            if pipelined:
+                pipeline = self.calc.pipeline
+                self.assertEqual(len(pipeline.pgetters), 4)
+                self.assertEqual(pipeline.submitted, len(pipeline.pgetters))
+            hcurves[pipelined, custom_tmp] = self.calc.datastore[
+                'hcurves-stats'][:]
+        for key in [(1, ''), (1, tmp)]:
+            aac(hcurves[key], hcurves[0, ''], atol=1E-9)
+
     def test_case_23(self):  # filtering away on TRT
         self.assert_curves_ok(['hazard_curve.csv'],
                               case_23.__file__, delta=1e-5)
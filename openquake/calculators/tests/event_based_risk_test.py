@@ -17,10 +17,12 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
+import unittest
 from unittest import mock, SkipTest
 import numpy
 
-from openquake.baselib.general import gettemp
+from openquake.baselib import config
+from openquake.baselib.general import gettemp, AccumDict, fast_agg2
 from openquake.baselib.hdf5 import read_csv
 from openquake.hazardlib import InvalidFile
 from openquake.hazardlib.source.rupture import get_ruptures
@@ -30,6 +32,7 @@ from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
 from openquake.calculators.post_risk import PostRiskCalculator
+from openquake.calculators import event_based_risk as ebr
 from openquake.qa_tests_data.event_based_risk import (
     case_1, case_2, case_3, case_4, case_4a, case_5, case_6c, case_master,
     case_miriam, occupants, case_1f, case_1g, case_7a, case_8, case_9,
@@ -327,6 +330,16 @@ agg_id
             self.assertEqualFiles('expected/' + strip_calc_id(fname),
                                   fname, delta=5E-4)
 
+    def test_case_5_streaming(self):
+        # risk_by_event processed in partitions, same results as test_case_5
+        with mock.patch.dict(config.memory, {'rbe_max_gb': 1E-6}):
+            self.run_calc(case_5.__file__, 'job.ini')
+        for kind in ('aggcurves', 'aggrisk-stats', 'aggcurves-stats'):
+            fnames = export((kind, 'csv'), self.calc.datastore)
+            for fname in fnames:
+                self.assertEqualFiles('expected/' + strip_calc_id(fname),
+                                      fname, delta=5E-4)
+
     def test_occupants(self):
         self.run_calc(occupants.__file__, 'job.ini')
         fnames = export(('aggcurves', 'csv'), self.calc.datastore)
@@ -552,6 +565,22 @@ agg_id
         aac(losses, [1356.609, 324.64624, 203.6374, 129.69826], rtol=6e-5)
         self.assertEqual(nrups, 2)  # two ruptures >= 80% of the losses
 
+    def test_case_7a_gmf_by_site(self):
+        # reading the GMFs by site must give the same risk_by_event
+        self.run_calc(case_7a.__file__,  'job_h.ini', gmf_by_site='true')
+        hc_id = str(self.calc.datastore.calc_id)
+        self.assertIn('gmf_by_site', self.calc.datastore)
+        self.run_calc(case_7a.__file__,  'job_r.ini',
+                      hazard_calculation_id=hc_id)
+        expected = self.calc.datastore.read_df(
+            'risk_by_event', ['event_id', 'agg_id', 'loss_id'])
+        with mock.patch('openquake.commonlib.calc.GMF_BY_SITE_FRACTION', 2):
+            self.run_calc(case_7a.__file__,  'job_r.ini',
+                          hazard_calculation_id=hc_id, concurrent_tasks='4')
+        got = self.calc.datastore.read_df(
+            'risk_by_event', ['event_id', 'agg_id', 'loss_id'])
+        aac(got.sort_index().loss, expected.sort_index().loss, rtol=1E-6)
+
     def test_case_8(self):
         # loss_type-dependent taxonomy mapping
         out = self.run_calc(case_8.__file__,  'job.ini', exports='csv',
@@ -766,3 +795,52 @@ class ReinsuranceTestCase(CalculatorTestCase):
         [fname] = export(('reinsurance-aggcurves', 'csv'), self.calc.datastore)
         self.assertEqualFiles('expected/reinsurance-aggcurves.csv',
                               fname, delta=.002)  # big diffs on macos, 0.16%
+
+
+def agg_with_dict(keys, values, xtypes):
+    # the original implementation of the event loss table, used as reference
+    acc = AccumDict(accum=numpy.zeros((len(xtypes), 2)))
+    for li, (kk, vv) in enumerate(zip(keys, values)):
+        for ukey, avalue in zip(*fast_agg2(kk, vv)):
+            acc[ukey][li] += avalue
+    dic = AccumDict(accum=[])
+    for ukey, arr in acc.items():
+        eid, kid = divmod(ukey, ebr.TWO32)
+        for li in range(len(xtypes)):
+            if arr[li].any():
+                dic['event_id'].append(eid)
+                dic['agg_id'].append(kid)
+                dic['loss_id'].append(ebr.LOSSID[xtypes[li]])
+                dic['variance'].append(arr[li, 0])
+                dic['loss'].append(arr[li, 1])
+    return dic
+
+
+class EventLossTableTestCase(unittest.TestCase):
+    # the array-based aggregation in ebr.aggreg, see utils/bench_elt.py
+    def test_same_as_dict(self):
+        rng = numpy.random.default_rng(42)
+        xtypes = ['structural', 'nonstructural']
+        N, E, K = 2000, 100, 50
+        keys, values = [], []
+        for li in range(len(xtypes)):
+            eids = rng.integers(0, E, N).astype(numpy.uint64)
+            kids = rng.integers(0, K, N).astype(numpy.uint64)
+            keys.append(eids * ebr.TWO32 + kids)
+            vals = rng.random((N, 2))
+            vals[rng.random(N) < .1] = 0  # some zero losses
+            values.append(vals)
+        expected = agg_with_dict(keys, values, xtypes)
+
+        acc = [[] for _ in xtypes]
+        with mock.patch.object(ebr, 'MAX_ROWS', N):  # force compaction
+            for li in range(len(xtypes)):
+                for chunk in numpy.array_split(numpy.arange(N), 4):
+                    ebr.fast_agg(keys[li][chunk], values[li][chunk],
+                                 False, li, acc)
+        got = ebr.build_event_loss_table(acc, xtypes)
+
+        order = numpy.lexsort((expected['loss_id'], expected['agg_id'],
+                               expected['event_id']))
+        for col in got:
+            aac(got[col], numpy.array(expected[col])[order])
@@ -34,7 +34,8 @@ from openquake.commonlib.calc import gmvs_to_poes
 from openquake.calculators.views import view
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
-from openquake.calculators.event_based import get_mean_curve, compute_avg_gmf
+from openquake.calculators.event_based import (
+    get_mean_curve, compute_avg_gmf, AvgGmf)
 from openquake.calculators.tests import CalculatorTestCase
 from openquake.qa_tests_data.event_based import (
     blocksize, case_1, case_2, case_3, case_4, case_5, case_6, case_7,
@@ -117,6 +118,16 @@ class EventBasedTestCase(CalculatorTestCase):
         # aac(avgstd, [[0.14734], [1.475266]], atol=1E-6)  # cutting at .10
         aac(avgstd, [[0.137023], [1.620616]], atol=1E-6)
 
+        # accumulating the GMFs in blocks gives the same result, even
+        # with a single-row block (one site, one event, one IMT)
+        acc = AvgGmf(weights, 1, min_iml)
+        sids = numpy.zeros(ok.sum(), int)
+        gmvs = gmvs[ok].reshape(-1, 1)
+        acc.add(sids[:1], eids[ok][:1], gmvs[:1])
+        acc.add(sids[1:500], eids[ok][1:500], gmvs[1:500])
+        acc.add(sids[500:], eids[ok][500:], gmvs[500:])
+        aac(acc.get()[:, 0], avgstd, rtol=1E-6)
+
     def test_spatial_correlation(self):
         expected = {sc1: [0.99, 0.41],
                     sc2: [0.99, 0.64],
@@ -195,6 +206,19 @@ class EventBasedTestCase(CalculatorTestCase):
         [fname, _, _] = out['gmf_data', 'csv']
         self.assertEqualFiles('expected/gsim_by_imt.csv', fname)
 
+    def test_case_1_compressed(self):
+        # the compressed GMFs are read transparently
+        self.run_calc(case_1.__file__, 'job.ini')
+        expected = self.calc.datastore.read_df('gmf_data', 'sid')
+        self.run_calc(case_1.__file__, 'job.ini', gmf_compression='lzf',
+                      gmf_precision='1E-4')
+        dset = self.calc.datastore['gmf_data/gmv_0']
+        self.assertEqual(dset.compression, 'lzf')
+        self.assertTrue(dset.shuffle)
+        got = self.calc.datastore.read_df('gmf_data', 'sid')
+        numpy.testing.assert_equal(got.eid.to_numpy(), expected.eid.to_numpy())
+        aac(got.gmv_0, expected.gmv_0, rtol=1E-4)
+
     def test_case_1_ruptures(self):
         self.run_calc(case_1.__file__, 'job_ruptures.ini')
         self.assertEqual(len(self.calc.datastore['ruptures']), 2)
@@ -1219,8 +1219,9 @@ def view_calc_risk(token, dstore):
     if oq.ignore_master_seed or oq.ignore_covs:
         rng = None
     else:
-        rng = ebr.MultiEventRNG(oq.master_seed, gmf_df.eid.unique(),
-                                int(oq.asset_correlation))
+        RNG = ebr.VectorizedRNG if oq.vectorized_rng else ebr.MultiEventRNG
+        rng = RNG(oq.master_seed, gmf_df.eid.unique(),
+                  int(oq.asset_correlation))
 
     mon = Monitor()
     outs = []  # ebr.gen_outputs(gmf_df, crmodel, rng, mon)
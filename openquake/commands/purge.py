@@ -21,6 +21,7 @@ import shutil
 import getpass
 from openquake.baselib import config
 from openquake.baselib.general import humansize
+from openquake.hazardlib.contexts import purge_ctxs_cache, CTXS_CACHE
 from openquake.commonlib import logs, datastore
 
 datadir = datastore.get_datadir()
@@ -103,6 +104,10 @@ def main(what, force=False):
     elif what == 'old':
         purge('complete failed deleted'.split(), '30 days', force)
         return
+    elif what == 'ctxs':
+        n = purge_ctxs_cache(os.path.join(datadir, CTXS_CACHE))
+        print('Removed %d files from the contexts cache' % n)
+        return
     calc_id = int(what)
     if calc_id < 0:
         try:
@@ -113,5 +118,5 @@ def main(what, force=False):
     purge_one(calc_id, getpass.getuser(), force)
 
 
-main.what = 'a calculation ID or the string "failed"'
+main.what = 'a calculation ID or the strings "failed", "old", "ctxs"'
 main.force = 'ignore dependent calculations'
@@ -22,7 +22,7 @@ import functools
 import numpy
 from shapely.geometry import Point
 
-from openquake.baselib import performance, parallel, hdf5, general
+from openquake.baselib import config, performance, parallel, hdf5, general
 from openquake.hazardlib.source import rupture
 from openquake.hazardlib import map_array, geo
 from openquake.hazardlib.source.rupture import get_events
@@ -429,6 +429,174 @@ def get_slices(sbe, data, num_assets):
     return out
 
 
+# number of rows in a chunk of a compressed gmf_data column
+GMF_CHUNK = 65_536
+
+
+def round_gmvs(gmvs, precision):
+    """
+    Round float32 GMVs to the given relative precision by zeroing the least
+    significant bits of the mantissa, so that they compress much better.
+
+    >>> round_gmvs(numpy.float32([0.123456, 1.5, 0.]), 1E-3)
+    array([0.12347412, 1.5       , 0.        ], dtype=float32)
+    """
+    drop = 23 - int(numpy.ceil(-numpy.log2(precision))) if precision else 0
+    if drop <= 0:
+        return gmvs
+    ints = numpy.ascontiguousarray(gmvs, F32).view(U32)
+    mask = U32((0xFFFFFFFF << drop) & 0xFFFFFFFF)
+    return ((ints + U32(1 << (drop - 1))) & mask).view(F32)
+
+
+def gmf_read_token(monitor):
+    """
+    :returns: a context manager holding a token to read gmf_data, so that
+              at most `max_gmf_readers` tasks read the GMFs at the same time
+    """
+    num_tokens = int(config.distribution.get('max_gmf_readers') or 0)
+    tokens = parallel.ReadTokens(
+        parallel.scratch_dir(monitor.calc_id), num_tokens)
+    return tokens(monitor)
+
+
+##############################################################
+# site-ordered copy of gmf_data, used when there are few     #
+# asset sites compared to the hazard sites                   #
+##############################################################
+
+# read gmf_by_site if the risk sites are less than this fraction of the sites
+GMF_BY_SITE_FRACTION = 0.1
+
+site_slice_dt = numpy.dtype([('start', I64), ('stop', I64)])
+
+
+def save_gmf_by_site(dstore, cols, N):
+    """
+    Store the columns of gmf_data ordered by (sid, eid) in the group
+    gmf_by_site, together with an index `gmf_by_site/slice_by_site` of
+    length N, so that the GMFs of a site can be read with a single slice.
+
+    :param dstore: DataStore containing gmf_data
+    :param cols: the columns to copy, such as eid, gmv_0, ...
+    :param N: the total number of sites
+    """
+    data = dstore['gmf_data']
+    sids = data['sid'][:]
+    order = numpy.lexsort((data['eid'][:], sids))
+    stops = get_counts(sids, N).cumsum()
+    slices = numpy.zeros(N, site_slice_dt)
+    slices['start'][1:] = stops[:-1]
+    slices['stop'] = stops
+    del sids
+    for col in cols:
+        dstore['gmf_by_site/' + col] = data[col][:][order]
+    dstore['gmf_by_site/slice_by_site'] = slices
+
+
+def use_gmf_by_site(dstore, risk_sids):
+    """
+    :param dstore: DataStore containing (or with a parent containing) GMFs
+    :param risk_sids: the sites with assets
+    :returns: True if the GMFs are stored also by site and the risk sites
+              are a small fraction of the total
+    """
+    ds = dstore.parent if 'gmf_data' in dstore.parent else dstore
+    if 'gmf_by_site' not in ds:
+        return False
+    N = len(ds['gmf_by_site/slice_by_site'])
+    return len(risk_sids) < GMF_BY_SITE_FRACTION * N
+
+
+def _gen_site_eids(dstore, sids):
+    # yields (sid, start, eids) for each site, where start is the
+    # position of the first row of the site in gmf_by_site; the event
+    # IDs are read with a single slice for each run of consecutive sites
+    sbs = dstore['gmf_by_site/slice_by_site']
+    eid_dset = dstore['gmf_by_site/eid']
+    for run in numpy.split(sids, numpy.where(numpy.diff(sids) != 1)[0] + 1):
+        if len(run) == 0:
+            continue
+        slices = sbs[run[0]:run[-1] + 1]
+        start, stop = slices[0]['start'], slices[-1]['stop']
+        if start == stop:
+            continue
+        eids = eid_dset[start:stop]
+        for sid, s0, s1 in zip(run, slices['start'], slices['stop']):
+            yield sid, s0, eids[s0 - start:s1 - start]
+
+
+def read_gmf_by_site(dstore, sids, eid0, eid1, cols):
+    """
+    :param dstore: DataStore containing the group gmf_by_site
+    :param sids: sorted array of site IDs
+    :param eid0: minimum event ID
+    :param eid1: maximum event ID (excluded)
+    :param cols: the columns to read, starting with 'sid' and 'eid'
+    :returns: a dictionary column -> array ordered by (eid, sid), empty
+              if there are no GMFs for the given sites and events
+    """
+    acc = {'sid': [], 'eid': []}
+    ranges = []  # row ranges to read, merging the contiguous ones
+    for sid, start, eids in _gen_site_eids(dstore, sids):
+        i0, i1 = numpy.searchsorted(eids, [eid0, eid1])
+        if i0 == i1:
+            continue
+        acc['sid'].append(numpy.full(i1 - i0, sid, U32))
+        acc['eid'].append(eids[i0:i1])
+        if ranges and ranges[-1][1] == start + i0:
+            ranges[-1][1] = start + i1
+        else:
+            ranges.append([start + i0, start + i1])
+    if not ranges:
+        return {}
+    for col in cols[2:]:
+        dset = dstore['gmf_by_site/' + col]
+        acc[col] = [dset[r0:r1] for r0, r1 in ranges]
+    dic = {col: numpy.concatenate(acc[col]) for col in cols}
+    order = numpy.argsort(dic['eid'], kind='stable')
+    return {col: arr[order] for col, arr in dic.items()}
+
+
+def starmap_from_gmfs_by_site(task_func, oq, dstore, mon):
+    """
+    :param task_func: function or generator with signature (events, oq, ds)
+    :param oq: an OqParam instance
+    :param dstore: DataStore instance where the GMFs are stored by site
+    :returns: a Starmap object used for event based calculations
+
+    The tasks receive arrays of consecutive event IDs with weights given by
+    the number of affected assets; the weights are computed by reading
+    only the event IDs of the sites with assets.
+    """
+    ds = dstore.parent if 'gmf_data' in dstore.parent else dstore
+    N = len(ds['gmf_by_site/slice_by_site'])
+    site_ids = dstore['assetcol/array']['site_id']
+    num_assets = get_counts(site_ids, N)
+    with mon('computing event impact', measuremem=True):
+        eids, weights = [], []
+        for sid, _, eids_ in _gen_site_eids(ds, numpy.unique(site_ids)):
+            eids.append(eids_)
+            weights.append(numpy.full(len(eids_), num_assets[sid]))
+        eids = numpy.concatenate(eids)
+        ws = numpy.bincount(eids, numpy.concatenate(weights))
+        uniq = numpy.unique(eids)
+        events = numpy.zeros(len(uniq), [('eid', U32), ('weight', float)])
+        events['eid'] = uniq
+        events['weight'] = ws[uniq]
+    logging.info('Reading the GMFs of %d sites out of %d by site',
+                 len(numpy.unique(site_ids)), N)
+    dstore.swmr_on()
+    maxw = events['weight'].sum() / (oq.concurrent_tasks or 1) or 1.
+    logging.info('maxw = {:_d}'.format(int(maxw)))
+    smap = parallel.Starmap.apply(
+        task_func, (events, oq, ds),
+        maxweight=min(maxw, 200_000_000),
+        weight=operator.itemgetter('weight'),
+        h5=dstore.hdf5)
+    return smap
+
+
 def starmap_from_gmfs(task_func, oq, dstore, mon):
     """
     :param task_func: function or generator with signature (gmf_df, oq, dstore)
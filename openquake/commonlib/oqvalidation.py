@@ -120,6 +120,27 @@ asset_life_expectancy:
 assets_per_site_limit:
   INTERNAL
 
+gmf_by_site:
+  If set, store also a copy of gmf_data ordered by site, so that
+  event_based_risk calculations with few asset sites can read only the
+  GMFs of such sites.
+  Example: *gmf_by_site = true*.
+  Default: False
+
+gmf_compression:
+  Compression used for the columns of gmf_data, with the shuffle filter;
+  'lzf' is fast, 'gzip' gives smaller files. The data are decompressed
+  transparently when read.
+  Example: *gmf_compression = lzf*.
+  Default: None
+
+gmf_precision:
+  Relative precision of the stored GMVs; if nonzero, the GMVs are rounded
+  by zeroing the least significant bits of the mantissa, so that they
+  compress much better. Use it together with gmf_compression.
+  Example: *gmf_precision = 1E-3*.
+  Default: 0 (lossless)
+
 gmf_max_gb:
   If the size (in GB) of the GMFs is below this value, then compute avg_gmf
   Example: *gmf_max_gb = 1.*
@@ -137,7 +158,14 @@ cachedir:
   INTERNAL
 
 cache_distances:
-  Useful in UCERF calculations.
+  If set, in classical calculations the contexts (i.e. the distances and
+  the rupture and site parameters) are stored in the cache directory and
+  reused by the following calculations with the same sources and sites,
+  for instance when changing only the GMPE logic tree or the IMT levels.
+  Requires running the calculation with the --reuse-input flag.
+  The files are stored in the ctxs subdirectory of oqdata; the least
+  recently used ones are removed when the cache exceeds the size set by
+  ctxs_cache_max_gb in openquake.cfg, or all of them with `oq purge ctxs`.
   Example: *cache_distances = true*.
   Default: False
 
@@ -329,7 +357,11 @@ ground_motion_correlation_model:
   Default: None
 
 ground_motion_correlation_params:
-  To be used together with ground_motion_correlation_model.
+  To be used together with ground_motion_correlation_model. For the JB2009
+  and HM2018 models you can also set a "cutoff" distance in km beyond which
+  the correlation is tapered to zero: then a sparse correlation matrix is
+  computed only on the affected sites, which is needed to manage
+  tens of thousands of sites.
   Example: *ground_motion_correlation_params = {"vs30_clustering": False}*.
   Default: empty dictionary
 
@@ -859,6 +891,15 @@ use_rates:
   Example: *use_rates = true*.
   Default: False
 
+vectorized_rng:
+  Used in event based risk and damage calculations. When set, the random
+  numbers for the vulnerability and damage sampling are generated in bulk
+  from a counter-based Philox generator keyed by (master_seed, eid, aid):
+  they do not depend on the task distribution and are much faster for
+  millions of events. The numbers are different from the default ones.
+  Example: *vectorized_rng = true*.
+  Default: False
+
 vs30_tolerance:
   Used when amplification_method = convolution.
   Example: *vs30_tolerance = 20*.
@@ -1043,6 +1084,10 @@ class OqParam(valid.ParamSet):
     export_dir = valid.Param(valid.utf8, '.')
     exports = valid.Param(valid.export_formats, ())
     extreme_gmv = valid.Param(valid.floatdict, {'default': numpy.inf})
+    gmf_by_site = valid.Param(valid.boolean, False)
+    gmf_compression = valid.Param(
+        valid.NoneOr(valid.Choice('lzf', 'gzip')), None)
+    gmf_precision = valid.Param(valid.probability, 0)
     gmf_max_gb = valid.Param(valid.positivefloat, .1)
     ground_motion_correlation_model = valid.Param(
         valid.NoneOr(valid.Choice(*GROUND_MOTION_CORRELATION_MODELS)), None)
@@ -1160,6 +1205,7 @@ class OqParam(valid.ParamSet):
     truncation_level = valid.Param(lambda s: valid.positivefloat(s) or 1E-9)
     uniform_hazard_spectra = valid.Param(valid.boolean, False)
     use_rates = valid.Param(valid.boolean, False)
+    vectorized_rng = valid.Param(valid.boolean, False)
     vs30_tolerance = valid.Param(int, 0)
     width_of_mfd_bin = valid.Param(valid.positivefloat, None)
     with_betw_ratio = valid.Param(valid.positivefloat, None)
@@ -21,7 +21,9 @@ import time
 import tempfile
 import unittest.mock as mock
 import unittest
+import numpy
 import pandas
+import shapely.geometry
 from io import BytesIO
 
 from openquake.baselib import general
@@ -555,6 +557,27 @@ class ReadGeometryTestCase(unittest.TestCase):
         self.assertEqual(len(sites_df), 55)
         print('Associated in %.1f seconds' % (t1-t0), sites_df)
 
+    def test_million_points(self):
+        # benchmark for the bulk point-in-polygon test
+        geom_df = readinput.read_mosaic_df(buffer=0)
+        rng = numpy.random.default_rng(42)
+        N = 1_000_000
+        lonlats = numpy.zeros((N, 2))
+        lonlats[:, 0] = rng.uniform(-180, 180, N)
+        lonlats[:, 1] = rng.uniform(-60, 75, N)
+        t0 = time.time()
+        codes = geolocate(lonlats, geom_df)
+        dt = time.time() - t0
+        print('Associated %d points in %.1f seconds' % (N, dt))
+        # around half of the points are inside a mosaic model
+        self.assertGreater((codes != '???').sum(), N // 3)
+        # check a few points against the scalar test
+        for i in range(0, N, N // 100):
+            point = shapely.geometry.Point(lonlats[i])
+            inside = [code for code, geom in zip(geom_df.code, geom_df.geom)
+                      if geom.contains(point)]
+            self.assertEqual(codes[i], max(inside) if inside else '???')
+
 
 class ReadRiskTestCase(unittest.TestCase):
     def test_read_station_data(self):
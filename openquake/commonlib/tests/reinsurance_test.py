@@ -233,6 +233,32 @@ event_id,policy_id,retention,claim,WXLR_metro,WXLR_rural
         del out['policy_grp']
         assert_ok(out, expected)
 
+    def test_by_policies(self):
+        # all policies at once, same numbers as in test_policy1/2/3
+        expected = _df('''\
+event_id,policy_id,retention,claim,WXLR_metro,WXLR_rural,policy_grp
+41,      1,        1078.0742,1078.0742,   0.0000,  0.0,ABC
+40,      1,        1070.1654,1070.1654,   0.0000,  0.0,ABC
+33,      1,        1017.8770,1017.8770,   0.0000,  0.0,ABC
+13,      1,         664.2781, 664.2781,   0.0000,  0.0,ABC
+ 5,      1,         661.1264, 661.1264,   0.0000,  0.0,ABC
+27,      2,         200.0000,2941.0974,2441.0974,300.0,ABC
+28,      2,         200.0000,2936.3154,2436.3154,300.0,ABC
+26,      2,         200.0000,2659.9182,2159.9182,300.0,ABC
+29,      2,         200.0000,2403.0217,1903.0217,300.0,ABC
+23,      2,         200.0000,1530.9891,1030.9891,300.0,ABC
+41,      2,         200.0000, 978.0742, 478.0742,300.0,ABC
+40,      2,         200.0000, 970.1654, 470.1654,300.0,ABC
+21,      2,         200.0000, 957.2078, 457.2078,300.0,ABC
+13,      2,         200.0000, 564.2781,  64.2781,300.0,ABC
+ 5,      2,         200.0000, 561.1264,  61.1264,300.0,ABC
+25,      3,         700.0000,8500.0000,3000.0000,4800.0,AB.''')
+        rbp = reinsurance.by_policies(
+            risk_by_event, self.policy_df, self.treaty_df)
+        self.assertEqual(list(rbp.policy_grp), list(expected.policy_grp))
+        del rbp['policy_grp'], expected['policy_grp']
+        assert_ok(rbp, expected)
+
     def test_by_cat_no_apply(self):
         expected = _df('''\
 event_id,retention,claim,WXLR_metro,WXLR_rural,CatXL_reg
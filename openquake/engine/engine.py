@@ -378,7 +378,9 @@ def run_jobs(jobctxs, concurrent_jobs=None, nodes=1, sbatch=False, precalc=False
             for jobctx in jobctxs:
                 run_calc(jobctx)
     finally:
-        if dist == 'zmq' or (dist == 'slurm' and not sbatch):
+        if dist == 'zmq' and w.keep_alive():
+            pass  # the workerpool is reused by the next jobs
+        elif dist == 'zmq' or (dist == 'slurm' and not sbatch):
             stop_workers(job_id)
     return jobctxs
 
@@ -21,7 +21,7 @@ import sys
 import operator
 from contextlib import contextmanager
 import numpy
-from scipy.spatial import cKDTree, distance
+from scipy.spatial import distance
 from scipy.interpolate import interp1d
 
 from openquake.baselib.python3compat import raise_
@@ -335,7 +335,7 @@ class SourceFilter(object):
     Filter objects have a .filter method yielding filtered sources
     and the IDs of the sites within the given maximum distance.
     Filter the sources by using `self.sitecol.within_bbox` which is
-    based on numpy.
+    based on the spatial index of the site collection.
     """
     def __init__(self, sitecol, integration_distance=default):
         self.sitecol = sitecol
@@ -443,10 +443,8 @@ class SourceFilter(object):
         return U32([len(self.close_sids(rup, trt)) for rup in rups])
 
     def _close_sids(self, lon, lat, dep, dist):
-        if not hasattr(self, 'kdt'):
-            self.kdt = cKDTree(self.sitecol.xyz)
         xyz = spherical_to_cartesian(lon, lat, dep)
-        sids = U32(self.kdt.query_ball_point(xyz, dist, eps=.001))
+        sids = U32(self.sitecol.kdt.query_ball_point(xyz, dist, eps=.001))
         sids.sort()  # for cross-platform consistency
         return sids
 
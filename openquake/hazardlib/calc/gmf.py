@@ -233,6 +233,7 @@ class GmfComputer(object):
         self.cross_correl = cross_correl or NoCrossCorrelation(
             cmaker.truncation_level)
         self.mea_tau_phi = []
+        self.mean_stds = None  # set by set_mean_stds
         self.gmv_fields = [f'gmv_{m}' for m in range(len(cmaker.imts))]
         self.mmi_index = -1
         for m, imt in enumerate(cmaker.imtls):
@@ -331,11 +332,13 @@ class GmfComputer(object):
             E = len(idxs)
             if E == 0:  # crucial for performance
                 continue
-            if mean_stds is None:
+            if conditioned:
+                ms = (mean_stds[0][g], mean_stds[1][g], mean_stds[2][g])
+            elif self.mean_stds is not None:  # computed by set_mean_stds
+                ms = self.mean_stds[g]
+            else:
                 with mmon:
                     ms = self.cmaker.get_4MN([self.ctx], gs)
-            else:  # conditioned
-                ms = (mean_stds[0][g], mean_stds[1][g], mean_stds[2][g])
             with cmon:
                 E = len(idxs)
                 result = numpy.zeros(
@@ -432,6 +435,34 @@ class GmfComputer(object):
         return gmf  # shapes (N, E)
 
 
+def set_mean_stds(computers, mmon=Monitor()):
+    """
+    Compute the mean and stddevs for a block of GmfComputers sharing the
+    same ContextMaker by concatenating the contexts of the ruptures with
+    the same magnitude, thus calling the GSIMs once per magnitude and not
+    once per rupture. The result is stored in the attribute .mean_stds of
+    each computer, an array of shape (G, 4, M, N). The random numbers are
+    still generated rupture by rupture in `compute_all`, so the GMFs do
+    not change.
+
+    :param computers: a list of (non-conditioned) GmfComputers
+    :param mmon: a Monitor for the computation of the mean and stddevs
+    """
+    groups = AccumDict(accum=[])  # (mag, dtype) -> computers
+    for computer in computers:
+        mag = U32(round(computer.ebrupture.rupture.mag * 100))
+        groups[mag, computer.ctx.dtype].append(computer)
+    for comps in groups.values():
+        ctx = numpy.concatenate([c.ctx for c in comps]).view(numpy.recarray)
+        with mmon:
+            out = comps[0].cmaker.get_mean_stds([ctx], split_by_mag=False)
+        start = 0
+        for comp in comps:
+            slc = slice(start, start + comp.N)
+            comp.mean_stds = out[:, :, :, slc].transpose(1, 0, 2, 3)
+            start = slc.stop
+
+
 # this is not used in the engine; it is still useful for usage in IPython
 # when demonstrating hazardlib capabilities
 def ground_motion_fields(rupture, sites, imts, gsim, truncation_level,
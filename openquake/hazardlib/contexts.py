@@ -16,9 +16,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import abc
 import copy
+import math
+import functools
 import time
+import zlib
+import pickle
+import hashlib
 import logging
 import warnings
 import itertools
@@ -28,11 +34,12 @@ import numpy
 import shapely
 from scipy.interpolate import interp1d
 
-from openquake.baselib import config
+from openquake.baselib import config, hdf5
 from openquake.baselib.general import (
     AccumDict, DictArray, RecordBuilder, split_in_slices, block_splitter,
     sqrscale)
-from openquake.baselib.performance import Monitor, split_array, kround0, compile
+from openquake.baselib.performance import (
+    Monitor, split_array, idx_start_stop, kround0, compile)
 from openquake.baselib.python3compat import decode
 from openquake.hazardlib import valid, imt as imt_module
 from openquake.hazardlib.const import StdDev, OK_COMPONENTS
@@ -58,6 +65,13 @@ TWO20 = 2**20
 TWO16 = 2**16
 TWO24 = 2**24
 TWO32 = 2**32
+# scalar source parameters entering in the key of the contexts cache
+SRC_PARAMS = ('source_id', 'checksum', 'tectonic_region_type',
+              'rupture_mesh_spacing', 'rupture_aspect_ratio',
+              'upper_seismogenic_depth', 'lower_seismogenic_depth',
+              'dip', 'rake', 'area_discretization', 'investigation_time',
+              'infer_occur_rates', 'scaling_rate')
+CTXS_CACHE = 'ctxs'  # subdirectory of the cachedir containing the contexts
 STD_TYPES = (StdDev.TOTAL, StdDev.INTER_EVENT, StdDev.INTRA_EVENT)
 KNOWN_DISTANCES = frozenset('''rrup rx_ry0 rx ry0 rjb rhypo repi rcdpp azimuth
 azimuthcp rvolc clon_clat clon clat'''.split())
@@ -65,6 +79,11 @@ NUM_BINS = 256
 DIST_BINS = sqrscale(80, 1000, NUM_BINS)
 MEA = 0
 STD = 1
+# distances and rupture parameters managed by genctxs_mf
+MF_DISTANCES = {'rrup', 'rjb', 'rx', 'ry0'}
+MF_RUPPARAMS = {'mag', 'strike', 'dip', 'rake', 'ztor', 'width', 'zbot'}
+MF_MAXSIZE = 1_000_000  # max number of (section, site) distances per chunk
+SQRT05 = math.sqrt(0.5)
 bymag = operator.attrgetter('mag')
 # These coordinates were provided by M Gerstenberger (personal
 # communication, 10 August 2018)
@@ -321,6 +340,94 @@ def simple_cmaker(gsims, imts, **params):
     return ContextMaker('*', gsims, dic)
 
 
+def purge_ctxs_cache(ctxs_cachedir, maxsize=0):
+    """
+    Remove the least recently used files in the contexts cache until
+    the total size is below maxsize (by default remove everything)
+
+    :param ctxs_cachedir: the directory containing the ctxs_<key>.hdf5 files
+    :param maxsize: the maximum size in bytes of the cache
+    :returns: the number of removed files
+    """
+    if not os.path.exists(ctxs_cachedir):
+        return 0
+    files = []
+    for fname in os.listdir(ctxs_cachedir):
+        if fname.startswith('ctxs_'):
+            st = os.stat(os.path.join(ctxs_cachedir, fname))
+            files.append((st.st_mtime, st.st_size, fname))
+    totsize = sum(size for _, size, _ in files)
+    removed = 0
+    for _mtime, size, fname in sorted(files):  # oldest first
+        if totsize <= maxsize:
+            break
+        try:
+            os.remove(os.path.join(ctxs_cachedir, fname))
+        except FileNotFoundError:  # removed by a concurrent job
+            pass
+        totsize -= size
+        removed += 1
+    return removed
+
+
+def get_src_arrays(src):
+    """
+    :param src: a (split) source
+    :returns: the scalar parameters and the arrays identifying the
+              ruptures of the source, used in the key of the contexts cache
+    """
+    params = [type(src).__name__] + [
+        getattr(src, name, None) for name in SRC_PARAMS]
+    params.append(str(getattr(src, 'magnitude_scaling_relationship', None)))
+    tom = getattr(src, 'temporal_occurrence_model', None)
+    params.append((type(tom).__name__, getattr(tom, 'time_span', None)))
+    if src.code == b'F':  # multifault, the sections are in sections_sha1
+        idxs = src.rupture_idxs
+        return params, [src.mags, src.rakes, src.probs_occur,
+                        U32([len(idx) for idx in idxs]),
+                        numpy.concatenate(idxs)]
+    elif src.code == b'N':  # nonparametric
+        arrays = []
+        for rup, pmf in src.data:
+            hypo = rup.hypocenter
+            arrays.append(F64([rup.mag, rup.rake, hypo.x, hypo.y, hypo.z] +
+                              list(rup.surface.get_bounding_box()) +
+                              [prob for prob, _ in pmf.data]))
+        return params, arrays
+    arrays = [F64(src.get_annual_occurrence_rates())]
+    if hasattr(src, 'nodal_plane_distribution'):  # point-like sources
+        arrays.append(F64([(prob, np.strike, np.dip, np.rake) for prob, np
+                           in src.nodal_plane_distribution.data]))
+        arrays.append(F64(src.hypocenter_distribution.data))
+    if hasattr(src, 'pdata'):  # collapsed point source
+        arrays.append(src.pdata['array'])
+    if hasattr(src, 'location'):
+        loc = src.location
+        arrays.append(F64([loc.x, loc.y, loc.z]))
+    elif hasattr(src, 'mesh'):  # multipoint
+        arrays.extend([src.mesh.lons, src.mesh.lats])
+    else:
+        poly = src.polygon
+        arrays.extend([poly.lons, poly.lats])
+    for name in ('hypo_list', 'slip_list'):
+        if len(getattr(src, name, ())):
+            arrays.append(F64(getattr(src, name)))
+    return params, arrays
+
+
+@functools.lru_cache()
+def sections_sha1(hdf5path):
+    """
+    :param hdf5path: the file containing the multi_fault_sections
+    :returns: the sha1 of the sections, computed once per file
+    """
+    sha = hashlib.sha1()
+    with hdf5.File(hdf5path, 'r') as h5:
+        for geom in h5['multi_fault_sections'][()]:  # vlen arrays
+            sha.update(geom.tobytes())
+    return sha.hexdigest()
+
+
 # ############################ genctxs ################################## #
 
 # generator of quartets (rup_index, mag, planar_array, sites)
@@ -501,6 +608,170 @@ def _build_dparam(src, sitecol, cmaker):
     return out
 
 
+def _split_secs(nsecs, maxsecs):
+    # split the ruptures in chunks with around maxsecs sections each
+    cumsecs = numpy.cumsum(nsecs) - nsecs
+    return idx_start_stop(cumsecs // max(maxsecs, 1))
+
+
+@compile("float64[:](float64[:, :], int64[:], int64[:], int64[:], int64[:])")
+def _min_secs(dists, rows, kstarts, counts, sids):
+    # minimum distance over the sections of each (rupture, site) pair
+    out = numpy.empty(len(sids))
+    for p, sid in enumerate(sids):
+        start = kstarts[p]
+        out[p] = dists[rows[start], sid]
+        for k in range(start + 1, start + counts[p]):
+            out[p] = min(out[p], dists[rows[k], sid])
+    return out
+
+
+@compile("float32[:, :](float32[:, :, :, :], int64[:], uint8[:], float32[:],"
+         "int64[:], int64[:], int64[:])")
+def _sum_tuw(tuws, krows, kflip, kshift, kstarts, counts, sids):
+    # sum over the sections of each (rupture, site) pair in the same
+    # order as multiline.get_tu, to get the same float32 roundings
+    out = numpy.zeros((3, len(sids)), numpy.float32)
+    for p, sid in enumerate(sids):
+        start = kstarts[p]
+        for k in range(start, start + counts[p]):
+            t, u, w = tuws[krows[k], sid, kflip[k]]
+            out[0, p] += t * w
+            out[1, p] += (u + kshift[k]) * w
+            out[2, p] += w
+    return out
+
+
+def _concat_ctxs(ctxs):
+    return numpy.concatenate(ctxs).view(numpy.recarray)
+
+
+def mf_batchable(cmaker):
+    """
+    :returns: True if the contexts of multifault sources can be built
+              with :func:`genctxs_mf`
+    """
+    return (cmaker.mf_batch and not cmaker.fewsites and
+            cmaker.REQUIRES_DISTANCES <= MF_DISTANCES and
+            cmaker.REQUIRES_RUPTURE_PARAMETERS <= MF_RUPPARAMS)
+
+
+def genctxs_mf(src, sitecol, cmaker):
+    """
+    Context generator for multifault sources. The ruptures are never
+    instantiated: the distances are obtained by reducing the section
+    distances over the CSR matrix rupture -> sections, working on chunks
+    of ruptures with the same magnitude.
+    """
+    minmag = cmaker.maximum_distance.x[0]
+    maxmag = cmaker.maximum_distance.x[-1]
+    dists = cmaker.REQUIRES_DISTANCES
+    with cmaker.ir_mon:
+        msparams = src.msparams
+        close, = numpy.where(msparams['area'] > 0)
+        mags = src.mags[close]
+        ok = (mags > minmag) & (mags < maxmag)
+        order = numpy.argsort(mags[ok], kind='stable')
+        ridxs = close[ok][order]  # rupture indices sorted by magnitude
+        rup_ids = src.offset + numpy.arange(len(close))[ok][order]
+        cmaker.num_rups = len(ridxs)
+        if cmaker.num_rups == 0:
+            return
+        rupture_idxs = src.rupture_idxs[ridxs]
+        nsecs = numpy.array([len(idxs) for idxs in rupture_idxs])
+        allsecs = numpy.concatenate(rupture_idxs)
+        uidxs = numpy.unique(allsecs)
+        secrows = numpy.searchsorted(uidxs, allsecs)  # flat CSR indices
+        offsets = numpy.cumsum(nsecs) - nsecs
+
+    with cmaker.sec_mon:
+        sections = src.get_sections(uidxs)
+        rrups = numpy.array([get_dparam(sec, sitecol, 'rrup')
+                             for sec in sections])  # shape (S, N)
+        if 'rjb' in dists:
+            rjbs = F64([get_dparam(sec, sitecol, 'rjb')
+                        for sec in sections])
+        if 'rx' in dists or 'ry0' in dists:
+            tors = [sec.tor for sec in sections]
+            tuws = F32([get_dparam(sec, sitecol, 'tuw')
+                        for sec in sections])  # shape (S, N, 2, 3)
+
+    dd = cmaker.defaultdict.copy()
+    if src.infer_occur_rates:
+        occur_rates = src.occur_rates[ridxs]
+        dd['probs_occur'] = numpy.zeros(0)
+    else:
+        probs_occur = src.probs_occur[ridxs]
+        dd['probs_occur'] = numpy.zeros(probs_occur.shape[1])
+    builder = RecordBuilder(**dd)
+    siteparams = [par for par in sitecol.array.dtype.names if par in dd]
+    rparams = {'mag': numpy.round(src.mags[ridxs], 3),
+               'rake': src.rakes[ridxs]}
+    for par in MF_RUPPARAMS - set(rparams):
+        rparams[par] = msparams[par][ridxs]
+    u_max = msparams['u_max'][ridxs]
+    N = len(sitecol)
+    for _, mstart, mstop in idx_start_stop(U32(src.mags[ridxs] * 100)):
+        magdist = cmaker.maximum_distance(src.mags[ridxs[mstart]])
+        for _, cstart, cstop in _split_secs(
+                nsecs[mstart:mstop], MF_MAXSIZE // N):
+            rs = numpy.arange(mstart + cstart, mstart + cstop)
+            start, stop = offsets[rs[0]], offsets[rs[-1]] + nsecs[rs[-1]]
+            rows = secrows[start:stop]
+            rrup = numpy.minimum.reduceat(
+                rrups[rows], offsets[rs] - start)  # shape (R, N)
+            ri, si = (rrup <= magdist).nonzero()
+            if len(ri) == 0:
+                continue
+            ctx = builder.zeros(len(ri))
+            ctx.rrup = rrup[ri, si]
+            # sections for each (rupture, site) pair
+            counts = nsecs[rs][ri]
+            kstarts = offsets[rs][ri] - start
+            if 'rjb' in dists:
+                ctx.rjb = _min_secs(rjbs, rows, kstarts, counts, si)
+            if 'rx' in dists or 'ry0' in dists:
+                # reorder and flip the sections as in MultiLine.get_tu
+                krows = rows.copy()
+                kflip = numpy.zeros(len(rows), U8)
+                kshift = numpy.zeros(len(rows), F32)
+                for r in numpy.unique(ri):
+                    n = offsets[rs[r]] - start
+                    slc = slice(n, n + nsecs[rs[r]])
+                    ml = multiline.MultiLine([tors[row] for row in rows[slc]])
+                    krows[slc] = rows[slc][ml.soidx]
+                    kflip[slc] = ml.flipped[ml.soidx]
+                    kshift[slc] = ml.shift
+                tw, uw, ws = _sum_tuw(
+                    tuws, krows, kflip, kshift, kstarts, counts, si)
+                if 'rx' in dists:
+                    ctx.rx = tw / ws
+                if 'ry0' in dists:
+                    us = uw / ws
+                    umax = u_max[rs][ri]
+                    ctx.ry0 = numpy.where(
+                        us < 0, numpy.abs(us),
+                        numpy.where(us > umax, us - umax, 0))
+            idx = rs[ri]
+            for par in cmaker.REQUIRES_RUPTURE_PARAMETERS:
+                ctx[par] = rparams[par][idx]
+            if src.infer_occur_rates:
+                ctx.occurrence_rate = occur_rates[idx]
+            else:
+                ctx.occurrence_rate = numpy.nan
+                ctx.probs_occur = probs_occur[idx]
+            for par in siteparams:
+                ctx[par] = sitecol.array[par][si]
+            ctx.src_id = src.id
+            if src.id >= 0:
+                ctx.rup_id = rup_ids[idx]
+            if cmaker.minimum_distance:
+                for name in dists:
+                    ctx[name][ctx[name] < cmaker.minimum_distance] = (
+                        cmaker.minimum_distance)
+            yield ctx
+
+
 # this is the critical function for the performance of the classical calculator
 # the performance is dominated by the CPU cache, i.e. large arrays are slow
 # the only way to speedup is to reduce the maximum_distance, then the array
@@ -515,6 +786,35 @@ def _set_poes(mean_std, loglevels, phi_b, out):
         for lvl, iml in enumerate(levels):
             out[mL1 + lvl] = truncnorm_sf(phi_b, (iml - mea) / std)
 
+
+# fused version of set_poes + MapArray.update_indep used in the regular case
+# (poissonian ruptures, no mixture models, no amplification): the PoEs are
+# computed level by level and multiplied into the map without storing them
+@compile("(float32[:,:,:], float64[:,:,:,:], float64[:,:], float64, "
+         "float64[:], uint32[:], float64, boolean)")
+def _update_fused(arr, mean_std, loglevels, phi_b, rates, sidxs, itime,
+                  use_rates):
+    G = mean_std.shape[1]
+    M, L1 = loglevels.shape
+    z = phi_b * 2. - 1.
+    for i in range(len(sidxs)):
+        sidx = sidxs[i]
+        rit = rates[i] * itime
+        for g in range(G):
+            for m in range(M):
+                mea = mean_std[MEA, g, m, i]
+                std = mean_std[STD, g, m, i]
+                mL1 = m * L1
+                for lvl in range(L1):
+                    # same as truncnorm_sf, rounded to float32 as in set_poes
+                    x = (loglevels[m, lvl] - mea) / std
+                    sf = (phi_b - .5 * (1. + math.erf(x * SQRT05))) / z
+                    poe = numpy.float32(min(max(sf, 0.), 1.))
+                    if use_rates:
+                        arr[sidx, mL1 + lvl, g] += rit * poe
+                    else:
+                        arr[sidx, mL1 + lvl, g] *= math.exp(-rit * poe)
+
 # ############################ ContextMaker ############################### #
 
 
@@ -552,6 +852,8 @@ class ContextMaker(object):
     deltagetter = None
     fewsites = False
     tom = None
+    fused = True  # use the fused kernel in .update when possible
+    mf_batch = True  # use genctxs_mf for multifault sources when possible
 
     def __init__(self, trt, gsims, oq, monitor=Monitor(), extraparams=()):
         self.trt = trt
@@ -607,6 +909,11 @@ class ContextMaker(object):
         elif not hasattr(self, 'imtls'):
             raise KeyError('Missing imtls in ContextMaker!')
         self.cache_distances = param.get('cache_distances', False)
+        # the contexts are cached only if a cache directory is set
+        # (i.e. with --reuse-input)
+        cachedir = param.get('cachedir', '')
+        self.ctxs_cachedir = (os.path.join(cachedir, CTXS_CACHE)
+                              if self.cache_distances and cachedir else '')
         self.max_sites_disagg = param.get('max_sites_disagg', 10)
         self.time_per_task = param.get('time_per_task', 60)
         self.collapse_level = int(param.get('collapse_level', -1))
@@ -690,6 +997,7 @@ class ContextMaker(object):
         self.ctx_mon = monitor('nonplanar contexts', measuremem=False)
         self.gmf_mon = monitor('computing mean_std', measuremem=False)
         self.poe_mon = monitor('get_poes', measuremem=False)
+        self.cache_mon = monitor('reading cached contexts', measuremem=False)
         self.ir_mon = monitor('iter_ruptures', measuremem=False)
         self.sec_mon = monitor('building dparam', measuremem=True)
         self.delta_mon = monitor('getting delta_rates', measuremem=False)
@@ -920,10 +1228,8 @@ class ContextMaker(object):
                     # this is really expensive
                     lons = rup.surface.mesh.lons.flatten()
                     lats = rup.surface.mesh.lats.flatten()
-                    points_in_polygon = (
-                        shapely.geometry.Point(lon, lat).within(cshm_polygon)
-                        for lon, lat in zip(lons, lats))
-                    value = any(points_in_polygon)
+                    value = shapely.contains_xy(
+                        cshm_polygon, lons, lats).any()
                 else:
                     value = False
             elif param == 'zbot':
@@ -1045,6 +1351,12 @@ class ContextMaker(object):
 
         if getattr(src, 'location', None) and step == 1:
             return self.pla_mon.iter(genctxs_Pp(src, sitecol, self))
+        elif (getattr(src, 'code', None) == b'F' and step == 1 and
+              mf_batchable(self)):
+            self.dparam = None
+            ctxs = genctxs_mf(src, sitecol, self)
+            blocks = block_splitter(ctxs, 10_000, weight=len)
+            return self.ctx_mon.iter(map(_concat_ctxs, blocks))
         elif hasattr(src, 'source_id'):  # other source
             if src.code == b'F' and step == 1:
                 with self.sec_mon:
@@ -1078,6 +1390,66 @@ class ContextMaker(object):
         # the weight of 10_000 ensure less than 1MB per block (recarray)
         return self.ctx_mon.iter(map(self.recarray, blocks))
 
+    def ctxs_key(self, src, sitecol):
+        """
+        :param src: a source object (already split)
+        :param sitecol: a (filtered) SiteCollection
+        :returns: a content-based key for the contexts of the source
+        """
+        # clon and clat are added to the defaultdict by get_ctx_iter
+        # depending on max_sites_disagg and on the number of sites
+        fields = sorted(set(self.defaultdict) - {'clon', 'clat'})
+        params = (self.trt, fields, self.minimum_distance,
+                  self.pointsource_distance, self.max_sites_disagg,
+                  len(sitecol.complete), self.ps_grid_spacing,
+                  self.shift_hypo, self.mf_batch)
+        srcparams, arrays = get_src_arrays(src)
+        # the maximum distance is an interp1d object and the reqv
+        # an RjbEquivalent object, so their arrays are used in the key
+        maxdist = self.maximum_distance
+        if hasattr(maxdist, 'x'):
+            arrays.extend([F64(maxdist.x), F64(maxdist.y)])
+        else:
+            arrays.append(F64(maxdist))
+        reqv = self.reqv.get(self.trt) if self.reqv else None
+        if reqv is not None:
+            arrays.extend([reqv.repi, reqv.mags, reqv.reqv])
+        sha = hashlib.sha1(repr((params, srcparams)).encode('utf8'))
+        for arr in arrays:
+            sha.update(numpy.ascontiguousarray(arr).tobytes())
+        if src.code == b'F':
+            # the hdf5path of multifault sources changes at each
+            # calculation, so the content of the sections is used instead
+            sha.update(sections_sha1(src.hdf5path).encode('ascii'))
+        sha.update(sitecol.array.tobytes())
+        return sha.hexdigest()
+
+    def get_cached_ctxs(self, src, sitecol):
+        """
+        :param src: a source object (already split)
+        :param sitecol: a (filtered) SiteCollection
+        :returns: a list of context arrays, read from the file
+            ctxs_<key>.hdf5 in the cache directory if it exists, otherwise
+            computed with .get_ctx_iter and stored there
+        """
+        fname = 'ctxs_%s.hdf5' % self.ctxs_key(src, sitecol)
+        path = os.path.join(self.ctxs_cachedir, fname)
+        if os.path.exists(path):
+            with self.cache_mon, hdf5.File(path, 'r') as h5:
+                data = h5['ctxs'][()]
+            os.utime(path)  # mark as recently used, see purge_ctxs_cache
+            return pickle.loads(zlib.decompress(data.tobytes()))
+        os.makedirs(self.ctxs_cachedir, exist_ok=True)
+        ctxs = list(self.get_ctx_iter(src, sitecol))
+        data = zlib.compress(pickle.dumps(ctxs, pickle.HIGHEST_PROTOCOL))
+        # write on a temporary file and then rename, since the same
+        # contexts could be stored by concurrent tasks
+        tmp = '%s.%d' % (path, os.getpid())
+        with hdf5.File(tmp, 'w') as h5:
+            h5['ctxs'] = numpy.frombuffer(data, U8)
+        os.replace(tmp, path)
+        return ctxs
+
     def max_intensity(self, sitecol1, mags, dists):
         """
         :param sitecol1: a SiteCollection instance with a single site
@@ -1198,12 +1570,56 @@ class ContextMaker(object):
         pmap = self.get_pmap(self.from_srcs(srcgroup, sitecol))
         return (~pmap).to_rates()
 
+    def fusable(self, ctx):
+        """
+        :param ctx: a context array
+        :returns: True if the fused kernel can be used for the context
+        """
+        if not self.fused or self.oq.af or getattr(self, 'cluster', 0):
+            return False
+        probs_occur = ctx.probs_occur
+        if probs_occur.ndim != 2 or probs_occur.shape[1]:
+            return False  # nonparametric ruptures
+        for gsim in self.gsims:
+            if (hasattr(gsim, 'weights_signs') or
+                    hasattr(gsim, 'mixture_model') or
+                    hasattr(gsim, 'weights')):
+                return False
+            imtweight = getattr(gsim, 'weight', None)
+            if imtweight and any(imtweight.dic.get(imt) == 0
+                                 for imt in self.imtls):
+                return False
+        return True
+
+    def update_fused(self, pmap, ctx):
+        """
+        Update the probability map without building the PoEs array
+
+        :param pmap: probability map to update
+        :param ctx: a context array with poissonian ruptures
+        """
+        loglevels = self.loglevels.array
+        ctx.mag = numpy.round(ctx.mag, 3)
+        for mag in numpy.unique(ctx.mag):
+            ctxt = ctx[ctx.mag == mag]
+            self.cfactor += [len(ctxt), 1]
+            with self.gmf_mon:
+                mean_stdt = self.get_mean_stds([ctxt], split_by_mag=False)
+            with self.poe_mon:
+                _update_fused(pmap.array, mean_stdt[:2], loglevels,
+                              self.phi_b, ctxt.occurrence_rate,
+                              pmap.sidx[ctxt.sids], self.tom.time_span,
+                              pmap.rates)
+
     def update(self, pmap, ctx, rup_mutex=None):
         """
         :param pmap: probability map to update
         :param ctx: a context array
         :param rup_mutex: dictionary (src_id, rup_id) -> weight
         """
+        if not rup_mutex and self.fusable(ctx):
+            self.update_fused(pmap, ctx)
+            return
         for poes, mea, sig, ctxt in self.gen_poes(ctx):
             if rup_mutex:
                 pmap.update_mutex(poes, ctxt, self.tom.time_span, rup_mutex)
@@ -1233,17 +1649,23 @@ class ContextMaker(object):
             recarr = numpy.concatenate(
                 recarrays, dtype=recarrays[0].dtype).view(numpy.recarray)
             recarrays = split_array(recarr, U32(numpy.round(recarr.mag*100)))
+        # GSIMs with the same base_key share the computation of the base
+        nbase = collections.Counter(
+            getattr(gsim, 'base_key', None) for gsim in self.gsims)
+        bases = {}  # base_key -> mean and stddevs of the base GSIM
         for g, gsim in enumerate(self.gsims):
-            out[:, g] = self.get_4MN(recarrays, gsim)
+            key = getattr(gsim, 'base_key', None)
+            if key is None or nbase[key] == 1:
+                out[:, g] = self.get_4MN(recarrays, gsim)
+                continue
+            if key not in bases:
+                bases[key] = numpy.zeros((4, M, N))
+                self._compute(recarrays, gsim.gmpe, bases[key])
+            out[:, g] = self.get_4MN(recarrays, gsim, bases[key])
         return out
 
-    def get_4MN(self, ctxs, gsim):
-        """
-        Called by the GmfComputer
-        """
-        N = sum(len(ctx) for ctx in ctxs)
-        M = len(self.imts)
-        out = numpy.zeros((4, M, N))
+    def _compute(self, ctxs, gsim, out):
+        # fill the array out of shape (4, M, N) by calling gsim.compute
         gsim.adj = []  # NSHM2014P adjustments
         compute = gsim.__class__.compute
         start = 0
@@ -1253,6 +1675,28 @@ class ContextMaker(object):
             if adj is not None:
                 gsim.adj.append(adj)
             start = slc.stop
+
+    def get_4MN(self, ctxs, gsim, base=None):
+        """
+        Called by the GmfComputer
+
+        :param ctxs: a list of context arrays
+        :param gsim: a GSIM instance
+        :param base: if given, the mean and stddevs of gsim.gmpe
+        :returns: an array of shape (4, M, N)
+        """
+        if base is None:
+            N = sum(len(ctx) for ctx in ctxs)
+            out = numpy.zeros((4, len(self.imts), N))
+            self._compute(ctxs, gsim, out)
+        else:  # cheap transformation of the base mean and stddevs
+            out = base.copy()
+            gsim.adj = []
+            start = 0
+            for ctx in ctxs:
+                slc = slice(start, start + len(ctx))
+                gsim.transform(ctx, self.imts, *out[:, :, slc])
+                start = slc.stop
         if self.truncation_level not in (0, 1E-9, 99.) and (out[1] == 0.).any():
             raise ValueError('Total StdDev is zero for %s' % gsim)
         if gsim.adj:
@@ -1515,7 +1959,11 @@ class PmapMaker(object):
         sites = self.srcfilter.get_close_sites(src)
         if sites is None:
             return
-        for ctx in self.cmaker.get_ctx_iter(src, sites):
+        if self.cmaker.ctxs_cachedir:
+            ctxs = self.cmaker.get_cached_ctxs(src, sites)
+        else:
+            ctxs = self.cmaker.get_ctx_iter(src, sites)
+        for ctx in ctxs:
             if self.cmaker.deltagetter:
                 # adjust occurrence rates in case of aftershocks
                 with self.cmaker.delta_mon:
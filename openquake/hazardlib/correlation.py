@@ -19,6 +19,54 @@ spatially-distributed ground-shaking intensities.
 """
 import abc
 import numpy
+from scipy import sparse
+from scipy.linalg import cholesky_banded
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from scipy.spatial import cKDTree
+from openquake.hazardlib.geo.geodetic import spherical_to_cartesian
+
+
+def wendland(ratio):
+    """
+    Wendland taper, a compactly supported positive definite function
+    in 3D, equal to 1 for ratio=0 and to 0 for ratio >= 1
+    """
+    r = numpy.clip(ratio, 0., 1.)
+    return (1. - r)**4 * (4. * r + 1.)
+
+
+def sparse_lower_triangle(corrfunc, sites, cutoff):
+    """
+    Build a sparse correlation matrix for the given sites, by tapering
+    the correlation function to zero beyond the cutoff distance, and
+    factorize it after a reverse Cuthill-McKee reordering reducing the
+    bandwidth. The tapered matrix is still positive definite.
+
+    :param corrfunc: a function distances -> correlation coefficients
+    :param sites: a (possibly filtered) SiteCollection with N sites
+    :param cutoff: a distance in km
+    :returns: (L, perm) where perm is a permutation of the N sites and L is
+        a sparse lower triangular matrix such that L @ L.T is the correlation
+        matrix of the permuted sites
+    """
+    N = len(sites)
+    xyz = spherical_to_cartesian(sites['lon'], sites['lat'])
+    ij = cKDTree(xyz).query_pairs(cutoff, output_type='ndarray')
+    dists = numpy.sqrt(((xyz[ij[:, 0]] - xyz[ij[:, 1]])**2).sum(axis=1))
+    vals = corrfunc(dists) * wendland(dists / cutoff)
+    diag = numpy.arange(N)
+    corr = sparse.csr_matrix(
+        (numpy.concatenate([vals, vals, numpy.ones(N)]),
+         (numpy.concatenate([ij[:, 0], ij[:, 1], diag]),
+          numpy.concatenate([ij[:, 1], ij[:, 0], diag]))), shape=(N, N))
+    perm = reverse_cuthill_mckee(corr, symmetric_mode=True)
+    low = sparse.tril(corr[perm][:, perm]).tocoo()
+    # store the lower band as ab[k, j] = corr[j + k, j]
+    ab = numpy.zeros((int((low.row - low.col).max()) + 1, N))
+    ab[low.row - low.col, low.col] = low.data
+    cb = cholesky_banded(ab, lower=True)
+    L = sparse.dia_matrix((cb, -numpy.arange(len(cb))), shape=(N, N))
+    return L.tocsr(), perm
 
 
 class BaseCorrelationModel(metaclass=abc.ABCMeta):
@@ -26,6 +74,21 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
     Base class for correlation models for spatially-distributed ground-shaking
     intensities.
     """
+    cutoff = 0  # if positive, use a sparse tapered correlation matrix
+
+    def _apply_sparse(self, sites, imt, residuals):
+        # apply the tapered correlation computed on the sites; the factor
+        # is cached and reused as long as the sites do not change
+        sids, L, perm = self.cache.get((imt, 'sparse'), (None, None, None))
+        if sids is None or not numpy.array_equal(sids, sites.sids):
+            L, perm = sparse_lower_triangle(
+                lambda dists: self._get_correlation_matrix(dists, imt),
+                sites, self.cutoff)
+            self.cache[imt, 'sparse'] = sites.sids, L, perm
+        out = numpy.zeros_like(residuals)
+        out[perm] = L @ residuals[perm]
+        return out
+
     def apply_correlation(self, sites, imt, residuals, stddev_intra=0):
         """
         Apply correlation to randomly sampled residuals.
@@ -49,7 +112,11 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
         NB: the correlation matrix is cached. It is computed only once
         per IMT for the complete site collection and then the portion
         corresponding to the sites is multiplied by the residuals.
+        If a cutoff is set, a sparse correlation matrix is computed
+        only for the given sites instead.
         """
+        if self.cutoff:
+            return self._apply_sparse(sites, imt, residuals)
         # intra-event residual for a single relization is a product
         # of lower-triangle decomposed correlation matrix and vector
         # of N random numbers (where N is equal to number of sites).
@@ -84,9 +151,14 @@ class JB2009CorrelationModel(BaseCorrelationModel):
         Boolean value to indicate whether "Case 1" or "Case 2" from page 1700
         should be applied. ``True`` value means that Vs 30 values show or are
         expected to show clustering ("Case 2"), ``False`` means otherwise.
+    :param cutoff:
+        If positive, distance in km beyond which the correlation is tapered
+        to zero, so that a sparse correlation matrix can be used for large
+        site collections.
     """
-    def __init__(self, vs30_clustering):
+    def __init__(self, vs30_clustering, cutoff=0):
         self.vs30_clustering = vs30_clustering
+        self.cutoff = cutoff
         self.cache = {}  # imt -> correlation model
 
     def _get_correlation_matrix(self, sites, imt):
@@ -160,9 +232,13 @@ class HM2018CorrelationModel(BaseCorrelationModel):
         Value to be multiplied by the uncertainty in the correlation parameter
         beta. If uncertainty_multiplier = 0 (default), the median value is
         used as a constant value.
+    :param cutoff:
+        If positive, distance in km beyond which the correlation is tapered
+        to zero (used only if uncertainty_multiplier = 0).
     """
-    def __init__(self, uncertainty_multiplier=0):
+    def __init__(self, uncertainty_multiplier=0, cutoff=0):
         self.uncertainty_multiplier = uncertainty_multiplier
+        self.cutoff = cutoff
         self.distance_matrix = {}
         self.cache = {}
 
@@ -188,6 +264,9 @@ class HM2018CorrelationModel(BaseCorrelationModel):
             # For this, every row of 'residuals' (every site) is divided by its
             # corresponding standard deviation element.
             residuals_norm = residuals / stddev_intra[:, None]
+            if self.cutoff:
+                return stddev_intra[:, None] * self._apply_sparse(
+                    sites, imt, residuals_norm)
 
             # Lower diagonal of the Cholesky decomposition
             # Note that instead of computing the whole correlation matrix
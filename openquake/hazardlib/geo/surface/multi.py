@@ -63,10 +63,60 @@ def build_secparams(sections):
     return secparams
 
 
-# not fast
+def _build_lines(secparams):
+    lines = []
+    for secparam in secparams:
+        tl0, tl1, tr0, tr1 = secparam[['tl0', 'tl1', 'tr0', 'tr1']]
+        line = geo.Line.from_coo(np.array([[tl0, tl1], [tr0, tr1]], float))
+        lines.append(line)
+    return lines
+
+
+# not fast, parallelized in preclassical
+def build_u_max(rupture_idxs, secparams):
+    """
+    :param rupture_idxs: a list of arrays of section indices
+    :param secparams: an array of section parameters
+    :returns: the u_max parameter for each rupture as an array of float32
+    """
+    lines = _build_lines(secparams)
+    return np.array([geo.MultiLine([lines[idx] for idx in idxs]).get_u_max()
+                     for idxs in rupture_idxs], F32)
+
+
+def _bounding_boxes(secparam, starts):
+    # bounding boxes of the ruptures, i.e. of the segments in secparam
+    # starting at the given indices
+    lons = np.concatenate([secparam['west'], secparam['east']])
+    lats = np.concatenate([secparam['north'], secparam['south']])
+    twostarts = np.concatenate([starts, starts + len(secparam)])
+    R = len(starts)
+    west = np.minimum.reduceat(lons, twostarts)
+    east = np.maximum.reduceat(lons, twostarts)
+    north = np.maximum.reduceat(lats, twostarts)
+    south = np.minimum.reduceat(lats, twostarts)
+    bbs = np.array([np.minimum(west[:R], west[R:]),
+                    np.maximum(east[:R], east[R:]),
+                    np.maximum(north[:R], north[R:]),
+                    np.minimum(south[:R], south[R:])])
+    # ruptures crossing the international date line, very rare
+    stops = np.append(starts[1:], len(secparam))
+    for r in np.where(utils.get_longitudinal_extent(bbs[0], bbs[1]) < 0)[0]:
+        sp = secparam[starts[r]:stops[r]]
+        bbs[:, r] = utils.get_spherical_bounding_box(
+            np.concatenate([sp['west'], sp['east']]),
+            np.concatenate([sp['north'], sp['south']]))
+    return bbs
+
+
 def build_msparams(rupture_idxs, secparams, close_sec=None, ry0=False,
-                   mon1=Monitor(), mon2=Monitor()):
+                   mon1=Monitor(), mon2=Monitor(), u_max=None):
     """
+    :param rupture_idxs: a list of arrays of section indices
+    :param secparams: an array of section parameters
+    :param close_sec: a boolean mask on the sections (or None)
+    :param ry0: if True, set also the u_max parameter
+    :param u_max: if not None, the precomputed u_max for each rupture
     :returns: a structured array of parameters
     """
     U = len(rupture_idxs)  # number of ruptures
@@ -75,47 +125,50 @@ def build_msparams(rupture_idxs, secparams, close_sec=None, ry0=False,
         # NB: in the engine close_sec is computed in the preclassical phase
         close_sec = np.ones(len(secparams), bool)
 
-    # building lines, very fast
-    with mon1:
-        lines = []
-        for secparam in secparams:
-            tl0, tl1, tr0, tr1 = secparam[['tl0', 'tl1', 'tr0', 'tr1']]
-            line = geo.Line.from_coo(np.array([[tl0, tl1], [tr0, tr1]], float))
-            lines.append(line)
-
-    # building msparams, slow due to the computation of u_max
+    # building the segmented arrays rupture -> close sections
+    nsecs = np.array([len(idxs) for idxs in rupture_idxs])
+    allidxs = np.concatenate(rupture_idxs)
+    ok = close_sec[allidxs]
+    rids = np.repeat(np.arange(U), nsecs)[ok]
+    counts = np.bincount(rids, minlength=U)
+    nz = counts > 0  # ruptures with at least a close section
+    if not nz.any():  # all sections are far away
+        return msparams
+    starts = (np.cumsum(counts) - counts)[nz]
+    secparam = secparams[allidxs[ok]]
+
+    # building u_max, slow
+    if ry0:
+        with mon1:
+            if u_max is None:
+                todo = nz
+            else:
+                # ruptures with discarded sections need a new u_max
+                full = counts == nsecs
+                msparams['u_max'][full] = u_max[full]
+                todo = nz & ~full
+            if todo.any():
+                idxs = np.split(allidxs[ok], np.cumsum(counts)[:-1])
+                msparams['u_max'][todo] = build_u_max(
+                    [idxs[r] for r in np.where(todo)[0]], secparams)
+
+    # building simple multisurface params, vectorized
     with mon2:
-        for msparam, idxs in zip(msparams, rupture_idxs):
-            idxs = idxs[close_sec[idxs]]
-            if len(idxs) == 0:  # all sections are far away
-                continue
-
-            # building u_max
-            tors = [lines[idx] for idx in idxs]
-            if ry0:
-                msparam['u_max'] = geo.MultiLine(tors).get_u_max()
-
-            # building simple multisurface params
-            secparam = secparams[idxs]
-            areas = secparam['area']
-            msparam['area'] = areas.sum()
-            ws = areas / msparam['area']  # weights
-            msparam['dip'] = ws @ secparam['dip']
-            msparam['strike'] = utils.angular_mean_weighted(
-                secparam['strike'], ws) % 360
-            msparam['width'] = ws @ secparam['width']
-            msparam['ztor'] = ws @ secparam['ztor']
-            msparam['zbot'] = ws @ secparam['zbot']
-
-            # building bounding box
-            lons = np.concatenate([secparam['west'], secparam['east']])
-            lats = np.concatenate([secparam['north'], secparam['south']])
-            bb = utils.get_spherical_bounding_box(lons, lats)
-            msparam['west'] = bb[0]
-            msparam['east'] = bb[1]
-            msparam['north'] = bb[2]
-            msparam['south'] = bb[3]
-
+        areas = secparam['area']
+        tot = np.add.reduceat(areas, starts)
+        ws = areas / np.repeat(tot, counts[nz])  # weights
+        msparam = msparams[nz]
+        msparam['area'] = tot
+        for par in ('dip', 'width', 'ztor', 'zbot'):
+            msparam[par] = np.add.reduceat(ws * secparam[par], starts)
+        rad = np.radians(secparam['strike'].astype(float))
+        mean_sin = np.add.reduceat(np.sin(rad) * ws, starts)
+        mean_cos = np.add.reduceat(np.cos(rad) * ws, starts)
+        msparam['strike'] = np.degrees(np.arctan2(mean_sin, mean_cos)) % 360
+        bbs = _bounding_boxes(secparam, starts)
+        for i, par in enumerate(['west', 'east', 'north', 'south']):
+            msparam[par] = bbs[i]
+        msparams[nz] = msparam
     return msparams
 
 
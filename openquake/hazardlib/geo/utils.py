@@ -29,6 +29,7 @@ import numpy
 import numba
 from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist, euclidean
+import shapely
 from shapely import geometry, contains_xy
 from shapely.strtree import STRtree
 
@@ -246,13 +247,9 @@ class _GeographicObjects(object):
         mesh = exp.mesh
         assets_by_site = split_array(exp.assets, exp.assets['site_id'])
         if region:
-            # TODO: use SRTree
-            out = []
-            for i, (lon, lat) in enumerate(zip(mesh.lons, mesh.lats)):
-                if not geometry.Point(lon, lat).within(region):
-                    out.append(i)
-            if out:
-                ok = ~numpy.isin(numpy.arange(len(mesh)), out)
+            ok = contains_xy(region, mesh.lons, mesh.lats)
+            out, = numpy.where(~ok)
+            if len(out):
                 if ok.sum() == 0:
                     raise RuntimeError(
                         'Could not find any asset within the region!')
@@ -327,14 +324,12 @@ def assoc_to_polygons(polygons, data, sitecol, mode):
     assert mode in 'strict warn filter', mode
     sites = {}
     discarded = []
-    tree = STRtree(polygons)
-    index_by_id = dict((id(pl), i) for i, pl in enumerate(polygons))
-
-    for sid, lon, lat in zip(sitecol.sids, sitecol.lons, sitecol.lats):
-        point = geometry.Point(lon, lat)
-        result = next((index_by_id[id(o)]
-                       for o in tree.geometries[tree.query(point)]
-                       if o.contains(point)), None)
+    lonlats = numpy.array([sitecol.lons, sitecol.lats]).T
+    # in case of overlapping polygons take the first one
+    idxs = points_in_geoms(lonlats, polygons, -numpy.arange(len(polygons)))
+    for sid, lon, lat, idx in zip(
+            sitecol.sids, sitecol.lons, sitecol.lats, idxs):
+        result = None if idx == -1 else idx
         if result is not None:
             # associate inside
             sites[sid] = data[result].copy()
@@ -925,6 +920,45 @@ def geohash3(lons, lats):
     return arr[:, 0] * 1024 + arr[:, 1] * 32 + arr[:, 2]
 
 
+def points_in_geoms(lonlats, geoms, ranks=None):
+    """
+    Bulk point-in-polygon test: for each geometry only the points inside
+    its bounding box are checked, with a vectorized test on the prepared
+    geometry.
+
+    :param lonlats: array of shape (N, 2) of (lon, lat)
+    :param geoms: a sequence of G shapely geometries
+    :param ranks: G ranks used to choose between overlapping geometries
+    :returns: N geometry indices (-1 for points outside all geometries)
+
+    If a point is inside more than one geometry, the index of the
+    geometry with the largest rank is returned (by default the largest
+    index).
+
+    >>> square = geometry.box(0, 0, 2, 2)
+    >>> points_in_geoms([(1, 1), (3, 3), (2, 1)], [square])
+    array([ 0, -1, -1])
+    """
+    lonlats = numpy.asarray(lonlats, float)
+    out = numpy.full(len(lonlats), -1)
+    if len(lonlats) == 0:
+        return out
+    if ranks is None:
+        ranks = numpy.arange(len(geoms))
+    best = numpy.full(len(lonlats), -numpy.inf)
+    xs, ys = lonlats[:, 0], lonlats[:, 1]
+    for g, geom in enumerate(geoms):
+        minx, miny, maxx, maxy = geom.bounds
+        idxs, = numpy.where((xs >= minx) & (xs <= maxx) &
+                            (ys >= miny) & (ys <= maxy))
+        shapely.prepare(geom)
+        idxs = idxs[contains_xy(geom, xs[idxs], ys[idxs])]
+        idxs = idxs[ranks[g] > best[idxs]]
+        out[idxs] = g
+        best[idxs] = ranks[g]
+    return out
+
+
 def geolocate(lonlats, geom_df, exclude=()):
     """
     :param lonlats: array of shape (N, 2) of (lon, lat)
@@ -934,15 +968,18 @@ def geolocate(lonlats, geom_df, exclude=()):
 
     NB: if the "code" field is not a primary key, i.e. there are
     different geometries with the same code, performs an "or", i.e.
-    associates the code if at least one of the geometries matches
+    associates the code if at least one of the geometries matches.
+    If a point is inside geometries with different codes, the last
+    code in alphabetical order is associated.
     """
     codes = numpy.array(['???'] * len(lonlats))
     filtered_geom_df = geom_df[~geom_df['code'].isin(exclude)]
-    for code, df in filtered_geom_df.groupby('code'):
-        ok = numpy.zeros(len(lonlats), bool)
-        for geom in df.geom:
-            ok |= contains_xy(geom, lonlats)
-        codes[ok] = code
+    ucodes, ranks = numpy.unique(
+        filtered_geom_df['code'].to_numpy(), return_inverse=True)
+    idxs = points_in_geoms(lonlats, filtered_geom_df['geom'].to_numpy(),
+                           ranks)
+    ok = idxs != -1
+    codes[ok] = ucodes[ranks[idxs[ok]]]
     return codes
 
 
@@ -955,12 +992,14 @@ def geolocate_geometries(geometries, geom_df, exclude=()):
         of geometries that intersect each input geometry
     """
     result_codes = numpy.empty(len(geometries), dtype=object)
+    for i in range(len(geometries)):
+        result_codes[i] = []
     filtered_geom_df = geom_df[~geom_df['code'].isin(exclude)]
-    for i, input_geom in enumerate(geometries):
-        intersecting_codes = set()  # to store intersecting codes for current geometry
-        for code, df in filtered_geom_df.groupby('code'):
-            target_geoms = df['geom'].values  # geometries associated with this code
-            if any(target_geom.intersects(input_geom) for target_geom in target_geoms):
-                intersecting_codes.add(code)
-        result_codes[i] = sorted(intersecting_codes)
+    if len(geometries) == 0 or len(filtered_geom_df) == 0:
+        return result_codes
+    codes = filtered_geom_df['code'].to_numpy()
+    tree = STRtree(filtered_geom_df['geom'].to_numpy())
+    idxs, gidxs = tree.query(geometries, predicate='intersects')
+    for i, code in sorted(set(zip(idxs, codes[gidxs]))):
+        result_codes[i].append(code)
     return result_codes
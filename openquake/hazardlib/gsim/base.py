@@ -81,7 +81,7 @@ class AdaptedWarning(UserWarning):
 
 
 OK_METHODS = ('compute', 'get_mean_and_stddevs', 'set_poes', 'requires',
-              'set_parameters', 'set_tables')
+              'set_parameters', 'set_tables', 'transform')
 
 
 def bad_methods(clsdict):
@@ -236,6 +236,12 @@ class GroundShakingIntensityModel(metaclass=MetaGSIM):
     REQUIRES_DISTANCES = abc.abstractproperty()
 
     _toml = ''  # set by valid.gsim
+    # GSIMs wrapping a .gmpe and computing mean and stddevs as a cheap
+    # transformation of the ones of the .gmpe (see ModifiableGMPE) can set
+    # a base_key and define a method .transform(ctx, imts, mean, sig, tau,
+    # phi); the ContextMaker calls the .gmpe.compute only once for all the
+    # GSIMs with the same base_key and then calls their .transform
+    base_key = None
     superseded_by = None
     non_verified = False
     experimental = False
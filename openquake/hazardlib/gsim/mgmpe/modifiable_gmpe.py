@@ -250,6 +250,13 @@ class ModifiableGMPE(GMPE):
         if hasattr(self.gmpe, 'gmpe_table'):
             self.gmpe_table = self.gmpe.gmpe_table
         self.set_parameters()
+        if not ('nrcan15_site_term' in self.params or
+                'cy14_site_term' in self.params or
+                hasattr(self.gmpe, 'weights_signs')):
+            # the underlying gmpe is computed on the original contexts,
+            # so its mean and stddevs can be shared with other
+            # ModifiableGMPEs with the same gmpe
+            self.base_key = '%s%s' % (gmpe_name, self.gmpe.kwargs)
 
         if ('set_between_epsilon' in self.params or
             'set_total_std_as_tau_plus_delta' in self.params) and (
@@ -334,12 +341,16 @@ class ModifiableGMPE(GMPE):
             ctx_copy.vs30 = np.full_like(ctx.vs30, rock_vs30) # rock
         else:
             ctx_copy = ctx
-        g = globals()
-
         # Compute the original mean and standard deviations
         self.gmpe.compute(ctx_copy, imts, mean, sig, tau, phi)
+        self.transform(ctx, imts, mean, sig, tau, phi)
 
-        # Apply sequentially the modifications
+    def transform(self, ctx: np.recarray, imts, mean, sig, tau, phi):
+        """
+        Apply sequentially the modifications to the mean and standard
+        deviations computed by the underlying GMPE
+        """
+        g = globals()
         for methname, kw in self.params.items():
             for m, imt in enumerate(imts):
                 me, si, ta, ph = mean[m], sig[m], tau[m], phi[m]
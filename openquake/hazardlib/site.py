@@ -22,8 +22,8 @@ Module :mod:`openquake.hazardlib.site` defines :class:`Site`.
 
 import numpy
 import pandas
-from scipy.spatial import distance
-from shapely import geometry
+from scipy.spatial import distance, cKDTree
+import shapely
 from openquake.baselib import hdf5
 from openquake.baselib.general import not_equal, get_duplicates, cached_property
 from openquake.hazardlib.geo.utils import (
@@ -126,6 +126,65 @@ class TileGetter:
         return sc
 
 
+class SiteIndex(object):
+    """
+    A spatial index over an array of sites, to find quickly the sites
+    inside a bounding box. The sites are bucketed in latitude bands of
+    `cell` degrees and sorted by longitude (modulo 360, so that the index
+    works also across the International Date Line) inside each band:
+    the sites in a bounding box are found with two binary searches per band.
+
+    >>> array = numpy.zeros(4, [('lon', float), ('lat', float)])
+    >>> array['lon'] = [179.9, -179.9, 0., 10.]
+    >>> array['lat'] = [0., 0., 1., 1.]
+    >>> SiteIndex(array).query((179, -1, 181, 1))
+    array([0, 1])
+    """
+    def __init__(self, array, cell=.1):
+        self.array = array
+        self.cell = cell
+        lons, lats = array['lon'], array['lat']
+        self.minlon, self.maxlon = lons.min(), lons.max()
+        self.minlat = lats.min()
+        rows = ((lats - self.minlat) // cell).astype(numpy.int64)
+        self.nrows = rows.max() + 1
+        # the longitudes modulo 360 are in the range [0, 360) < 400
+        keys = rows * 400. + lons % 360
+        self.order = keys.argsort(kind='stable')
+        self.keys = keys[self.order]
+
+    def query(self, bbox):
+        """
+        :param bbox: a quartet (min_lon, min_lat, max_lon, max_lat)
+        :returns: the sorted indices of a superset of the sites in the bbox
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        r0 = max(int((min_lat - self.minlat) // self.cell), 0)
+        r1 = min(int((max_lat - self.minlat) // self.cell), self.nrows - 1)
+        if r1 < r0:
+            return numpy.array([], numpy.int64)
+        rows = numpy.arange(r0, r1 + 1) * 400.
+        lo, hi = min_lon % 360, max_lon % 360
+        if max_lon - min_lon >= 360:
+            ranges = [(0., 360.)]
+        elif lo <= hi:
+            ranges = [(lo, hi)]
+        else:  # crossing the 0 meridian modulo 360
+            ranges = [(lo, 360.), (0., hi)]
+        starts, stops = [], []
+        for lo, hi in ranges:
+            starts.append(numpy.searchsorted(self.keys, rows + lo, 'left'))
+            stops.append(numpy.searchsorted(self.keys, rows + hi, 'right'))
+        starts = numpy.concatenate(starts)
+        lens = numpy.concatenate(stops) - starts
+        # concatenate the ranges starts[i]:stops[i] without a Python loop
+        tot = lens.sum()
+        offsets = numpy.repeat(starts - numpy.cumsum(lens) + lens, lens)
+        idxs = self.order[offsets + numpy.arange(tot)]
+        idxs.sort()
+        return idxs
+
+
 class Site(object):
     """
     Site object represents a geographical location defined by its position
@@ -705,14 +764,40 @@ class SiteCollection(object):
                                  ' check the site model' % param)
         return site_model
 
+    @property
+    def index(self):
+        """
+        A :class:`SiteIndex` built once and rebuilt only if the underlying
+        array changes
+        """
+        idx = self.__dict__.get('_index')
+        if idx is None or idx.array is not self.array:
+            idx = self.__dict__['_index'] = SiteIndex(self.array)
+        return idx
+
+    @property
+    def kdt(self):
+        """
+        A cKDTree on the cartesian coordinates of the sites, built once and
+        rebuilt only if the underlying array changes
+        """
+        arr, kdt = self.__dict__.get('_kdt', (None, None))
+        if arr is not self.array:
+            kdt = cKDTree(self.xyz)
+            self.__dict__['_kdt'] = self.array, kdt
+        return kdt
+
     def within(self, region):
         """
         :param region: a shapely polygon
         :returns: a filtered SiteCollection of sites within the region
         """
-        mask = numpy.array([
-            geometry.Point(rec['lon'], rec['lat']).within(region)
-            for rec in self.array])
+        idxs = self.within_bbox(region.bounds)  # prefiltering
+        shapely.prepare(region)
+        ok = shapely.contains_xy(
+            region, self['lon'][idxs], self['lat'][idxs])
+        mask = numpy.zeros(len(self), bool)
+        mask[idxs[ok]] = True
         return self.filter(mask)
 
     def within_bbox(self, bbox):
@@ -722,14 +807,18 @@ class SiteCollection(object):
         :returns:
             site IDs within the bounding box
         """
+        if len(self) == 0:
+            return numpy.array([], numpy.int64)
         min_lon, min_lat, max_lon, max_lat = bbox
-        lons, lats = self['lon'], self['lat']
-        if cross_idl(lons.min(), lons.max(), min_lon, max_lon):
+        index = self.index
+        idxs = index.query(bbox)
+        lons, lats = self['lon'][idxs], self['lat'][idxs]
+        if cross_idl(index.minlon, index.maxlon, min_lon, max_lon):
             lons = lons % 360
             min_lon, max_lon = min_lon % 360, max_lon % 360
         mask = (min_lon < lons) * (lons < max_lon) * \
                (min_lat < lats) * (lats < max_lat)
-        return mask.nonzero()[0]
+        return idxs[mask]
 
     def extend(self, lons, lats):
         """
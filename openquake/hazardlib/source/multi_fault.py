@@ -121,6 +121,16 @@ class MultiFaultSource(BaseSeismicSource):
             except KeyError:
                 raise KeyError(f'{key} not found in {self.hdf5path}')
 
+    @property
+    def u_max(self):
+        """
+        :returns: the u_max parameters stored in hdf5path, if any
+        """
+        assert self.hdf5path
+        with hdf5.File(self.hdf5path, 'r') as h5:
+            key = f'{self.source_id}/u_max'
+            return h5[key][:] if key in h5 else None
+
     def set_sections(self, sections):
         """
         Used in the UCERF converter, not in the engine
@@ -134,7 +144,8 @@ class MultiFaultSource(BaseSeismicSource):
                      mon1=performance.Monitor(),
                      mon2=performance.Monitor()):
         self.msparams = build_msparams(
-            self.rupture_idxs, secparams, close_sec, ry0, mon1, mon2)
+            self.rupture_idxs, secparams, close_sec, ry0, mon1, mon2,
+            self.u_max if ry0 else None)
 
     def is_gridded(self):
         return True  # convertible to HDF5
@@ -19,10 +19,11 @@
 Utilities to compute mean and quantile curves
 """
 import math
+import functools
 import numpy
 import pandas
 from scipy.stats import norm
-from openquake.baselib.general import AccumDict, agg_probs
+from openquake.baselib.general import agg_probs
 from openquake.baselib.performance import compile
 try:
     import numba
@@ -110,6 +111,30 @@ def calc_momenta(array, weights):
     return momenta
 
 
+def calc_momenta_by(idxs, array, weights, N):
+    """
+    :param idxs: an array of E indices in the range 0..N-1
+    :param array: an array of shape (E, M)
+    :param weights: an array of length E
+    :param N: the number of indices
+    :returns: an array of shape (3, N, M) with the first 3 statistical
+              moments of the rows with the same index
+
+    >>> arr = numpy.array([[2, 4], [3, 5], [1, 1]])
+    >>> calc_momenta_by(numpy.array([0, 0, 2]), arr, numpy.ones(3), 3)[1]
+    array([[5., 9.],
+           [0., 0.],
+           [1., 1.]])
+    """
+    momenta = numpy.zeros((3, N, array.shape[1]))
+    momenta[0] = numpy.bincount(idxs, weights, N)[:, None]
+    for m, col in enumerate(array.T):
+        wcol = weights * col
+        momenta[1, :, m] = numpy.bincount(idxs, wcol, N)
+        momenta[2, :, m] = numpy.bincount(idxs, wcol * col, N)
+    return momenta
+
+
 def calc_avg_std(momenta):
     """
     :param momenta: an array of shape (2, ...) obtained via calc_momenta
@@ -195,6 +220,29 @@ def quantile_curve(quantile, curves, weights=None):
     >>> quantile_curve(.85, numpy.array([.15, .15, .15]))  # constant array
     array(0.15)
     """
+    return quantile_curves([quantile], curves, weights)[0, ...]
+
+
+def quantile_curves(quantiles, curves, weights=None):
+    """
+    Compute several weighted quantiles of an array or list of arrays,
+    sorting the realizations only once and interpolating the weighted
+    CDF of all the elements at the same time.
+
+    :param quantiles:
+        Q quantile values in the range [0.0, 1.0]
+    :param curves:
+        R arrays
+    :param weights:
+        R weights with sum 1, or None
+    :returns:
+        an array of shape (Q, ...) with the quantiles
+
+    >>> arr = numpy.array([[.1, .2], [.3, .4], [.2, .6]])
+    >>> quantile_curves([.5, .9], arr, [.2, .3, .5]).round(4)
+    array([[0.16  , 0.4   ],
+           [0.2667, 0.56  ]])
+    """
     if not isinstance(curves, numpy.ndarray):
         curves = numpy.array(curves)
     R = len(curves)
@@ -203,15 +251,28 @@ def quantile_curve(quantile, curves, weights=None):
     else:
         weights = numpy.array(weights)
         assert len(weights) == R, (len(weights), R)
-    result = numpy.zeros(curves.shape[1:])
-    for idx, _ in numpy.ndenumerate(result):
-        cw = numpy.zeros(R, cw_dt)  # (curve, weight)
-        cw['c'] = curves[(slice(None), ) + idx]
-        cw['w'] = weights
-        cw.sort(order='c')
-        # get the quantile from the interpolated CDF
-        result[idx] = numpy.interp(quantile, cw['w'].cumsum(), cw['c'])
-    return result
+    shape = curves.shape[1:]
+    values = curves.reshape(R, -1)
+    X = values.shape[1]
+    # sort by value and then by weight, as done by the sort of cw_dt records
+    order = numpy.lexsort(
+        (numpy.broadcast_to(weights[:, None], values.shape), values), axis=0)
+    cols = numpy.arange(X)
+    values = values[order, cols]
+    cumw = weights[order].cumsum(axis=0)  # weighted CDF, shape (R, X)
+    result = numpy.zeros((len(quantiles), X))
+    for i, q in enumerate(quantiles):
+        # same as numpy.interp(q, cumw[:, x], values[:, x]) for each x
+        j = (cumw <= q).sum(axis=0) - 1
+        lo = numpy.clip(j, 0, R - 1)
+        hi = numpy.clip(j + 1, 0, R - 1)
+        w0, w1 = cumw[lo, cols], cumw[hi, cols]
+        v0, v1 = values[lo, cols], values[hi, cols]
+        inside = (j >= 0) & (j < R - 1)
+        dw = numpy.where(inside, w1 - w0, 1.)
+        result[i] = numpy.where(inside, v0 + (q - w0) * (v1 - v0) / dw,
+                                numpy.where(j < 0, v0, v1))
+    return result.reshape((len(quantiles),) + shape)
 
 
 def max_curve(values, weights=None):
@@ -275,23 +336,43 @@ def calc_stats(df, kfields, stats, weights):
     :param weights: an array of weights for each realization
     :returns: a DataFrame with the statistics
     """
-    acc = AccumDict(accum=[])
+    acc = {}
     vfields = [f for f in df.columns if f not in kfields and f != 'rlz_id']
     # in aggrisk kfields=['agg_id', 'loss_type']
     # in aggcurves kfields=['agg_id', 'return_period', 'loss_type']
-    for key, group in df.groupby(kfields):
-        for name, func in stats.items():
-            for k, kf in zip(key, kfields):
-                acc[kf].append(k)
-            for vf in vfields:
-                values = numpy.zeros_like(weights)  # shape R
-                values[group.rlz_id] = getattr(group, vf).to_numpy()
-                v = func(values, weights)
-                acc[vf].append(v)
-            acc['stat'].append(name)
+    groupby = df.groupby(kfields)
+    gidx = groupby.ngroup().to_numpy()
+    keys = groupby.size().index  # in the same order as the group indices
+    S = len(stats)
+    for kf in kfields:
+        acc[kf] = numpy.repeat(keys.get_level_values(kf), S)
+    rlzs = df.rlz_id.to_numpy()
+    funcs = list(stats.values())
+    for vf in vfields:
+        values = numpy.zeros((len(weights), len(keys)))  # shape (R, K)
+        values[rlzs, gidx] = df[vf].to_numpy()
+        acc[vf] = compute_stats(values, funcs, weights).T.reshape(-1)
+    acc['stat'] = numpy.tile(list(stats), len(keys))
     return pandas.DataFrame(acc)
 
 
+def get_quantiles(stats):
+    """
+    :param stats: a sequence of S statistic functions
+    :returns: the quantile values and their indices in the sequence
+
+    >>> get_quantiles([mean_curve, functools.partial(quantile_curve, .15)])
+    ([0.15], [1])
+    """
+    qs, idxs = [], []
+    for i, func in enumerate(stats):
+        if (isinstance(func, functools.partial) and
+                func.func is quantile_curve):
+            qs.append(func.args[0])
+            idxs.append(i)
+    return qs, idxs
+
+
 # NB: this is a function linear in the array argument
 def compute_stats(array, stats, weights):
     """
@@ -305,8 +386,14 @@ def compute_stats(array, stats, weights):
         an array of S elements (which can be arrays)
     """
     result = numpy.zeros((len(stats),) + array.shape[1:], array.dtype)
+    qs, idxs = get_quantiles(stats)
+    if array.dtype.names:  # composite array
+        idxs = []
+    elif qs:  # compute all the quantiles with a single sort
+        result[idxs] = quantile_curves(qs, array, weights)
     for i, func in enumerate(stats):
-        result[i] = apply_stat(func, array, weights)
+        if i not in idxs:
+            result[i] = apply_stat(func, array, weights)
     return result
 
 
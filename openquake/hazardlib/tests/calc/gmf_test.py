@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2024, GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import Mock
+import numpy
+from openquake.hazardlib import valid, contexts, site, geo
+from openquake.hazardlib.source.rupture import EBRupture, build_planar
+from openquake.hazardlib.calc.gmf import GmfComputer, set_mean_stds
+
+U32 = numpy.uint32
+
+
+class SetMeanStdsTestCase(unittest.TestCase):
+    def test_same_gmfs(self):
+        # computing the mean and stddevs for a batch of ruptures must
+        # give the same GMFs as computing them rupture by rupture
+        rlzs_by_gsim = {valid.gsim('BooreAtkinson2008'): U32([0, 1]),
+                        valid.gsim('AkkarBommer2010'): U32([2])}
+        cmaker = contexts.simple_cmaker(
+            rlzs_by_gsim, ['PGA', 'SA(0.3)'], truncation_level=3.)
+        siteparams = Mock(reference_vs30_value=760.,
+                          reference_vs30_type='measured')
+        sitecol = site.SiteCollection.from_points(
+            [0., 0., .5, 1.], [0., 1., .5, 0.], sitemodel=siteparams,
+            req_site_params=cmaker.REQUIRES_SITES_PARAMETERS)
+        computers = []
+        for i, (lat, mag) in enumerate([(.5, 6.), (.2, 6.), (.8, 7.)]):
+            rup = build_planar(geo.point.Point(0, lat, 10), mag=mag, rake=0.)
+            ebr = EBRupture(rup, 0, 0, n_occ=3, id=i, e0=3 * i)
+            ebr.seed = 42 + i
+            computers.append(GmfComputer(ebr, sitecol, cmaker))
+        expected = [c.compute_all() for c in computers]
+        set_mean_stds(computers)
+        for comp, exp in zip(computers, expected):
+            self.assertEqual(comp.mean_stds.shape, (2, 4, 2, comp.N))
+            df = comp.compute_all()
+            for col in exp.columns:
+                numpy.testing.assert_allclose(df[col], exp[col], rtol=1E-6)
@@ -16,6 +16,7 @@
 
 import os
 import unittest
+import unittest.mock as mock
 import numpy
 import numpy.testing as npt
 
@@ -218,6 +219,29 @@ class NankaiTestCase(unittest.TestCase):
             hcurves['PGV'][0])
 
 
+class FusedTestCase(unittest.TestCase):
+    # the fused kernel must give the same curves as the original path
+    def test(self):
+        d = os.path.dirname(os.path.dirname(__file__))
+        source_model = os.path.join(d, 'source_model/multi-point-source.xml')
+        groups = nrml.to_python(source_model, SourceConverter(
+            investigation_time=50., rupture_mesh_spacing=2.))
+        sites = SiteCollection([
+            Site(Point(0.1, 0.1), 800, z1pt0=100., z2pt5=1.),
+            Site(Point(0.3, 0.2), 400, z1pt0=100., z2pt5=1.)])
+        imtls = DictArray({'PGA': [0.01, 0.02, 0.04, 0.08, 0.16],
+                           'SA(0.2)': [0.01, 0.02, 0.04, 0.08, 0.16]})
+        gsim_by_trt = {'Stable Continental Crust': Campbell2003()}
+        with mock.patch.object(ContextMaker, 'update_fused', autospec=True,
+                               side_effect=ContextMaker.update_fused) as upd:
+            fused = calc_hazard_curves(groups, sites, imtls, gsim_by_trt)
+        self.assertGreater(upd.call_count, 0)
+        with mock.patch.object(ContextMaker, 'fused', False):
+            orig = calc_hazard_curves(groups, sites, imtls, gsim_by_trt)
+        for imt in imtls:
+            npt.assert_allclose(fused[imt], orig[imt], rtol=1E-6)
+
+
 class MultiPointTestCase(unittest.TestCase):
     def test(self):
         d = os.path.dirname(os.path.dirname(__file__))
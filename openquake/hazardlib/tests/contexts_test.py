@@ -17,7 +17,10 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import copy
 import unittest
+import shutil
+import tempfile
 import numpy
 
 from openquake.baselib.general import DictArray, gettemp
@@ -25,7 +28,8 @@ from openquake.hazardlib import site
 from openquake.hazardlib.pmf import PMF
 from openquake.hazardlib.const import TRT
 from openquake.hazardlib.tom import PoissonTOM
-from openquake.hazardlib.contexts import Effect, ContextMaker, get_distances
+from openquake.hazardlib.contexts import (
+    Effect, ContextMaker, get_distances, purge_ctxs_cache, sections_sha1)
 from openquake.hazardlib import valid
 from openquake.hazardlib.geo.surface import SimpleFaultSurface as SFS
 from openquake.hazardlib.source.multi_fault import save_and_split
@@ -202,7 +206,8 @@ class GetCtxs01TestCase(unittest.TestCase):
         ssm = to_python(rup_path, sc)
         geom = to_python(geom_path, sc)
         self.src = ssm[0][0]
-        save_and_split([self.src], geom.sections, gettemp(suffix='.hdf5'))
+        self.hdf5path = gettemp(suffix='.hdf5')
+        save_and_split([self.src], geom.sections, self.hdf5path)
         set_msparams(self.src, geom.sections)
 
         # Create site-collection
@@ -227,6 +232,52 @@ class GetCtxs01TestCase(unittest.TestCase):
         rjb = self.rup.surface.get_joyner_boore_distance(self.sitec.mesh)
         self.assertAlmostEqual(rjb, self.ctx.rjb, delta=1e-3)
 
+    def test_cached_ctxs(self):
+        cachedir = tempfile.mkdtemp()
+        param = dict(imtls={'PGA': []}, cache_distances=True,
+                     cachedir=cachedir)
+        cm = ContextMaker('*', [AbrahamsonEtAl2014()], param)
+        [ctx1] = cm.get_cached_ctxs(self.src, self.sitec)  # stored
+        ctxsdir = os.path.join(cachedir, 'ctxs')
+        [fname] = os.listdir(ctxsdir)
+        self.assertTrue(fname.startswith('ctxs_'))
+        [ctx2] = cm.get_cached_ctxs(self.src, self.sitec)  # read
+        self.assertEqual(os.listdir(ctxsdir), [fname])  # same key
+        for par in ('mag', 'rrup', 'rjb', 'rx', 'ry0', 'rup_id'):
+            numpy.testing.assert_equal(ctx1[par], ctx2[par])
+
+        # the key does not depend on the path of the multifault file,
+        # nor on the attributes set during the calculation; the sections
+        # are hashed once per file
+        sections_sha1.cache_clear()
+        key = cm.ctxs_key(self.src, self.sitec)
+        src = copy.deepcopy(self.src)
+        src.nsites = 1
+        src.hdf5path = gettemp(suffix='.hdf5')
+        shutil.copy(self.hdf5path, src.hdf5path)
+        self.assertEqual(cm.ctxs_key(src, self.sitec), key)
+        self.assertEqual(cm.ctxs_key(src, self.sitec), key)
+        self.assertEqual(sections_sha1.cache_info().misses, 2)
+
+        # a new ContextMaker, with a new maximum_distance object,
+        # gives the same key
+        cm1 = ContextMaker('*', [AbrahamsonEtAl2014()], param)
+        self.assertEqual(cm1.ctxs_key(src, self.sitec), key)
+
+        # but it depends on the ruptures
+        src.mags = src.mags + 0.1
+        self.assertNotEqual(cm.ctxs_key(src, self.sitec), key)
+
+        # but it depends on the minimum_distance
+        cm2 = ContextMaker('*', [AbrahamsonEtAl2014()],
+                           dict(param, minimum_distance=10))
+        self.assertNotEqual(cm2.ctxs_key(self.src, self.sitec), key)
+
+        # purging the cache
+        self.assertEqual(purge_ctxs_cache(ctxsdir, maxsize=1E9), 0)
+        self.assertEqual(purge_ctxs_cache(ctxsdir), 1)
+        self.assertEqual(os.listdir(ctxsdir), [])
+
     def test_rrup_distance(self):
         rrup = self.rup.surface.get_min_distance(self.sitec.mesh)
         self.assertAlmostEqual(rrup, self.ctx.rrup, delta=1e-3)
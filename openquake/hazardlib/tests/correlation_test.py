@@ -19,7 +19,7 @@ import numpy
 
 from openquake.hazardlib.imt import SA, PGA
 from openquake.hazardlib.correlation import JB2009CorrelationModel, \
-                                            HM2018CorrelationModel
+    HM2018CorrelationModel, jbcorrelation, wendland, sparse_lower_triangle
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.geo import Point
 
@@ -148,6 +148,35 @@ class JB2009ApplyCorrelationTestCase(unittest.TestCase):
              decimal=6)
 
 
+class SparseCorrelationTestCase(unittest.TestCase):
+    # a 10x10 grid with spacing of ~5.5 km
+    lons, lats = numpy.meshgrid(numpy.arange(10) * .05,
+                                numpy.arange(10) * .05)
+    SITECOL = SiteCollection.from_points(lons.flatten(), lats.flatten())
+
+    def test_tapered_matrix(self):
+        cutoff = 20.
+        L, perm = sparse_lower_triangle(
+            lambda dists: jbcorrelation(dists, PGA()), self.SITECOL, cutoff)
+        corr = numpy.zeros((100, 100))
+        corr[numpy.ix_(perm, perm)] = (L @ L.T).toarray()
+        dists = self.SITECOL.mesh.get_distance_matrix()
+        expected = jbcorrelation(dists, PGA()) * wendland(dists / cutoff)
+        aaae(corr, expected, decimal=4)
+        # the factor is much smaller than the dense one
+        self.assertLess(L.nnz, 100 * 100 / 2)
+
+    def test_apply_correlation(self):
+        numpy.random.seed(13)
+        dense = JB2009CorrelationModel(vs30_clustering=False)
+        tapered = JB2009CorrelationModel(vs30_clustering=False, cutoff=1000.)
+        sites = self.SITECOL.filtered([0, 1, 2, 11, 12, 13])
+        residuals = numpy.random.normal(size=(6, 100000))
+        corr = numpy.corrcoef(tapered.apply_correlation(
+            sites, PGA(), residuals))
+        aaae(corr, dense._get_correlation_matrix(sites, PGA()), decimal=2)
+
+
 class HM2018CorrelationMatrixTestCase(unittest.TestCase):
     SITECOL = SiteCollection([Site(Point(2, -40), 1, 1, 1),
                               Site(Point(2, -40.1), 1, 1, 1),
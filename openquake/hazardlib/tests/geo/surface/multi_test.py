@@ -24,7 +24,8 @@ from openquake.hazardlib.geo import Point, Line
 from openquake.hazardlib.geo.mesh import Mesh
 from openquake.hazardlib.geo.geodetic import geodetic_distance
 from openquake.hazardlib.geo.surface.kite_fault import KiteSurface
-from openquake.hazardlib.geo.surface.multi import MultiSurface
+from openquake.hazardlib.geo.surface.multi import (
+    MultiSurface, MS_DT, build_msparams, build_u_max)
 from openquake.hazardlib.tests.geo.line_test import get_mesh, plot_pattern
 from openquake.hazardlib.tests.geo.surface.kite_fault_test import plot_mesh_2d
 
@@ -54,6 +55,48 @@ class GetTorTestCase(unittest.TestCase):
         aae(expected, surf.tor.lines[1].coo)
 
 
+class BuildMsparamsTestCase(unittest.TestCase):
+    """
+    Tests the vectorized computation of the multisurface parameters
+    """
+    def test_idl(self):
+        secparams = numpy.zeros(4, MS_DT)
+        for name, values in dict(
+                area=[100, 300, 200, 100], dip=[30, 50, 90, 90],
+                strike=[10, 350, 90, 90], width=[10, 20, 15, 15],
+                ztor=[0, 2, 1, 1], zbot=[5, 10, 15, 15],
+                west=[179.2, -179.8, 10, 20], east=[179.8, -179.2, 11, 21],
+                north=[10.2, 10.4, 45.1, 45.1], south=[10, 10.2, 45, 45],
+                tl0=[179.2, -179.8, 10, 20], tl1=[10, 10.2, 45, 45],
+                tr0=[179.8, -179.2, 11, 21], tr1=[10.2, 10.4, 45.1, 45.1]
+        ).items():
+            secparams[name] = values
+        # the first rupture crosses the international date line,
+        # the third one has only far away sections
+        rupture_idxs = [numpy.uint16(idxs) for idxs in [[0, 1], [2, 3],
+                                                        [3], [2]]]
+        close_sec = numpy.array([True, True, True, False])
+        ms = build_msparams(rupture_idxs, secparams, close_sec, ry0=True)
+        sin10, cos10 = numpy.sin(numpy.radians(10)), numpy.cos(
+            numpy.radians(10))
+        strike = numpy.degrees(numpy.arctan2(-.5 * sin10, cos10)) % 360
+        aac(ms[0][['area', 'dip', 'width', 'ztor', 'zbot', 'strike']].tolist(),
+            [400, 45, 17.5, 1.5, 8.75, strike], rtol=1E-6)
+        aac(ms[0][['west', 'east', 'north', 'south']].tolist(),
+            [179.2, -179.2, 10.4, 10], rtol=1E-6)
+        self.assertEqual(ms[1], ms[3])  # the section 3 is discarded
+        aac(ms[1][['area', 'dip', 'west', 'east', 'north', 'south']].tolist(),
+            [200, 90, 10, 11, 45.1, 45], rtol=1E-6)
+        self.assertEqual(ms[2]['area'], 0)
+
+        # using precomputed u_max values
+        u_max = build_u_max(rupture_idxs, secparams)
+        self.assertGreater(u_max[1], u_max[3])
+        ms2 = build_msparams(rupture_idxs, secparams, close_sec, ry0=True,
+                             u_max=u_max)
+        self.assertTrue((ms2 == ms).all())
+
+
 class MultiSurfaceTestCase(unittest.TestCase):
     # Test multiplanar surfaces used in UCERF, which are build from
     # pre-exiting multisurfaces. In this test there are 3 original
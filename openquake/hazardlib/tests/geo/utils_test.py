@@ -17,6 +17,7 @@ import unittest
 import collections
 
 import numpy
+import pandas
 import shapely.geometry
 
 from openquake.hazardlib import geo
@@ -426,3 +427,27 @@ class PlaneFit(unittest.TestCase):
 
 
 # NB: utils.assoc is tested in the engine
+
+
+class GeolocateTestCase(unittest.TestCase):
+    def setUp(self):
+        box = shapely.geometry.box
+        self.geom_df = pandas.DataFrame(dict(
+            code=['B', 'A', 'A', 'C'],
+            geom=[box(0, 0, 2, 2), box(1, 1, 3, 3), box(5, 5, 6, 6),
+                  box(10, 10, 11, 11)]))
+
+    def test_geolocate(self):
+        lonlats = [(.5, .5), (1.5, 1.5), (2.5, 2.5), (5.5, 5.5), (2, 1),
+                   (7, 7)]
+        codes = utils.geolocate(lonlats, self.geom_df)
+        # in the overlapping region the last code in alphabetical order wins
+        self.assertEqual(list(codes), ['B', 'B', 'A', 'A', '???', '???'])
+        codes = utils.geolocate(lonlats, self.geom_df, exclude=['B'])
+        self.assertEqual(list(codes), ['???', 'A', 'A', 'A', '???', '???'])
+
+    def test_geolocate_geometries(self):
+        geoms = [shapely.geometry.box(1.5, 1.5, 5.5, 5.5),
+                 shapely.geometry.Point(20, 20)]
+        codes = utils.geolocate_geometries(geoms, self.geom_df)
+        self.assertEqual(list(codes), [['A', 'B'], []])
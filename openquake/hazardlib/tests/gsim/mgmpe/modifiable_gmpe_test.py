@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 import unittest
+import unittest.mock as mock
 import numpy as np
 from openquake.hazardlib import valid
 from openquake.hazardlib.imt import PGA, SA
@@ -163,6 +164,16 @@ class ModifiableGMPETest(unittest.TestCase):
         aae(phi[ORIG, 0], 0.6201)
         aae(sig[MODI, 0], 0.5701491121)
 
+    def test_shared_base(self):
+        # the underlying GMPE is computed once for both modified GMPEs
+        cls = valid.gsim('AkkarEtAlRjb2014').__class__
+        with mock.patch.object(cls, 'compute', autospec=True,
+                               side_effect=cls.compute) as compute:
+            mea, _sig, _tau, _phi = self.get_mean_stds(
+                set_scale_median_scalar={'scaling_factor': 1.2})
+        self.assertEqual(compute.call_count, 1)
+        aae(np.exp(mea[MODI]) / np.exp(mea[ORIG]), 1.2)
+
 
 class ModifiableGMPETestSwissAmpl(unittest.TestCase):
     """
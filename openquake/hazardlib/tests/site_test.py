@@ -23,6 +23,7 @@ from shapely import wkt
 
 from openquake.baselib import hdf5
 from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.geo.utils import fix_lon, cross_idl
 from openquake.hazardlib.geo.point import Point
 
 assert_eq = numpy.testing.assert_equal
@@ -263,6 +264,32 @@ class WithinBBoxTestCase(unittest.TestCase):
     def test1(self):
         assert_eq(self.sites.within_bbox((-182, -28, -178, -26)), [0])
 
+    def test_index(self):
+        # compare the spatial index with a full scan
+        rng = numpy.random.default_rng(42)
+        for lon1, lon2 in [(-180, 180), (170, 190), (-10, 10)]:
+            lons = fix_lon(rng.uniform(lon1, lon2, 10_000))
+            lats = rng.uniform(-60, 60, 10_000)
+            sites = SiteCollection.from_points(lons, lats)
+            for clon, clat, w in [(179.5, 0, 2), (-179.5, 10, 3), (0, 0, 1),
+                                  (5, 50, 20), (10, 80, 5)]:
+                min_lon, max_lon = fix_lon(clon - w), fix_lon(clon + w)
+                min_lat, max_lat = clat - w, clat + w
+                lo, hi, lns = min_lon, max_lon, lons
+                if cross_idl(lons.min(), lons.max(), lo, hi):
+                    lo, hi, lns = lo % 360, hi % 360, lons % 360
+                mask = ((lo < lns) & (lns < hi) &
+                        (min_lat < lats) & (lats < max_lat))
+                sids = sites.within_bbox(
+                    (min_lon, min_lat, max_lon, max_lat))
+                assert_eq(sids, mask.nonzero()[0])
+
+        # the index is rebuilt if the sites change
+        index = sites.index
+        self.assertIs(sites.index, index)
+        sites.array = sites.array[:100]
+        self.assertIsNot(sites.index, index)
+
 
 class SiteCollectionIterTestCase(unittest.TestCase):
 
@@ -197,6 +197,37 @@ class MultiFaultTestCase(unittest.TestCase):
                 print(col)
                 aac(df[col].to_numpy(), ctx[col], rtol=1E-5, equal_nan=1)
 
+    def test_batched(self):
+        # the contexts built by genctxs_mf must be the same as the ones
+        # built by instantiating the ruptures
+        [src] = load(os.path.join(BASE_DATA_PATH, 'ucerf.hdf5'))
+        src.id = 0
+        lons, lats = numpy.meshgrid(numpy.linspace(-123, -120, 10),
+                                    numpy.linspace(36, 39, 10))
+        sitecol = SiteCollection.from_points(lons.flatten(), lats.flatten())
+        sitecol._set('vs30', 760.)
+        sitecol._set('vs30measured', 1)
+        sitecol._set('z1pt0', 100.)
+        sitecol._set('z2pt5', 5.)
+        gsim = valid.gsim('AbrahamsonEtAl2014NSHMPMean')
+        cmaker = contexts.simple_cmaker([gsim], ['PGA'])
+        sf = calc.filters.SourceFilter(sitecol, cmaker.maximum_distance)
+        secparams = build_secparams(src.get_sections())
+        nsites = sf.get_close(secparams)
+        src.set_msparams(secparams, nsites > 0, ry0=True)
+        for infer_occur_rates in (False, True):
+            src.infer_occur_rates = infer_occur_rates
+            src.investigation_time = 50.
+            [new] = cmaker.from_srcs([src], sitecol)
+            self.assertTrue(contexts.mf_batchable(cmaker))
+            cmaker.mf_batch = False
+            [old] = cmaker.from_srcs([src], sitecol)
+            del cmaker.mf_batch
+            self.assertEqual(len(new), 200000)
+            self.assertEqual(new.dtype, old.dtype)
+            for col in old.dtype.names:
+                numpy.testing.assert_array_equal(new[col], old[col], col)
+
 
 def main100sites():
     [src] = load(os.path.join(BASE_DATA_PATH, 'ucerf.hdf5'))
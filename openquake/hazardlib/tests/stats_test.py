@@ -1,7 +1,8 @@
 import unittest
+import functools
 import numpy
 from openquake.hazardlib.stats import (
-    mean_curve, quantile_curve, std_curve)
+    mean_curve, quantile_curve, quantile_curves, std_curve, compute_stats)
 
 aaae = numpy.testing.assert_array_almost_equal
 
@@ -116,3 +117,29 @@ class QuantileCurveTestCase(unittest.TestCase):
         actual_curve = quantile_curve(quantile, curves, weights)
 
         numpy.testing.assert_allclose(expected_curve, actual_curve)
+
+    def test_compute_quantile_curves(self):
+        # several quantiles with ties and zero weights, compared with
+        # numpy.interp on the sorted weighted CDF of each element
+        rng = numpy.random.default_rng(42)
+        curves = numpy.round(rng.random((20, 3, 4)), 1)
+        weights = rng.random(20)
+        weights[[2, 5]] = 0
+        weights /= weights.sum()
+        qs = [0., .15, .5, .85, 1.]
+        actual = quantile_curves(qs, curves, weights)
+        self.assertEqual(actual.shape, (5, 3, 4))
+        for i, q in enumerate(qs):
+            for idx in numpy.ndindex(3, 4):
+                values = curves[(slice(None),) + idx]
+                order = numpy.lexsort((weights, values))
+                expected = numpy.interp(
+                    q, weights[order].cumsum(), values[order])
+                self.assertAlmostEqual(actual[(i,) + idx], expected)
+
+        # compute_stats uses a single sort for all the quantiles
+        funcs = [mean_curve] + [
+            functools.partial(quantile_curve, q) for q in qs]
+        res = compute_stats(curves, funcs, weights)
+        aaae(res[0], mean_curve(curves, weights))
+        aaae(res[1:], actual)
@@ -21,8 +21,8 @@ import logging
 import pandas as pd
 import numpy as np
 from openquake.baselib import hdf5
-from openquake.baselib.general import BASE183, fast_agg2, gen_slices
-from openquake.baselib.performance import compile, Monitor
+from openquake.baselib.general import BASE183, gen_slices
+from openquake.baselib.performance import Monitor
 from openquake.baselib.writers import scientificformat
 from openquake.hazardlib import nrml, InvalidFile
 from openquake.risklib import scientific
@@ -266,34 +266,73 @@ def parse(fname, policy_idx):
     return df, treaty_df, fmap
 
 
-@compile(["(float64[:],float64[:],float64,float64)",
-          "(float64[:],float32[:],float64,float64)",
-          "(float32[:],float32[:],float64,float64)"])
-def apply_treaty(cession, retention, deduc, capacity):
-    for i, ret in np.ndenumerate(retention):
-        overmax = ret - deduc
-        if ret > deduc:
-            if overmax > capacity:
-                retention[i] = deduc + overmax - capacity
-                cession[i] = capacity
-            else:
-                retention[i] = deduc
-                cession[i] = overmax
+def build_policy_grps(policy_df, treaty_df):
+    """
+    :param policy_df: policy DataFrame
+    :param treaty_df: treaty DataFrame
+    :returns: an array with the policy_grp of each policy
+    """
+    codes = treaty_df.code.to_numpy()
+    keys = np.tile(codes, (len(policy_df), 1))
+    for c, (col, typ) in enumerate(zip(treaty_df.id, treaty_df.type)):
+        if typ == 'catxl':
+            keys[policy_df[col].to_numpy() == 0, c] = '.'
+    return np.array([''.join(key) for key in keys])
+
+
+def apply_treaties(cession, retention, deduc, capacity):
+    """
+    Vectorized version of apply_treaty working on arrays of any shape;
+    cession and retention are modified in place.
+    """
+    overmax = retention - deduc
+    ok = retention > deduc
+    big = ok & (overmax > capacity)
+    small = ok & ~big
+    retention[big] = deduc + overmax[big] - capacity
+    cession[big] = capacity
+    retention[small] = deduc
+    cession[small] = overmax[small]
 
 
-def claim_to_cessions(claim, policy, treaty_df):
+# tested in reinsurance_test.py
+def by_policies(rbe, policy_df, treaty_df):
     """
-    :param claim: an array of claims
-    :param policy: a dictionary corresponding to a specific policy
-    :param treaty_df: dataframe with treaties
+    Batched version of :func:`by_policy` processing all policies at once.
 
-    Converts an array of claims into a dictionary of arrays.
+    :param DataFrame rbe:
+        losses aggregated by policy (agg_id) and event_id
+    :param DataFrame policy_df:
+        Policy parameters, with policy_df.policy being an integer >= 1
+    :param DataFrame treaty_df:
+        All treaties
+    :returns:
+        DataFrame of reinsurance losses by event ID and policy ID,
+        ordered as the policies in policy_df
     """
+    policy = policy_df.policy.to_numpy().astype(int)
+    aggid = rbe.agg_id.to_numpy()
+    size = max(policy.max(initial=0), aggid.max(initial=0) + 1) + 1
+    pidx = np.full(size, -1)
+    pidx[policy] = np.arange(len(policy))
+    rowpol = pidx[aggid + 1]
+    # group the rows by policy, keeping the order inside each policy
+    order = np.argsort(rowpol, kind='stable')
+    order = order[rowpol[order] >= 0]
+    pol = rowpol[order]
+
+    out = {}
+    ded = policy_df.deductible.to_numpy()[pol]
+    lim = policy_df.liability.to_numpy()[pol]
+    claim = scientific.insured_losses(rbe.loss.to_numpy()[order], ded, lim)
+    out['event_id'] = rbe.event_id.to_numpy()[order]
+    out['policy_id'] = policy[pol]
+
     # proportional cessions
     cols = treaty_df[treaty_df.type == 'prop'].id
-    fractions = [policy[col] for col in cols]
-    assert sum(fractions) <= 1
-    out = {'retention': claim * (1. - sum(fractions)), 'claim': claim}
+    fractions = [policy_df[col].to_numpy()[pol] for col in cols]
+    out['retention'] = claim * (1. - sum(fractions))
+    out['claim'] = claim
     for col, frac in zip(cols, fractions):
         out[col] = claim * frac
 
@@ -301,82 +340,78 @@ def claim_to_cessions(claim, policy, treaty_df):
     wxl = treaty_df[treaty_df.type == 'wxlr']
     for col, deduc, limit in zip(wxl.id, wxl.deductible, wxl.limit):
         out[col] = np.zeros(len(claim))
-        if policy[col]:
-            apply_treaty(out[col], out['retention'], deduc, limit - deduc)
-
-    return {k: np.round(v, 6) for k, v in out.items()}
+        ok = policy_df[col].to_numpy()[pol].astype(bool)
+        cession, ret = out[col][ok], out['retention'][ok]
+        apply_treaties(cession, ret, deduc, limit - deduc)
+        out[col][ok], out['retention'][ok] = cession, ret
 
-
-def build_policy_grp(policy, treaty_df):
-    """
-    :param policy: policy dictionary
-    :param treaty_df: treaty DataFrame
-    :returns: the policy_grp for the given policy
-    """
-    cols = treaty_df.id.to_numpy()
-    codes = treaty_df.code.to_numpy()
-    types = treaty_df.type.to_numpy()
-    key = list(codes)
-    for c, col in enumerate(cols):
-        if types[c] == 'catxl' and policy[col] == 0:
-            key[c] = '.'
-    return ''.join(key)
+    for k in list(out)[2:]:
+        out[k] = np.round(out[k], 6)
+    nonzero = out['claim'] > 0  # discard zero claims
+    rbp = pd.DataFrame({k: out[k][nonzero] for k in out})
+    # ex: event_id, policy_id, retention, claim, surplus, quota_shared, wxlr
+    rbp['policy_grp'] = build_policy_grps(policy_df, treaty_df)[
+        pol[nonzero]]
+    return rbp
 
 
 def line(row, fmt='%d'):
     return ''.join(scientificformat(val, fmt).rjust(11) for val in row)
 
 
-def clever_agg(ukeys, datalist, treaty_df, idx, overdict, eids):
+def clever_agg(keys, data, treaty_df, idx, overdict, eids):
     """
-    :param ukeys: a list of unique keys
-    :param datalist: a list of matrices of the shape (E, 2+T)
+    :param keys: an integer array of shape (G, T), nonzero for the treaties
+                 applying to each of the G policy groups (the sign is used
+                 only for the ordering)
+    :param data: an array of shape (G, E, 2+T)
     :param treaty_df: a treaty DataFrame
     :param idx: a dictionary treaty.code -> cession index
-    :param overdic: a dictionary treaty.code -> overspill array
+    :param overdict: a dictionary treaty.code -> overspill array
+    :param eids: an array of E event IDs
 
-    Recursively compute cessions and retentions for each treaty.
-    Populate the cession dictionary and returns the final retention.
+    Compute cessions and retentions for each treaty layer, one layer at
+    the time, for all the groups at once; after each layer the groups
+    with the same remaining treaties are summed together.
+    Populate the overspill dictionary and returns the final matrix (E, 2+T).
     """
-    if DEBUG:
-        print()
-        print(line(['event_id', 'policy_grp'] + list(idx)))
-        rows = []
-        for key, data in zip(ukeys, datalist):
-            # printing the losses
-            for eid, row in zip(eids, data):
-                rows.append([eid, key] + list(row))
-        for row in sorted(rows):
-            print(line(row))
-    if len(ukeys) == 1 and ukeys[0] == '':
-        return datalist[0]
-    newkeys, newdatalist = [], []
-    for key, data in zip(ukeys, datalist):
-        code = key[0]
-        newkey = key[1:]
-        if code != '.':
-            tr = treaty_df.loc[code]
-            ret = data[:, idx['retention']]
-            cession = data[:, idx[code]]
+    for t, (code, tr) in enumerate(treaty_df.iterrows()):
+        if DEBUG:
+            print()
+            print(line(['event_id', 'policy_grp'] + list(idx)))
+            rows = []
+            for key, dat in zip(keys, data):
+                grp = ''.join(c if k else '.' for c, k in zip(
+                    treaty_df.index[t:], key))
+                rows.extend([eid, grp] + list(row)
+                            for eid, row in zip(eids, dat))
+            for row in sorted(rows):
+                print(line(row))
+        act = keys[:, 0] != 0
+        if act.any() and tr.type != 'wxlr':
+            ret = data[act, :, idx['retention']]
+            cession = data[act, :, idx[code]]
             capacity = tr.limit - tr.deductible
-            has_over = False
             if tr.type == 'catxl':
                 overspill = ret - tr.deductible - capacity
-                has_over = (overspill > 0).any()
-                apply_treaty(cession, ret, tr.deductible, capacity)
-            elif tr.type == 'prop':
+                apply_treaties(cession, ret, tr.deductible, capacity)
+            else:  # prop
                 overspill = cession - capacity
                 over = overspill > 0
-                has_over = (overspill > 0).any()
-                if has_over:
-                    ret[over] += cession[over] - tr.limit
-                    cession[over] = tr.limit
-            if has_over:
-                overdict['over_' + code] = np.maximum(overspill, 0)
-        newkeys.append(newkey)
-        newdatalist.append(data)
-    keys, sums = fast_agg2(newkeys, np.array(newdatalist))
-    return clever_agg(keys, sums, treaty_df, idx, overdict, eids)
+                ret[over] += cession[over] - tr.limit
+                cession[over] = tr.limit
+            data[act, :, idx['retention']] = ret
+            data[act, :, idx[code]] = cession
+            has_over = (overspill > 0).any(axis=1)
+            if has_over.any():  # the last group with overspill wins
+                overdict['over_' + code] = np.maximum(
+                    overspill[has_over][-1], 0)
+        # sum the groups with the same remaining treaties
+        keys, inv = np.unique(keys[:, 1:], axis=0, return_inverse=True)
+        summed = np.zeros((len(keys),) + data.shape[1:])
+        np.add.at(summed, inv.reshape(-1), data)
+        data = summed
+    return data[0]
 
 
 # tested in reinsurance_test.py
@@ -391,19 +426,7 @@ def by_policy(rbe, pol_dict, treaty_df):
     :returns:
         DataFrame of reinsurance losses by event ID and policy ID
     '''
-    out = {}
-    df = rbe[rbe.agg_id == pol_dict['policy'] - 1]
-    losses = df.loss.to_numpy()
-    ded, lim = pol_dict['deductible'], pol_dict['liability']
-    claim = scientific.insured_losses(losses, ded, lim)
-    out['event_id'] = df.event_id.to_numpy()
-    out['policy_id'] = np.array([pol_dict['policy']] * len(df), int)
-    out.update(claim_to_cessions(claim, pol_dict, treaty_df))
-    nonzero = out['claim'] > 0  # discard zero claims
-    rbp = pd.DataFrame({k: out[k][nonzero] for k in out})
-    # ex: event_id, policy_id, retention, claim, surplus, quota_shared, wxlr
-    rbp['policy_grp'] = build_policy_grp(pol_dict, treaty_df)
-    return rbp
+    return by_policies(rbe, pd.DataFrame([pol_dict]), treaty_df)
 
 
 # called by post_risk
@@ -411,34 +434,36 @@ def by_event(rbp, treaty_df, mon=Monitor()):
     with mon('processing reinsurance by policy', measuremem=True):
         # this is very fast
         tdf = treaty_df.set_index('code')
-        inpcols = ['eid', 'claim'] + [t.id for _, t in tdf.iterrows()
-                                      if t.type != 'catxl']
+        inpcols = ['claim'] + [t.id for _, t in tdf.iterrows()
+                               if t.type != 'catxl']
         outcols = ['retention', 'claim'] + list(tdf.index)
         idx = {col: i for i, col in enumerate(outcols)}
-        eids, idxs = np.unique(rbp.event_id.to_numpy(), return_inverse=True)
-        rbp['eid'] = idxs
-        E = len(eids)
+        eids, eidx = np.unique(rbp.event_id.to_numpy(), return_inverse=True)
+        grps, gidx = np.unique(rbp.policy_grp.to_numpy(),
+                               return_inverse=True)
+        E, G = len(eids), len(grps)
+        for grp in grps:
+            logging.info('Processing policy group %r', grp)
         dic = dict(event_id=eids)
-        keys, datalist = [], []
-        for key, grp in rbp.groupby('policy_grp'):
-            logging.info('Processing policy group %r with %d rows',
-                         key, len(grp))
-            data = np.zeros((E, len(outcols)))
-            gb = grp[inpcols].groupby('eid').sum()
-            for i, col in enumerate(inpcols):
-                if i > 0:  # claim, noncat1, ...
-                    data[gb.index, i] = gb[col].to_numpy()
-            data[:, 0] = data[:, 1]  # retention = claim - noncats
-            for c in range(2, len(outcols)):
-                data[:, 0] -= data[:, c]
-            keys.append(key)
-            datalist.append(data)
-        del rbp['eid'], rbp['policy_grp']
+        # NB: the sign is such that the lexicographic order of the keys
+        # is the same as the order of the policy_grp strings
+        codes = tdf.index.to_numpy().astype(str)
+        sign = np.where(codes > '.', 1, -1)
+        keys = np.array([[c != '.' for c in grp] for grp in grps]) * sign
+        data = np.zeros((G, E, len(outcols)))
+        ge = gidx.reshape(-1) * E + eidx.reshape(-1)
+        for i, col in enumerate(inpcols, 1):  # claim, noncat1, ...
+            data[:, :, i] = np.bincount(
+                ge, rbp[col].to_numpy(), G * E).reshape(G, E)
+        data[:, :, 0] = data[:, :, 1]  # retention = claim - noncats
+        for c in range(2, len(outcols)):
+            data[:, :, 0] -= data[:, :, c]
+        del rbp['policy_grp']
 
     with mon('reinsurance by event', measuremem=True):
         # this is fast
         overspill = {}
-        res = clever_agg(keys, datalist, tdf, idx, overspill, eids)
+        res = clever_agg(keys, data, tdf, idx, overspill, eids)
 
         # sanity check on the result
         ret = res[:, 0]
@@ -457,8 +482,9 @@ def reins_by_policy(dstore, policy_df, treaty_df, loss_id, monitor):
     """
     Task function called by post_risk
     """
+    if len(policy_df) == 0:
+        return
     rbe_mon = monitor('reading risk_by_event')
-    policies = [dict(policy) for _, policy in policy_df.iterrows()]
     dfs = []
     with dstore:
         nrows = len(dstore['risk_by_event/agg_id'])
@@ -466,7 +492,6 @@ def reins_by_policy(dstore, policy_df, treaty_df, loss_id, monitor):
             with rbe_mon:
                 rbe_df = dstore.read_df(
                     'risk_by_event', sel={'loss_id': loss_id}, slc=slc)
-            for policy in policies:
-                dfs.append(by_policy(rbe_df, policy, treaty_df))
+            dfs.append(by_policies(rbe_df, policy_df, treaty_df))
     if dfs:
         yield pd.concat(dfs)
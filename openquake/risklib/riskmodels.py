@@ -403,8 +403,10 @@ class RiskModel(object):
             val = assets['value-' + loss_type].to_numpy()
         asset_df = pandas.DataFrame(dict(aid=assets.index, val=val), sid)
         vf = self.risk_functions[peril][loss_type]
+        stream = scientific.rng_stream(
+            loss_type, sorted(self.risk_functions).index(peril))
         return vf(asset_df, gmf_df, col, rndgen,
-                  self.minimum_asset_loss.get(loss_type, 0.))
+                  self.minimum_asset_loss.get(loss_type, 0.), stream)
 
     scenario = ebrisk = scenario_risk = event_based_risk
 
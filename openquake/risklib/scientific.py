@@ -29,7 +29,7 @@ from functools import lru_cache
 import numpy
 import pandas
 from numpy.testing import assert_equal
-from scipy import interpolate, stats
+from scipy import interpolate, stats, special
 from openquake.baselib import hdf5, general
 
 F64 = numpy.float64
@@ -132,9 +132,10 @@ def fine_graining(points, steps):
 
 # sampling functions
 class Sampler(object):
-    def __init__(self, distname, rng, lratios=(), cols=None):
+    def __init__(self, distname, rng, lratios=(), cols=None, stream=0):
         self.distname = distname
         self.rng = rng
+        self.stream = stream  # used by the VectorizedRNG
         self.arange = numpy.arange(len(lratios))  # for the PM distribution
         self.lratios = lratios  # for the PM distribution
         self.cols = cols  # for the PM distribution
@@ -151,17 +152,23 @@ class Sampler(object):
         means = df['mean'].to_numpy()
         covs = df['cov'].to_numpy()
         eids = df['eid'].to_numpy()
-        return self.rng.lognormal(eids, means, covs)
+        aids = df['aid'].to_numpy()
+        return self.rng.lognormal(eids, means, covs, aids, self.stream)
 
     def sampleBT(self, df):
         means = df['mean'].to_numpy()
         covs = df['cov'].to_numpy()
         eids = df['eid'].to_numpy()
-        return self.rng.beta(eids, means, covs)
+        aids = df['aid'].to_numpy()
+        return self.rng.beta(eids, means, covs, aids, self.stream)
 
     def samplePM(self, df):
         eids = df['eid'].to_numpy()
         allprobs = df[self.cols].to_numpy()
+        if isinstance(self.rng, VectorizedRNG):
+            aids = df['aid'].to_numpy()
+            idxs = self.rng.pmf(eids, allprobs, aids, self.stream)
+            return self.lratios[idxs]
         pmf = []
         for eid, probs in zip(eids, allprobs):  # probs by asset
             if probs.sum() == 0:  # oq-risk-tests/case_1g
@@ -298,12 +305,15 @@ class VulnerabilityFunction(object):
         else:
             raise NotImplementedError(self.distribution_name)
 
-    def __call__(self, asset_df, gmf_df, col, rng=None, minloss=0):
+    def __call__(self, asset_df, gmf_df, col, rng=None, minloss=0,
+                 stream=0):
         """
         :param asset_df: a DataFrame with A assets
         :param gmf_df: a DataFrame of GMFs for the given assets
         :param col: GMF column associated to the IMT (i.e. "gmv_0")
         :param rng: a MultiEventRNG or None
+        :param minloss: losses below this value are discarded
+        :param stream: stream of random numbers (see `rng_stream`)
         :returns: a DataFrame with columns eid, aid, loss
         """
         if asset_df is None:  # in the tests
@@ -316,7 +326,8 @@ class VulnerabilityFunction(object):
             lratios = ()
             cols = None
         df = ratio_df.join(asset_df, how='inner')
-        sampler = Sampler(self.distribution_name, rng, lratios, cols)
+        sampler = Sampler(
+            self.distribution_name, rng, lratios, cols, stream)
         covs = not hasattr(self, 'covs') or self.covs.any()
         losses = sampler.get_losses(df, covs)
         ok = losses > minloss
@@ -846,11 +857,13 @@ class MultiEventRNG(object):
                 return eps
         return self.rng[eid].normal()
 
-    def lognormal(self, eids, means, covs):
+    def lognormal(self, eids, means, covs, aids=None, stream=0):
         """
         :param eids: event IDs
         :param means: array of floats in the range 0..1
         :param covs: array of floats with the same shape
+        :param aids: asset IDs (ignored)
+        :param stream: ignored, the numbers are drawn sequentially
         :returns: array of floats
         """
         corrcache = {}
@@ -860,11 +873,13 @@ class MultiEventRNG(object):
         return means * numpy.exp(eps * sigma) / div
 
     # NB: asset correlation is ignored
-    def beta(self, eids, means, covs):
+    def beta(self, eids, means, covs, aids=None, stream=0):
         """
         :param eids: event IDs
         :param means: array of floats in the range 0..1
         :param covs: array of floats with the same shape
+        :param aids: asset IDs (ignored)
+        :param stream: ignored, the numbers are drawn sequentially
         :returns: array of floats following the beta distribution
 
         This function works properly even when some or all of the stddevs
@@ -882,7 +897,8 @@ class MultiEventRNG(object):
                    for i, eid in enumerate(eids[ok])]
         return res
 
-    def discrete_dmg_dist(self, eids, fractions, numbers):
+    def discrete_dmg_dist(self, eids, fractions, numbers, aids=None,
+                          stream=0):
         """
         Converting fractions into discrete damage distributions using bincount
         and random.choice.
@@ -890,6 +906,8 @@ class MultiEventRNG(object):
         :param eids: E event IDs
         :param fractions: array of shape (A, E, D)
         :param numbers: A asset numbers
+        :param aids: A asset IDs (ignored)
+        :param stream: ignored, the numbers are drawn sequentially
         :returns: array of integers of shape (A, E, D)
         """
         A, E, D = fractions.shape
@@ -905,7 +923,7 @@ class MultiEventRNG(object):
                 ddd[a, e] = numpy.bincount(states, minlength=D)
         return ddd
 
-    def boolean_dist(self, probs, num_sims):
+    def boolean_dist(self, probs, num_sims, stream=0):
         """
         Convert E probabilities into an array of (E, S)
         booleans, being S the number of secondary simulations.
@@ -924,6 +942,203 @@ class MultiEventRNG(object):
         return booldist
 
 
+# constants of the Philox4x32-10 generator (Salmon et al. 2011)
+PHILOX_M = numpy.uint64(0xD2511F53), numpy.uint64(0xCD9E8D57)
+PHILOX_W = numpy.uint64(0x9E3779B9), numpy.uint64(0xBB67AE85)
+MASK32 = numpy.uint64(0xFFFFFFFF)
+SHIFT32 = numpy.uint64(32)
+# the last counter word of VectorizedRNG is (stream << 8) | kind, with
+# the kind distinguishing the sampling methods and the damage states
+LN, BT, PM, BOOL, DMG = 0, 1, 2, 3, 16
+
+
+def rng_stream(loss_type, peril=0):
+    """
+    :param loss_type: a loss type name
+    :param peril: the index of the peril
+    :returns: the stream to be used in VectorizedRNG for the loss type
+
+    >>> rng_stream('structural'), rng_stream('structural', 1)
+    (3, 46)
+    """
+    return peril * len(LOSSTYPE) + LOSSID[loss_type]
+
+
+def philox4x32(c0, c1, c2, c3, k0, k1):
+    """
+    Vectorized Philox4x32-10 block function.
+
+    :param c0, c1, c2, c3: uint64 arrays with the 32 bit counter words
+    :param k0, k1: uint64 scalars with the 32 bit key words
+    :returns: four uint64 arrays with 32 bit random words
+    """
+    for _ in range(10):
+        p0 = PHILOX_M[0] * c0
+        p1 = PHILOX_M[1] * c2
+        c0, c1, c2, c3 = ((p1 >> SHIFT32) ^ c1 ^ k0, p1 & MASK32,
+                          (p0 >> SHIFT32) ^ c3 ^ k1, p0 & MASK32)
+        k0 = (k0 + PHILOX_W[0]) & MASK32
+        k1 = (k1 + PHILOX_W[1]) & MASK32
+    return c0, c1, c2, c3
+
+
+class VectorizedRNG(MultiEventRNG):
+    """
+    A counter-based version of :class:`MultiEventRNG`: the random numbers
+    are computed in bulk by the Philox4x32-10 block function keyed by the
+    master seed, with counter (eid, aid, stream). Therefore they do not
+    depend on how the events and the assets are split in tasks.
+
+    >>> rng = VectorizedRNG(master_seed=42, eids=[0, 1, 2])
+    >>> eids = numpy.array([1] * 3)
+    >>> aids = numpy.array([0, 1, 2])
+    >>> means = numpy.array([.5] * 3)
+    >>> covs = numpy.array([.1] * 3)
+    >>> rng.lognormal(eids, means, covs, aids)
+    array([0.62259428, 0.44441265, 0.50533657])
+    >>> rng.beta(eids, means, covs, aids)
+    array([0.44178585, 0.4685161 , 0.50057726])
+    >>> fractions = numpy.array([[[.8, .1, .1]]])
+    >>> rng.discrete_dmg_dist([0], fractions, [10])
+    array([[[7, 2, 1]]], dtype=uint32)
+    """
+    def __init__(self, master_seed, eids, asset_correlation=0):
+        self.master_seed = master_seed
+        self.asset_correlation = asset_correlation
+        self.eids = numpy.array(eids)
+        seed = int(master_seed)
+        self.key = numpy.uint64(seed & 0xFFFFFFFF), numpy.uint64(seed >> 32)
+
+    def uniform(self, eids, aids, stream=0, kind=LN):
+        """
+        :param eids: array of event IDs
+        :param aids: array of asset IDs with the same shape
+        :param stream: an integer to get independent numbers
+        :param kind: an integer < 256 to get independent numbers
+        :returns: uniform floats in the open interval (0, 1)
+        """
+        eids = numpy.asarray(eids, numpy.uint64)
+        aids = numpy.broadcast_to(numpy.asarray(aids, numpy.uint64),
+                                  eids.shape)
+        c3 = numpy.full(eids.shape, (stream << 8) | kind, numpy.uint64)
+        r0, r1, _, _ = philox4x32(eids & MASK32, eids >> SHIFT32,
+                                  aids, c3, *self.key)
+        # 53 random bits, as in numpy.random.Generator.random
+        bits = ((r0 >> numpy.uint64(5)) << numpy.uint64(26)) | (
+            r1 >> numpy.uint64(6))
+        return (bits + .5) / 9007199254740992.  # 2**53
+
+    def _aids(self, eids, aids):
+        # without asset IDs each element gets independent numbers
+        if self.asset_correlation:
+            return numpy.zeros(len(eids), numpy.uint64)
+        elif aids is None:
+            return numpy.arange(len(eids), dtype=numpy.uint64)
+        return aids
+
+    def lognormal(self, eids, means, covs, aids=None, stream=0):
+        """
+        :param eids: event IDs
+        :param means: array of floats in the range 0..1
+        :param covs: array of floats with the same shape
+        :param aids: asset IDs
+        :param stream: stream of random numbers (i.e. for the loss type)
+        :returns: array of floats
+        """
+        u = self.uniform(eids, self._aids(eids, aids), stream, LN)
+        eps = special.ndtri(u)
+        sigma = numpy.sqrt(numpy.log(1 + covs ** 2))
+        div = numpy.sqrt(1 + covs ** 2)
+        return means * numpy.exp(eps * sigma) / div
+
+    # NB: asset correlation is ignored, as in MultiEventRNG
+    def beta(self, eids, means, covs, aids=None, stream=0):
+        """
+        :param eids: event IDs
+        :param means: array of floats in the range 0..1
+        :param covs: array of floats with the same shape
+        :param aids: asset IDs
+        :param stream: stream of random numbers (i.e. for the loss type)
+        :returns: array of floats following the beta distribution
+        """
+        res = numpy.array(means)
+        ok = (means != 0) & (covs != 0)  # nonsingular values
+        if aids is None:
+            aids = numpy.arange(len(eids), dtype=numpy.uint64)
+        alpha, beta = _alpha_beta(means[ok], means[ok] * covs[ok])
+        res[ok] = special.betaincinv(
+            alpha, beta, self.uniform(eids[ok], aids[ok], stream, BT))
+        return res
+
+    def pmf(self, eids, allprobs, aids, stream=0):
+        """
+        :param eids: E event IDs
+        :param allprobs: array of shape (E, P) with probabilities
+        :param aids: E asset IDs
+        :param stream: stream of random numbers (i.e. for the loss type)
+        :returns: E indices in the range 0..P-1
+        """
+        cumprobs = allprobs.cumsum(axis=1)
+        thresholds = self.uniform(eids, aids, stream, PM) * cumprobs[:, -1]
+        idxs = (cumprobs < thresholds[:, None]).sum(axis=1)
+        return numpy.minimum(idxs, allprobs.shape[1] - 1)
+
+    def discrete_dmg_dist(self, eids, fractions, numbers, aids=None,
+                          stream=0):
+        """
+        Converting fractions into discrete damage distributions by sampling
+        the multinomial distribution as a chain of binomials with
+        inverse transform sampling, vectorized on assets and events.
+
+        :param eids: E event IDs
+        :param fractions: array of shape (A, E, D)
+        :param numbers: A asset numbers
+        :param aids: A asset IDs (by default 0, 1, ... A-1)
+        :param stream: stream of random numbers (i.e. for the loss type)
+        :returns: array of integers of shape (A, E, D)
+        """
+        A, E, D = fractions.shape
+        assert len(eids) == E, (len(eids), E)
+        assert len(numbers) == A, (len(eids), A)
+        assert D <= 256 - DMG, D
+        if aids is None:
+            aids = numpy.arange(A)
+        eids2 = numpy.broadcast_to(numpy.asarray(eids)[None, :], (A, E))
+        aids2 = numpy.broadcast_to(numpy.asarray(aids)[:, None], (A, E))
+        probs = fractions / fractions.sum(axis=2)[:, :, None]
+        ddd = numpy.zeros(fractions.shape, U32)
+        left = numpy.broadcast_to(
+            numpy.asarray(numbers, F64)[:, None], (A, E)).copy()
+        rest = numpy.ones((A, E))  # probability left
+        for d in range(D - 1):
+            p = numpy.clip(probs[:, :, d] / numpy.maximum(rest, 1E-300),
+                           0., 1.)
+            u = self.uniform(eids2, aids2, stream, DMG + d)
+            n = numpy.nan_to_num(stats.binom.ppf(u, left, p))
+            ddd[:, :, d] = n
+            left -= n
+            rest -= probs[:, :, d]
+        ddd[:, :, D - 1] = left
+        return ddd
+
+    def boolean_dist(self, probs, num_sims, stream=0):
+        """
+        Convert E probabilities into an array of (E, S)
+        booleans, being S the number of secondary simulations.
+
+        >>> rng = VectorizedRNG(master_seed=42, eids=[0, 1, 2])
+        >>> dist = rng.boolean_dist(probs=[.1, .2, 0.], num_sims=100)
+        >>> dist.sum(axis=1)  # around 10% and 20% respectively
+        array([ 9., 20.,  0.])
+        """
+        E = len(self.eids)
+        assert len(probs) == E, (len(probs), E)
+        sims = numpy.arange(num_sims)
+        eids = numpy.broadcast_to(self.eids[:, None], (E, num_sims))
+        probs = numpy.array(probs)[:, None]
+        return (self.uniform(eids, sims, stream, BOOL) < probs).astype(float)
+
+
 #
 # Event Based
 #
@@ -1575,6 +1790,89 @@ def losses_by_period(losses, return_periods, num_events, eff_time=None,
     return res
 
 
+def losses_by_period_segmented(losses, starts, return_periods, num_events,
+                               eff_time, pla_factor=None):
+    """
+    Vectorized version of :func:`losses_by_period` working on G groups
+    of losses at the same time, stored contiguously in a single array.
+
+    :param losses: an array of N losses, sorted inside each group
+    :param starts: G indices of the first loss of each group
+    :param return_periods: P ordered return periods
+    :param num_events: G numbers of events (>= number of losses per group)
+    :param eff_time: investigation_time * ses_per_logic_tree_path
+    :param pla_factor: Post-Loss-Amplification interpolator or None
+    :returns: a pair of arrays of shape (G, P), the second one being None
+              if there is no pla_factor
+
+    >>> losses = numpy.array([1, 2, 2, 3, 3, 3.5, 4, 4, 5, 7, 8, 9, 11, 13,
+    ...                       23, 6, 7])
+    >>> curves, _ = losses_by_period_segmented(
+    ...     losses, [0, 15], [1, 2, 5, 10, 20, 50, 100], [20, 4], 100)
+    >>> curves
+    array([[ 0. ,  0. ,  0. ,  3.5,  8. , 13. , 23. ],
+           [ 0. ,  0. ,  0. ,  0. ,  0. ,  6. ,  7. ]])
+    """
+    losses = numpy.asarray(losses)
+    starts = numpy.asarray(starts)
+    num_events = numpy.asarray(num_events)
+    counts = numpy.diff(numpy.append(starts, len(losses)))
+    if (counts > num_events).any():
+        g = (counts > num_events).argmax()
+        raise ValueError('More losses (%d) than events (%d) ??' %
+                         (counts[g], num_events[g]))
+    rperiods = numpy.asarray(return_periods)
+    shp = len(starts), len(rperiods)
+    curves = numpy.zeros(shp, losses.dtype)
+    plas = numpy.zeros(shp, losses.dtype) if pla_factor else None
+
+    # on the left of eff_time / num_events zeros, on the right of eff_time NaNs
+    right = rperiods > eff_time
+    curves[:, right] = numpy.nan
+    if plas is not None:
+        plas[:, right] = numpy.nan
+    g, p = numpy.nonzero(
+        (rperiods >= eff_time / num_events[:, None]) & ~right)
+    if len(g) == 0:
+        return curves, plas
+
+    # the eperiods of a group are eff_time / numpy.arange(ne, 0., -1), i.e.
+    # the k-th is eff_time / (ne - k); replicate numpy.interp on them
+    ne = num_events[g]
+    pad = ne - counts[g]  # number of zeros added on the left
+    x = numpy.log(rperiods)[p]
+
+    def loge(k):
+        return numpy.log(eff_time / (ne - k).astype(F64))
+
+    def value(k):
+        out = numpy.zeros(len(k))
+        ok = k >= pad
+        out[ok] = losses[starts[g[ok]] + k[ok] - pad[ok]]
+        return out
+    j = numpy.clip(numpy.floor(ne - eff_time / rperiods[p]).astype(int),
+                   0, ne - 1)
+    while (big := loge(j) > x).any():
+        j[big] -= 1
+    while True:
+        j1 = numpy.minimum(j + 1, ne - 1)
+        small = (j1 > j) & (loge(j1) <= x)
+        if not small.any():
+            break
+        j[small] += 1
+    x0, x1 = loge(j), loge(j1)
+    exact = (j1 == j) | (x0 == x)
+    ys = [(value(j), value(j1))]
+    if plas is not None:
+        ys.append((ys[0][0] * pla_factor(eff_time / (ne - j).astype(F64)),
+                   ys[0][1] * pla_factor(eff_time / (ne - j1).astype(F64))))
+    for out, (y0, y1) in zip([curves, plas], ys):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            slope = (y1 - y0) / (x1 - x0)
+        out[g, p] = numpy.where(exact, y0, slope * (x - x0) + y0)
+    return curves, plas
+
+
 class LossCurvesMapsBuilder(object):
     """
     Build losses curves and maps for all loss types at the same time.
@@ -1744,7 +2042,8 @@ class RiskComputer(dict):
                     # the Messina test in oq-risk-tests becomes 12x
                     # slower even if it has only 25_736 assets
                     dd5[p, :, :, li, :D] = rng.discrete_dmg_dist(
-                        gmf_df.eid, fractions, number)
+                        gmf_df.eid.to_numpy(), fractions, number,
+                        adf.index.to_numpy(), rng_stream(lt, p))
 
         if crm:
             csqs = crm.get_consequences()
@@ -614,6 +614,91 @@ class LossesByEventTestCase(unittest.TestCase):
         print('retention', ret_curve)
 
 
+class VectorizedRNGTestCase(unittest.TestCase):
+    def test_independent_from_chunks(self):
+        eids = numpy.arange(10)
+        aids = numpy.arange(10) % 3
+        means = numpy.full(10, .5)
+        covs = numpy.full(10, .3)
+        rng = scientific.VectorizedRNG(42, eids)
+        for meth in ('lognormal', 'beta'):
+            full = getattr(rng, meth)(eids, means, covs, aids)
+            rng5 = scientific.VectorizedRNG(42, eids[5:])
+            half = getattr(rng5, meth)(eids[5:], means[5:], covs[5:],
+                                       aids[5:])
+            aac(full[5:], half)
+
+    def test_asset_correlation(self):
+        eids = numpy.array([1, 1, 1])
+        aids = numpy.array([0, 1, 2])
+        ones = numpy.ones(3)
+        rng = scientific.VectorizedRNG(42, [1], asset_correlation=1)
+        losses = rng.lognormal(eids, ones * .5, ones * .1, aids)
+        self.assertEqual(len(set(losses)), 1)
+        rng = scientific.VectorizedRNG(42, [1])
+        losses = rng.lognormal(eids, ones * .5, ones * .1, aids)
+        self.assertEqual(len(set(losses)), 3)
+
+    def test_moments(self):
+        N = 100_000
+        eids = numpy.arange(N)
+        aids = numpy.zeros(N, int)
+        means = numpy.full(N, .3)
+        covs = numpy.full(N, .4)
+        rng = scientific.VectorizedRNG(42, eids)
+        for meth in ('lognormal', 'beta'):
+            vals = getattr(rng, meth)(eids, means, covs, aids)
+            aac(vals.mean(), .3, rtol=1e-2)
+            aac(vals.std() / vals.mean(), .4, rtol=1e-2)
+
+    def test_independent_streams(self):
+        # the draws for different loss types and different sampling
+        # methods must be independent, as in MultiEventRNG
+        N = 10_000
+        eids = numpy.arange(N)
+        aids = numpy.zeros(N, int)
+        means = numpy.full(N, .3)
+        covs = numpy.full(N, .4)
+        rng = scientific.VectorizedRNG(42, eids)
+        st = scientific.rng_stream('structural')
+        co = scientific.rng_stream('contents')
+        x = numpy.log(rng.lognormal(eids, means, covs, aids, st))
+        y = numpy.log(rng.lognormal(eids, means, covs, aids, co))
+        self.assertLess(abs(numpy.corrcoef(x, y)[0, 1]), .03)
+        z = rng.beta(eids, means, covs, aids, st)
+        self.assertLess(abs(numpy.corrcoef(x, z)[0, 1]), .03)
+
+        # without asset IDs each element gets a different number
+        vals = rng.beta(numpy.zeros(3, int), means[:3], covs[:3])
+        self.assertEqual(len(set(vals)), 3)
+
+        # the secondary simulations do not reuse the asset numbers
+        sims = rng.boolean_dist(numpy.full(N, .5), 2)
+        u = rng.uniform(eids, numpy.zeros(N, int)) < .5
+        self.assertLess((sims[:, 0] == u).mean(), .55)
+
+    def test_discrete_dmg_dist(self):
+        eids = numpy.arange(1000)
+        fractions = numpy.zeros((4, 1000, 3))
+        fractions[:] = [.5, .3, .2]
+        numbers = numpy.array([10, 20, 0, 1])
+        rng = scientific.VectorizedRNG(42, eids)
+        ddd = rng.discrete_dmg_dist(eids, fractions, numbers)
+        aac(ddd.sum(axis=2), numpy.repeat(numbers[:, None], 1000, 1))
+        aac(ddd[1].mean(axis=0), [10, 6, 4], rtol=.02)
+
+        # the numbers depend on the asset IDs and not on their order
+        ddd2 = rng.discrete_dmg_dist(eids, fractions[::-1], numbers[::-1],
+                                     numpy.arange(4)[::-1])
+        aac(ddd2[::-1], ddd)
+
+    def test_pmf(self):
+        eids = numpy.arange(6)
+        probs = numpy.array([[0., 1., 0.]] * 3 + [[0., 0., 0.]] * 3)
+        rng = scientific.VectorizedRNG(42, eids)
+        aac(rng.pmf(eids, probs, eids), [1, 1, 1, 0, 0, 0])
+
+
 class PlaFactorTestCase(unittest.TestCase):
     def test_interp(self):
         rps = [1, 5, 10, 50, 100, 500, 1000]
@@ -800,3 +885,7 @@ class RiskComputerTestCase(unittest.TestCase):
         dd1 = dd5[0, 0, 1, 0, 1:]
         aac(dd0, [10, 8, 4, 0])
         aac(dd1, [31, 14, 3, 0], atol=1e-8)
+
+        rng = scientific.VectorizedRNG(master_seed=42, eids=gmf_df.eid)
+        dd5 = rc.get_dd5(asset_df, gmf_df, rng)  # (A, E, L, D)
+        aac(dd5[0, 0, :, 0, :rc.D].sum(axis=1), [100, 100])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2024, GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import numpy
+from openquake.baselib import sap
+from openquake.baselib.general import AccumDict, fast_agg2
+from openquake.calculators import event_based_risk as ebr
+from openquake.calculators.views import text_table
+
+
+def agg_with_dict(keys, values, xtypes):
+    # the original algorithm, accumulating an array for each key
+    acc = AccumDict(accum=numpy.zeros((len(xtypes), 2)))
+    for li, (kk, vv) in enumerate(zip(keys, values)):
+        for ukey, avalue in zip(*fast_agg2(kk, vv)):
+            acc[ukey][li] += avalue
+    dic = AccumDict(accum=[])
+    for ukey, arr in acc.items():
+        eid, kid = divmod(ukey, ebr.TWO32)
+        for li in range(len(xtypes)):
+            if arr[li].any():
+                dic['event_id'].append(eid)
+                dic['agg_id'].append(kid)
+                dic['loss_id'].append(ebr.LOSSID[xtypes[li]])
+                dic['variance'].append(arr[li, 0])
+                dic['loss'].append(arr[li, 1])
+    return dic
+
+
+def main(N: int = 200_000, E: int = 10_000, K: int = 500,
+         chunks: int = 4):
+    """
+    Compare the array-based event loss table built by ebr.aggreg with
+    the original dict-based algorithm, for two loss types with N rows
+    each, E events and K aggregation keys. Use it as
+
+    $ python bench_elt.py 200000 10000 500
+    """
+    rng = numpy.random.default_rng(42)
+    xtypes = ['structural', 'nonstructural']
+    keys, values = [], []
+    for li in range(len(xtypes)):
+        eids = rng.integers(0, E, N).astype(numpy.uint64)
+        kids = rng.integers(0, K, N).astype(numpy.uint64)
+        keys.append(eids * ebr.TWO32 + kids)
+        vals = rng.random((N, 2))
+        vals[rng.random(N) < .1] = 0  # some zero losses
+        values.append(vals)
+
+    t0 = time.time()
+    expected = agg_with_dict(keys, values, xtypes)
+    t_dict = time.time() - t0
+
+    t0 = time.time()
+    acc = [[] for _ in xtypes]
+    for li in range(len(xtypes)):
+        for chunk in numpy.array_split(numpy.arange(N), chunks):
+            ebr.fast_agg(keys[li][chunk], values[li][chunk], False, li, acc)
+    got = ebr.build_event_loss_table(acc, xtypes)
+    t_arr = time.time() - t0
+
+    order = numpy.lexsort((expected['loss_id'], expected['agg_id'],
+                           expected['event_id']))
+    maxdiff = numpy.abs(
+        got['loss'] - numpy.array(expected['loss'])[order]).max()
+    rows = [('dict', t_dict, 0.), ('arrays', t_arr, maxdiff)]
+    print(text_table(rows, ['algorithm', 'seconds', 'maxdiff'], ext='org'))
+
+
+main.N = 'number of rows per loss type'
+main.E = 'number of events'
+main.K = 'number of aggregation keys'
+main.chunks = 'number of blocks passed to fast_agg'
+
+if __name__ == '__main__':
+    sap.run(main)
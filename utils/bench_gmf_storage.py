@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2024, GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import time
+import tempfile
+import numpy
+from openquake.baselib import sap, hdf5, general
+from openquake.commonlib import datastore
+from openquake.commonlib.calc import round_gmvs, GMF_CHUNK
+from openquake.calculators.views import text_table
+
+SETTINGS = [(None, 0), ('lzf', 0), ('gzip', 0),
+            ('lzf', 1E-3), ('gzip', 1E-3), ('gzip', 1E-2)]
+
+
+def store(fname, cols, compression, precision, blocksize):
+    # write the columns in blocks, as EventBasedCalculator.agg_dicts does
+    if compression:
+        kw = dict(compression=compression, shuffle=True, chunks=(GMF_CHUNK,))
+    else:
+        kw = {}
+    size = len(cols['sid'])
+    with hdf5.File(fname, 'w') as f:
+        f.create_df('gmf_data', [(col, arr.dtype) for col, arr in cols.items()],
+                    **kw)
+        for slc in general.gen_slices(0, size, blocksize):
+            for col, arr in cols.items():
+                if col.startswith('gmv_'):
+                    arr = round_gmvs(arr[slc], precision)
+                else:
+                    arr = arr[slc]
+                hdf5.extend(f['gmf_data/' + col], arr)
+
+
+def main(calc_id: int = -1, blocksize: int = 100_000):
+    """
+    Compare the write/read throughput and the file size of gmf_data
+    for the supported values of gmf_compression and gmf_precision,
+    starting from the GMFs of an existing calculation, for instance
+
+    $ oq engine --run demos/hazard/EventBasedPSHA/job.ini
+    $ python bench_gmf_storage.py -1
+    """
+    with datastore.read(calc_id) as ds:
+        cols = {col: ds['gmf_data/' + col][:] for col in
+                ds['gmf_data'].attrs['__pdcolumns__'].split()}
+    nbytes = sum(arr.nbytes for arr in cols.values())
+    print('Read %s of GMFs (%d rows)' % (
+        general.humansize(nbytes), len(cols['sid'])))
+    rows = []
+    for compression, precision in SETTINGS:
+        fname = tempfile.mktemp(suffix='.hdf5')
+        t0 = time.time()
+        store(fname, cols, compression, precision, blocksize)
+        dt_write = time.time() - t0
+        t0 = time.time()
+        with hdf5.File(fname, 'r') as f:
+            df = f.read_df('gmf_data')
+        dt_read = time.time() - t0
+        gmv = [col for col in df.columns if col.startswith('gmv_')]
+        err = max(numpy.abs(df[col].to_numpy() / cols[col] - 1)[
+            cols[col] > 0].max(initial=0) for col in gmv)
+        size = os.path.getsize(fname)
+        os.remove(fname)
+        rows.append((compression or '-', precision,
+                     general.humansize(size),
+                     nbytes / dt_write / 1024**2, nbytes / dt_read / 1024**2,
+                     err))
+    print(text_table(rows, ['compression', 'precision', 'size',
+                            'write MB/s', 'read MB/s', 'max_rel_err'],
+                     ext='org'))
+
+
+main.calc_id = 'calculation with gmf_data'
+main.blocksize = 'number of rows stored for each block'
+
+if __name__ == '__main__':
+    sap.run(main)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2024, GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import logging
+import numpy
+from openquake.baselib import sap
+from openquake.hazardlib.contexts import get_cmakers
+from openquake.hazardlib.map_array import MapArray
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.commonlib import readinput
+from openquake.calculators.views import text_table
+
+
+def update(cmaker, ctxs, N, fused):
+    cmaker.fused = fused
+    L, G = cmaker.loglevels.size, len(cmaker.gsims)
+    pmap = MapArray(numpy.arange(N), L, G).fill(1)
+    t0 = time.time()
+    for ctx in ctxs:
+        cmaker.update(pmap, ctx)
+    return pmap.array, time.time() - t0
+
+
+def main(job_ini, grp_id: int=-1):
+    """
+    Compare the fused kernel for the PoEs with the original
+    set_poes + update_indep path on a source group. Use it as
+
+    $ python bench_poes.py /path/to/job.ini
+
+    By default the source group with more sources is used.
+    """
+    logging.basicConfig(level=logging.INFO)
+    oq = readinput.get_oqparam(job_ini)
+    csm = readinput.get_composite_source_model(oq)
+    sitecol = readinput.get_site_collection(oq)
+    cmakers = get_cmakers(csm.src_groups, csm.full_lt, oq)
+    if grp_id == -1:
+        grp_id = max(range(len(csm.src_groups)),
+                     key=lambda g: len(csm.src_groups[g]))
+    cmaker = cmakers[grp_id]
+    cmaker.tom = PoissonTOM(oq.investigation_time)
+    cmaker.cluster = 0
+    srcs = []
+    for src in csm.src_groups[grp_id]:
+        srcs.extend(src)
+    logging.info('Building the contexts for %d sources', len(srcs))
+    ctxs = cmaker.from_srcs(srcs, sitecol)
+    if not all(cmaker.fusable(ctx) for ctx in ctxs):
+        logging.warning('The fused kernel is not applicable to group %d',
+                        grp_id)
+    N = len(sitecol.complete)
+    update(cmaker, ctxs, N, True)  # warmup
+    orig, t_orig = update(cmaker, ctxs, N, False)
+    fused, t_fused = update(cmaker, ctxs, N, True)
+    maxdiff = numpy.abs(fused - orig).max()
+    rows = [('original', t_orig, 0.), ('fused', t_fused, maxdiff)]
+    print(text_table(rows, ['path', 'seconds', 'maxdiff'], ext='org'))
+
+
+main.job_ini = 'path to a job.ini file'
+main.grp_id = 'source group to use (default the largest)'
+
+if __name__ == '__main__':
+    sap.run(main)
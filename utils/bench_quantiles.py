@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2024, GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import functools
+import numpy
+from openquake.baselib import sap
+from openquake.hazardlib import stats
+from openquake.calculators.views import text_table
+
+
+def quantile_loop(quantile, curves, weights):
+    # the original algorithm, sorting the realizations for each element
+    R = len(curves)
+    result = numpy.zeros(curves.shape[1:])
+    for idx, _ in numpy.ndenumerate(result):
+        cw = numpy.zeros(R, stats.cw_dt)
+        cw['c'] = curves[(slice(None), ) + idx]
+        cw['w'] = weights
+        cw.sort(order='c')
+        result[idx] = numpy.interp(quantile, cw['w'].cumsum(), cw['c'])
+    return result
+
+
+def main(R: int=10_000, L: int=100, quantiles='0.05 0.16 0.5 0.84 0.95'):
+    """
+    Compare the computation of the mean and the quantiles of R curves
+    with L levels (i.e. a single site in postclassical) with the original
+    per-element algorithm. Use it as
+
+    $ python bench_quantiles.py 10000 100
+    """
+    qs = [float(q) for q in quantiles.split()]
+    funcs = [stats.mean_curve] + [
+        functools.partial(stats.quantile_curve, q) for q in qs]
+    rng = numpy.random.default_rng(42)
+    curves = rng.random((R, L))
+    weights = rng.random(R)
+    weights /= weights.sum()
+
+    t0 = time.time()
+    orig = numpy.array([stats.mean_curve(curves, weights)] +
+                       [quantile_loop(q, curves, weights) for q in qs])
+    t_orig = time.time() - t0
+
+    t0 = time.time()
+    single = numpy.array([func(curves, weights) for func in funcs])
+    t_single = time.time() - t0
+
+    t0 = time.time()
+    shared = stats.compute_stats(curves, funcs, weights)
+    t_shared = time.time() - t0
+
+    rows = [('per element', t_orig, 0.),
+            ('per quantile', t_single, numpy.abs(single - orig).max()),
+            ('shared sort', t_shared, numpy.abs(shared - orig).max())]
+    print(text_table(rows, ['algorithm', 'seconds', 'maxdiff'], ext='org'))
+
+
+main.R = 'number of realizations'
+main.L = 'number of levels'
+main.quantiles = 'space-separated quantiles'
+
+if __name__ == '__main__':
+    sap.run(main)